@@ -18,14 +18,30 @@ def get_args():
     parser.add_argument('--n-cycles', type=int, default=5, help='the times to collect samples per epoch')
     parser.add_argument('--n-batches', type=int, default=40, help='the times to update the network')
     parser.add_argument('--save-interval', type=int, default=5, help='the interval that save the trajectory')
+    parser.add_argument('--checkpoint-interval', type=int, default=0, help='epochs between full training state checkpoints (replay buffer included), 0 to disable')
+    parser.add_argument('--resume', type=str, default=None, help='checkpoint (or the run directory holding it) to resume training from')
+    parser.add_argument('--phase-timing', action='store_true', help='log the time spent in each phase of an epoch')
+    parser.add_argument('--profile-start', type=int, default=-1, help='update step at which a torch.profiler trace starts')
+    parser.add_argument('--profile-steps', type=int, default=0, help='number of update steps in the torch.profiler trace')
     parser.add_argument('--seed', type=int, default=123, help='random seed')
     parser.add_argument('--num-workers', type=int, default=1, help='the number of cpus to collect samples')
+    parser.add_argument('--num-collectors', type=int, default=0, help='collector processes for the async actor/learner mode, 0 to disable')
+    parser.add_argument('--sync-interval', type=int, default=100, help='updates between parameter syncs to the collectors')
     parser.add_argument('--replay-strategy', type=str, default='none', help='the HER strategy')
     parser.add_argument('--clip-return', type=float, default=50, help='if clip the returns')
     parser.add_argument('--save-dir', type=str, default='saved_models', help='the path to save the models')
     parser.add_argument('--noise-eps', type=float, default=0.2, help='noise eps')
     parser.add_argument('--random-eps', type=float, default=0.3, help='random eps')
     parser.add_argument('--buffer-size', type=int, default=int(1e6), help='the size of the buffer')
+    parser.add_argument('--replay-type', type=str, default='ring', help='[ring, frame_store, torch, prioritized, tiered]')
+    parser.add_argument('--per-alpha', type=float, default=0.6, help='priority exponent of the prioritized replay')
+    parser.add_argument('--per-beta', type=float, default=0.4, help='importance sampling exponent of the prioritized replay')
+    parser.add_argument('--hot-buffer-size', type=int, default=int(2e5), help='transitions kept in memory by the tiered buffer')
+    parser.add_argument('--cold-chunk-size', type=int, default=10000, help='transitions per chunk file of the tiered buffer')
+    parser.add_argument('--cold-dir', type=str, default='data/replay_cold', help='where the tiered buffer spills its old transitions')
+    parser.add_argument('--cold-compress', action='store_true', help='compress the chunk files of the tiered buffer')
+    parser.add_argument('--cold-resident-chunks', type=int, default=4, help='compressed chunks held in memory to sample from (--cold-compress)')
+    parser.add_argument('--cold-swap-interval', type=int, default=50, help='samples between two resident chunk swaps (--cold-compress)')
     parser.add_argument('--replay-k', type=int, default=4, help='ratio to be replace')
     parser.add_argument('--clip-obs', type=float, default=200, help='the clip ratio')
     parser.add_argument('--batch-size', type=int, default=128, help='the sample batch size')
@@ -35,11 +51,16 @@ def get_args():
     parser.add_argument('--lr', type=float, default=0.001, help='the learning rate')
     parser.add_argument('--polyak', type=float, default=0.95, help='the average coefficient')
     parser.add_argument('--n-test-rollouts', type=int, default=10, help='the number of tests')
+    parser.add_argument('--reset-pool', type=str, default=None, help='file of saved atari start states, generated if missing')
+    parser.add_argument('--reset-pool-size', type=int, default=100, help='the number of start states in a new reset pool')
+    parser.add_argument('--num-eval-envs', type=int, default=0, help='envs playing test episodes at once, 0 to evaluate sequentially')
     parser.add_argument('--clip-range', type=float, default=5, help='the clip range')
     parser.add_argument('--demo-length', type=int, default=20, help='the demo length')
     parser.add_argument('--cuda', action='store_true', help='if use gpu do the acceleration')
     parser.add_argument('--soft-update', action='store_true', help='if use soft bellman backup')
     parser.add_argument('--num-rollouts-per-cycle', type=int, default=2, help='the rollouts per mpi')
+    parser.add_argument('--reward-type', type=str, default='dense', help='reward of the atari goal tasks [dense, sparse]')
+    parser.add_argument('--reward-cache-dir', type=str, default='data/reward_tables', help='where precomputed reward tables are kept')
     parser.add_argument('--temp', type=float, default=200, help='Boltzmann temperature')
     parser.add_argument('--update-eps', type=float, default=0.2, help='exploration epsilon')
 
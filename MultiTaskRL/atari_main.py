@@ -10,7 +10,7 @@ from atari_modules.reward_encoder_ablation_agent import RewardEncoderAblationAge
 from atari_modules.reward_encoder_agent import RewardEncoderAgent
 from atari_modules.transformer_agent import TransformerAgent
 from atari_modules.transformer_agent2 import TransformerAgent2
-from atari_modules.wrappers import make_goalPacman
+from atari_modules.wrappers import make_goalPacman, make_reset_pool
 import random
 import torch
 
@@ -26,8 +26,23 @@ def get_env_params(env):
 
 
 def launch(args):
+    if (args.phase_timing or args.profile_steps > 0) and args.agent != 'RE':
+        # only the reward encoder training loop is instrumented
+        raise NotImplementedError('--phase-timing and --profile-steps are only supported by the RE agent')
+    if args.replay_type == 'prioritized' and args.agent not in ['RE', 'REA', 'Transformer2']:
+        # the other agents neither weight their loss nor update the priorities
+        raise NotImplementedError('--replay-type prioritized is only supported by the RE, REA and Transformer2 agents')
+    if args.num_workers > 1 and args.agent == 'HerDQN':
+        # HER relabels whole episodes, the vector envs stream single transitions
+        raise NotImplementedError('--num-workers is not supported by the HerDQN agent')
+    if args.agent == 'RE' and args.num_collectors > 0 and (args.replay_type != 'ring' or args.num_workers > 1):
+        # the collectors fill a shared memory ring buffer, each from its own env
+        raise NotImplementedError('--num-collectors only supports --replay-type ring and --num-workers 1')
 
-    env = make_goalPacman()
+    if args.reset_pool is not None:
+        # generated once here, the envs of the agents load it from disk
+        make_reset_pool(args.reset_pool, args.reset_pool_size)
+    env = make_goalPacman(args.reset_pool)
     # set random seeds for reproduce
     env.seed(args.seed)
     random.seed(args.seed)
@@ -50,7 +65,9 @@ def launch(args):
     elif args.agent == 'RE':
         learn = True
         reward_encoding_agent = RewardEncoderAgent(args, env, env_params)
-        if learn:
+        if learn and args.num_collectors > 0:
+            reward_encoding_agent.learn_async()
+        elif learn:
             reward_encoding_agent.learn()
         else:
             dt = '2023-09-28 15:13:41'
@@ -0,0 +1,135 @@
+import copy
+import random
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from atari_modules.encoding_cache import RewardEncodingCache
+from atari_modules.models import TaskAwareCritic, RewardEncoder
+from atari_modules.replay_buffer import SharedReplayBuffer
+from atari_modules.reward_table import RewardTable
+from atari_modules.wrappers import make_goalPacman
+
+"""
+Actor/learner split for the reward encoder agent.
+Collector processes play with a periodically synced copy of the critic and the reward encoder and push their
+transitions into a shared memory replay buffer, while the learner keeps running gradient steps on that buffer.
+
+"""
+
+
+def _collector(rank, args, env_params, buffer, shared_critic, shared_encoder, param_lock, param_version,
+               env_steps, stop_event):
+    seed = args.seed + 1 + rank
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    device = "cuda" if args.cuda else "cpu"
+    env = make_goalPacman(args.reset_pool)
+    env.seed(seed)
+
+    critic_network = TaskAwareCritic(env_params, args.embed_dim).to(device)
+    reward_encoder = RewardEncoder(env_params, args.embed_dim).to(device)
+    uniform_inputs = torch.tensor(env.get_uniform_inputs() / 170, dtype=torch.float32, device=device)
+    # the learner has already written this table to the cache dir, so this is only a load
+    reward_table = RewardTable(env.all_goals, env.get_uniform_inputs(), env_params['action'], args.reward_type,
+                               device=device, cache_dir=args.reward_cache_dir)
+
+    def encode_goals(goals):
+        rewards = reward_table.grid_rewards(goals)
+        return torch.einsum('gna,nea->gea', rewards, reward_encoder(uniform_inputs)) / uniform_inputs.shape[0]
+
+    # the encodings of all goals are only recomputed when new parameters come in
+    encoding_cache = RewardEncodingCache(encode_goals, env.all_goals)
+    version = None
+
+    while not stop_event.is_set():
+        # pick up the latest parameters once per episode
+        if version != param_version.value:
+            with param_lock:
+                critic_network.load_state_dict(shared_critic.state_dict())
+                reward_encoder.load_state_dict(shared_encoder.state_dict())
+                version = param_version.value
+            encoding_cache.invalidate()
+
+        observation = env.reset()
+        obs = observation['observation']
+        ag = observation['achieved_goal']
+        g = observation['desired_goal']
+        reward_encoding = encoding_cache(g)
+
+        for t in range(env_params['max_timesteps']):
+            with torch.no_grad():
+                obs_tensor = torch.tensor(np.array(obs)[None], dtype=torch.float32, device=device) / 255.
+                q = critic_network(obs_tensor.permute(0, 3, 1, 2), reward_encoding)
+                action = torch.distributions.Categorical(logits=q / args.temp).sample().item()
+            observation_new, reward, done, info = env.step(action)
+            obs_new = observation_new['observation']
+            buffer.add(obs, ag, g, action, reward, obs_new, done)
+            with env_steps.get_lock():
+                env_steps.value += 1
+            if done:
+                break
+            obs = obs_new
+            ag = observation_new['achieved_goal']
+    env.close()
+
+
+class ActorLearner:
+    def __init__(self, args, env_params, critic_network, reward_encoder):
+        """
+        Parameters
+        ----------
+        critic_network, reward_encoder: nn.Module
+            the learner's networks, the collectors act with copies of them
+        """
+        self.args = args
+        self.critic_network = critic_network
+        self.reward_encoder = reward_encoder
+        self.ctx = mp.get_context('spawn')
+        self.buffer = SharedReplayBuffer(args.buffer_size, env_params['obs'], (env_params['goal'],), self.ctx)
+
+        # cpu copies in shared memory, the collectors load their parameters from these
+        self.shared_critic = copy.deepcopy(critic_network).cpu().share_memory()
+        self.shared_encoder = copy.deepcopy(reward_encoder).cpu().share_memory()
+        self.param_lock = self.ctx.Lock()
+        self.param_version = self.ctx.Value('l', 0, lock=False)
+        self._env_steps = self.ctx.Value('l', 0)
+        self.stop_event = self.ctx.Event()
+        self.processes = [self.ctx.Process(target=_collector,
+                                           args=(rank, args, env_params, self.buffer, self.shared_critic,
+                                                 self.shared_encoder, self.param_lock, self.param_version,
+                                                 self._env_steps, self.stop_event),
+                                           daemon=True)
+                          for rank in range(args.num_collectors)]
+
+    @property
+    def env_steps(self):
+        return self._env_steps.value
+
+    def start(self):
+        self.sync_params()
+        for process in self.processes:
+            process.start()
+
+    def sync_params(self):
+        # copy the learner's parameters into the shared copies, collectors reload on the next episode
+        with self.param_lock:
+            for shared, source in ((self.shared_critic, self.critic_network), (self.shared_encoder, self.reward_encoder)):
+                for shared_value, value in zip(shared.state_dict().values(), source.state_dict().values()):
+                    shared_value.copy_(value)
+            self.param_version.value += 1
+
+    def wait_for_samples(self, n, poll_interval=1.0):
+        while len(self.buffer) < n:
+            time.sleep(poll_interval)
+
+    def stop(self, timeout=10.0):
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self.buffer.close(unlink=True)
@@ -0,0 +1,107 @@
+import inspect
+import os
+import random
+import shutil
+
+import numpy as np
+import torch
+
+"""
+Checkpoint and resume of the whole training state of an agent.
+Networks, target networks, optimizers, the RNG states and the epoch counters go into a small state.pt,
+the replay buffers are written as one raw .npy array per field, so saving runs at disk bandwidth instead of
+pickling, and loading memory maps the arrays and copies them straight into the preallocated buffers.
+A checkpoint is written next to the old one and swapped in once complete, state.pt being written last,
+so a run killed while saving still has a usable checkpoint.
+
+"""
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_checkpoint(directory, networks, optimizers, buffers, counters):
+    """
+    Parameters
+    ----------
+    networks, optimizers: dict
+        name -> module / optimizer, saved through their state_dict
+    buffers: dict
+        name -> replay buffer with state_dict / load_state_dict, arrays are saved as .npy and the rest in state.pt
+    counters: dict
+        epoch, best reward, ... returned as is by load_checkpoint
+    """
+    tmp_directory = directory + '.tmp'
+    if os.path.exists(tmp_directory):
+        shutil.rmtree(tmp_directory)
+    os.makedirs(tmp_directory)
+
+    buffer_meta = {}
+    for name, buffer in buffers.items():
+        os.makedirs(os.path.join(tmp_directory, name))
+        buffer_meta[name] = {}
+        for key, value in buffer.state_dict().items():
+            if isinstance(value, np.ndarray):
+                np.save(os.path.join(tmp_directory, name, key + '.npy'), value)
+            else:
+                buffer_meta[name][key] = value
+        if hasattr(buffer, 'save_files'):
+            # buffers that already keep part of their transitions on disk put those files next to the arrays
+            buffer.save_files(os.path.join(tmp_directory, name))
+
+    state = {'networks': {name: network.state_dict() for name, network in networks.items()},
+             'optimizers': {name: optim.state_dict() for name, optim in optimizers.items()},
+             'buffers': buffer_meta,
+             'rng': rng_state(),
+             'counters': counters}
+    torch.save(state, os.path.join(tmp_directory, 'state.pt'))
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(tmp_directory, directory)
+
+
+def find_checkpoint(path):
+    # path is either the checkpoint itself or the run directory it was written in
+    for directory in [path, os.path.join(path, 'checkpoint')]:
+        for candidate in [directory, directory + '.tmp']:
+            if os.path.exists(os.path.join(candidate, 'state.pt')):
+                return candidate
+    raise FileNotFoundError('no checkpoint found in {}'.format(path))
+
+
+def load_checkpoint(path, networks, optimizers, buffers):
+    """Restores everything given to save_checkpoint in place and returns its counters.
+    Everything is loaded on cpu, load_state_dict moves it to the device of the networks and optimizers,
+    and the RNG states have to stay cpu tensors."""
+    directory = find_checkpoint(path)
+    # state.pt holds numpy and python objects, weights_only only exists from torch 1.13 on and defaults to True from 2.6
+    load_kwargs = {'weights_only': False} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+    state = torch.load(os.path.join(directory, 'state.pt'), map_location='cpu', **load_kwargs)
+    for name, network in networks.items():
+        network.load_state_dict(state['networks'][name])
+    for name, optim in optimizers.items():
+        optim.load_state_dict(state['optimizers'][name])
+    for name, buffer in buffers.items():
+        buffer_state = dict(state['buffers'][name])
+        buffer_directory = os.path.join(directory, name)
+        for file_name in os.listdir(buffer_directory):
+            if file_name.endswith('.npy'):
+                buffer_state[file_name[:-len('.npy')]] = np.load(os.path.join(buffer_directory, file_name), mmap_mode='r')
+        buffer.load_state_dict(buffer_state)
+        if hasattr(buffer, 'load_files'):
+            buffer.load_files(buffer_directory)
+    set_rng_state(state['rng'])
+    return state['counters']
@@ -3,8 +3,10 @@ import os
 from datetime import datetime
 import numpy as np
 import random
-from atari_modules.replay_buffer import ReplayBuffer
+from atari_modules.replay_buffer import make_replay_buffer
+from atari_modules.vec_env import make_rollout_collector, close_pools, epsilon_greedy
 from atari_modules.models import critic
+from atari_modules.checkpoint import load_checkpoint, save_checkpoint
 import pickle
 import csv
 from atari_modules.wrappers import goal_distance
@@ -31,7 +33,10 @@ class dqn_agent:
         # self.her_module = her_sampler(self.args.replay_strategy, self.args.replay_k, self.env.compute_reward)
         # create the replay buffer
         # self.buffer = her_replay_buffer(self.env_params, self.args.buffer_size, self.her_module.sample_her_transitions)
-        self.buffer = ReplayBuffer(self.args.buffer_size)
+        self.buffer = make_replay_buffer(self.args)
+        # with several workers, samples are collected from a vector env instead
+        self.collector = make_rollout_collector(self.args, self.env_params['max_timesteps'], lambda goals: goals,
+                                                self._act_vec)
         # create the dict for store the model
         if self.args.save_dir is not None:
             if not os.path.exists(self.args.save_dir):
@@ -44,9 +49,11 @@ class dqn_agent:
             with open(self.args.save_dir + "/arguments.pkl", 'wb') as f:
                 pickle.dump(self.args, f)
 
-            with open('{}/score_monitor.csv'.format(self.args.save_dir), "wt") as monitor_file:
-                monitor = csv.writer(monitor_file)
-                monitor.writerow(['epoch', 'eval', 'avg dist'])
+            # a resumed run keeps the scores from before it stopped
+            if self.args.resume is None or not os.path.exists('{}/score_monitor.csv'.format(self.args.save_dir)):
+                with open('{}/score_monitor.csv'.format(self.args.save_dir), "wt") as monitor_file:
+                    monitor = csv.writer(monitor_file)
+                    monitor.writerow(['epoch', 'eval', 'avg dist'])
 
     def learn(self):
         """
@@ -54,51 +61,54 @@ class dqn_agent:
 
         """
         # start to collect samples
-        for epoch in range(self.args.n_epochs):
+        for epoch in range(self._resume(), self.args.n_epochs):
             for _ in range(self.args.n_cycles):
                 # mb_obs, mb_ag, mb_g, mb_actions, mb_dones = [], [], [], [], []
-                for _ in range(self.args.num_rollouts_per_cycle):
-                    # reset the rollouts
-                    # ep_obs, ep_ag, ep_g, ep_actions, ep_dones = [], [], [], [], []
-                    # reset the environment
-                    observation = self.env.reset()
-                    obs = observation['observation']
-                    ag = observation['achieved_goal']
-                    g = observation['desired_goal']
-                    # start to collect samples
-                    for t in range(self.env_params['max_timesteps']):
-                        with torch.no_grad():
-                            obs_tensor = self._preproc_o(obs)
-                            g_tensor = self._preproc_g(g)
-                            action = self.act_e_greedy(obs_tensor, g_tensor, update_eps=0.2)
-                        # feed the actions into the environment
-                        observation_new, reward, done, info = self.env.step(action)
-                        obs_new = observation_new['observation']
-                        ag_new = observation_new['achieved_goal']
-                        # add transition to replay buffer
-                        self.buffer.add(obs, ag, g, action, reward, obs_new, done)
-                        # append rollouts
+                if self.collector is not None:
+                    self.collector.collect(self.buffer, self.args.num_rollouts_per_cycle)
+                else:
+                    for _ in range(self.args.num_rollouts_per_cycle):
+                        # reset the rollouts
+                        # ep_obs, ep_ag, ep_g, ep_actions, ep_dones = [], [], [], [], []
+                        # reset the environment
+                        observation = self.env.reset()
+                        obs = observation['observation']
+                        ag = observation['achieved_goal']
+                        g = observation['desired_goal']
+                        # start to collect samples
+                        for t in range(self.env_params['max_timesteps']):
+                            with torch.no_grad():
+                                obs_tensor = self._preproc_o(obs)
+                                g_tensor = self._preproc_g(g)
+                                action = self.act_e_greedy(obs_tensor, g_tensor, update_eps=0.2)
+                            # feed the actions into the environment
+                            observation_new, reward, done, info = self.env.step(action)
+                            obs_new = observation_new['observation']
+                            ag_new = observation_new['achieved_goal']
+                            # add transition to replay buffer
+                            self.buffer.add(obs, ag, g, action, reward, obs_new, done)
+                            # append rollouts
+                            # ep_obs.append(np.array(obs, dtype=np.uint8))
+                            # ep_ag.append(ag.copy())
+                            # ep_g.append(g.copy())
+                            # ep_actions.append(action)
+                            # ep_dones.append(float(done))
+                            # re-assign the observation
+                            if done:
+                                observation = self.env.reset()
+                                obs = observation['observation']
+                                ag = observation['achieved_goal']
+                                g = observation['desired_goal']
+                            else:
+                                obs = obs_new
+                                ag = ag_new
                         # ep_obs.append(np.array(obs, dtype=np.uint8))
                         # ep_ag.append(ag.copy())
-                        # ep_g.append(g.copy())
-                        # ep_actions.append(action)
-                        # ep_dones.append(float(done))
-                        # re-assign the observation
-                        if done:
-                            observation = self.env.reset()
-                            obs = observation['observation']
-                            ag = observation['achieved_goal']
-                            g = observation['desired_goal']
-                        else:
-                            obs = obs_new
-                            ag = ag_new
-                    # ep_obs.append(np.array(obs, dtype=np.uint8))
-                    # ep_ag.append(ag.copy())
-                    # mb_obs.append(ep_obs)
-                    # mb_ag.append(ep_ag)
-                    # mb_g.append(ep_g)
-                    # mb_actions.append(ep_actions)
-                    # mb_dones.append(ep_dones)
+                        # mb_obs.append(ep_obs)
+                        # mb_ag.append(ep_ag)
+                        # mb_g.append(ep_g)
+                        # mb_actions.append(ep_actions)
+                        # mb_dones.append(ep_dones)
                 # convert them into arrays
                 # mb_obs = np.array(mb_obs, dtype=np.uint8)
                 # mb_ag = np.array(mb_ag)
@@ -120,22 +130,44 @@ class dqn_agent:
                 monitor.writerow([epoch, success_rate, avg_dist])
             torch.save([self.critic_network.state_dict()],
                        os.path.join(self.args.save_dir, 'model.pt'))
+            if self.args.checkpoint_interval > 0 and (epoch + 1) % self.args.checkpoint_interval == 0:
+                save_checkpoint(os.path.join(self.args.save_dir, 'checkpoint'), *self._checkpoint_parts(), {'epoch': epoch})
                 # print('n_transitions_stored: {}'.format(self.buffer.n_transitions_stored))
                 # print('current replay size: {}, percentage: {}'.format(self.buffer.current_size, self.buffer.current_size / self.buffer.size * 100))
                 # torch.save([self.o_norm.mean, self.o_norm.std, self.g_norm.mean, self.g_norm.std,
                 #             self.actor_network.state_dict()], \
                 #            self.model_path + '/model.pt')
 
+        # stop the env worker processes
+        close_pools(self.collector)
+
+    def _checkpoint_parts(self):
+        networks = {'critic': self.critic_network, 'critic_target': self.critic_target_network}
+        return networks, {'critic_optim': self.critic_optim}, {'buffer': self.buffer}
+
+    def _resume(self):
+        # returns the epoch to start from, everything else is restored in place
+        if self.args.resume is None:
+            return 0
+        counters = load_checkpoint(self.args.resume, *self._checkpoint_parts())
+        print('resumed from {} at epoch {}'.format(self.args.resume, counters['epoch'] + 1))
+        return counters['epoch'] + 1
+
     # pre_process the inputs
     def _preproc_o(self, obs):
-        obs = np.transpose(np.array(obs)[None] / 255., [0, 3, 1, 2])
+        obs = np.array(obs)
+        if len(obs.shape) == 3:
+            obs = obs[None] # add batch dim of 1 if needed
+        obs = np.transpose(obs / 255., [0, 3, 1, 2])
         obs_tensor = torch.tensor(obs, dtype=torch.float32)
         if self.args.cuda:
             obs_tensor = obs_tensor.cuda()
         return obs_tensor
 
     def _preproc_g(self, g):
-        g_tensor = torch.tensor(g[None] / 170, dtype=torch.float32)
+        if len(g.shape) == 1:
+            g = g[None] # add batch dim of 1 if needed
+        g_tensor = torch.tensor(g / 170, dtype=torch.float32)
         if self.args.cuda:
             g_tensor = g_tensor.cuda()
         return g_tensor
@@ -148,6 +180,13 @@ class dqn_agent:
     def act_e_greedy(self, obs, g, update_eps=0.2):
         return random.randrange(self.env_params['action']) if random.random() < update_eps else self.act(obs, g).item()
 
+    # Acts in every env of the vector env at once, env i pursues g[i]
+    def act_e_greedy_batch(self, obs, g, update_eps=0.2):
+        return epsilon_greedy(self.act(obs, g), self.env_params['action'], update_eps).cpu().numpy()
+
+    def _act_vec(self, obs, goals):
+        return self.act_e_greedy_batch(self._preproc_o(obs), self._preproc_g(goals), update_eps=0.2)
+
     # soft update
     def _soft_update_target_network(self, target, source):
         for target_param, param in zip(target.parameters(), source.parameters()):
@@ -158,19 +197,13 @@ class dqn_agent:
         # sample the episodes
         transitions = self.buffer.sample(self.args.batch_size)
         # pre-process the observation and goal
-        obs_tensor = torch.tensor(np.transpose(transitions['obs'], [0, 3, 1, 2]) / 255, dtype=torch.float32)
-        obs_next_tensor = torch.tensor(np.transpose(transitions['obs_next'], [0, 3, 1, 2]) / 255, dtype=torch.float32)
-        g_tensor = torch.tensor(transitions['g'] / 170, dtype=torch.float32)
-        dones_tensor = torch.tensor(transitions['done'], dtype=torch.float32).reshape(-1, 1)
-        actions_tensor = torch.tensor(transitions['action'], dtype=torch.long)
-        r_tensor = torch.tensor(transitions['reward'], dtype=torch.float32)
-        if self.args.cuda:
-            obs_tensor = obs_tensor.cuda()
-            obs_next_tensor = obs_next_tensor.cuda()
-            g_tensor = g_tensor.cuda()
-            dones_tensor = dones_tensor.cuda()
-            actions_tensor = actions_tensor.cuda()
-            r_tensor = r_tensor.cuda()
+        device = "cuda" if self.args.cuda else "cpu"
+        obs_tensor = torch.as_tensor(transitions['obs'], device=device).permute(0, 3, 1, 2).to(torch.float32) / 255
+        obs_next_tensor = torch.as_tensor(transitions['obs_next'], device=device).permute(0, 3, 1, 2).to(torch.float32) / 255
+        g_tensor = torch.as_tensor(transitions['g'], device=device).to(torch.float32) / 170
+        dones_tensor = torch.as_tensor(transitions['done'], device=device).to(torch.float32).reshape(-1, 1)
+        actions_tensor = torch.as_tensor(transitions['action'], device=device).to(torch.long)
+        r_tensor = torch.as_tensor(transitions['reward'], device=device).to(torch.float32)
         # calculate the target Q value function
         with torch.no_grad():
             q_next_value = self.critic_target_network(obs_next_tensor, g_tensor).max(1)[0].reshape(-1, 1)
@@ -0,0 +1,71 @@
+import numpy as np
+import torch
+
+"""
+Cache of reward encodings keyed by goal.
+MsPacman only has a fixed set of ~148 goals, so instead of pushing the whole uniform input grid through the
+reward encoder every time a goal needs an encoding, the encodings of all known goals are computed in one
+batched forward and looked up by goal afterwards.
+The cache goes stale whenever the encoder is stepped (see invalidate), and is frozen for good once the
+encoder is done training.
+
+"""
+
+
+class RewardEncodingCache:
+    def __init__(self, encode_fn, goals=None):
+        """
+        Parameters
+        ----------
+        encode_fn: function
+            maps a (number goals x 2) array of goals to their (number goals x E x A) encodings
+        goals: array
+            goals to compute up front, others are added the first time they are requested
+        """
+        self.encode_fn = encode_fn
+        self.goals = np.zeros((0, 2), dtype=np.int64) if goals is None else np.array(goals, dtype=np.int64)
+        self._index = {tuple(goal): i for i, goal in enumerate(self.goals)}
+        self._encodings = None
+        # the encoder version is bumped on every encoder step, the cache is stale if it does not match
+        self.encoder_version = 0
+        self._cached_version = -1
+        self.frozen = False
+
+    def invalidate(self):
+        # call after every optimizer step that changes the encoder, does nothing once frozen
+        if not self.frozen:
+            self.encoder_version += 1
+
+    def freeze(self):
+        # the encoder will not change anymore, so compute everything one last time and keep it
+        self.refresh()
+        self.frozen = True
+
+    def refresh(self):
+        with torch.no_grad():
+            self._encodings = self.encode_fn(self.goals) if len(self.goals) > 0 else None
+        self._cached_version = self.encoder_version
+
+    def _add_goals(self, goals):
+        with torch.no_grad():
+            encodings = self.encode_fn(goals)
+        for goal in goals:
+            self._index[tuple(goal)] = len(self._index)
+        self.goals = np.concatenate([self.goals, goals])
+        self._encodings = encodings if self._encodings is None else torch.cat([self._encodings, encodings])
+
+    def __len__(self):
+        return len(self.goals)
+
+    def __call__(self, goals):
+        """Returns the (number goals x E x A) encodings of goals, a single goal gets a batch dim of 1."""
+        goals = np.array(goals, dtype=np.int64)
+        if len(goals.shape) == 1:
+            goals = goals[None]
+        if self._cached_version != self.encoder_version:
+            self.refresh()
+        new_goals = [goal for goal in np.unique(goals, axis=0) if tuple(goal) not in self._index]
+        if len(new_goals) > 0:
+            self._add_goals(np.stack(new_goals))
+        rows = torch.tensor([self._index[tuple(goal)] for goal in goals], device=self._encodings.device)
+        return self._encodings[rows]
@@ -0,0 +1,134 @@
+import csv
+import os
+
+import numpy as np
+import torch
+
+from atari_modules.reward_table import goal_rewards
+from atari_modules.vec_env import make_vec_goalPacman
+from atari_modules.wrappers import goal_distance
+
+"""
+Batched evaluation for the atari agents.
+Instead of playing the test episodes one after another with batch 1 forwards, a pool of envs plays many goals
+at once and the agent picks the actions of every running env in one forward. Finished envs are refilled with
+the next test episode until all of them are done, and the results are aggregated per goal as well.
+
+"""
+
+
+class BatchedEvaluator:
+    def __init__(self, vec_env, max_timesteps, reward_type='dense', per_goal_path=None, append=False):
+        """
+        Parameters
+        ----------
+        vec_env: SubprocVecGoalEnv
+            the env pool, its size is the number of episodes played at once
+        reward_type: str
+            the reward used for the total reward of an episode, see goal_rewards
+        per_goal_path: str
+            if given, the per goal results of every run are appended to this csv
+        append: bool
+            keep the rows already in per_goal_path, for resumed runs
+        """
+        self.vec_env = vec_env
+        self.max_timesteps = max_timesteps
+        self.reward_type = reward_type
+        self.per_goal_path = per_goal_path
+        self.num_runs = 0
+        if per_goal_path is not None and not (append and os.path.exists(per_goal_path)):
+            with open(per_goal_path, "wt") as monitor_file:
+                monitor = csv.writer(monitor_file)
+                monitor.writerow(['eval', 'goal x', 'goal y', 'episodes', 'avg. reward', 'avg. dist', 'success rate'])
+
+    def _rewards(self, achieved_goals, goals):
+        # reward of achieved_goals[i] under goals[i], same as reward_function(ag)[0, 0, action] in the agents
+        gs = torch.tensor(goals / 170., dtype=torch.float32)
+        ags = torch.tensor(achieved_goals / 170., dtype=torch.float32)
+        return goal_rewards(gs, ags, 1, self.reward_type).diagonal()[0].numpy()
+
+    def run(self, act, n_episodes, goals, record=True, init_episodes=None):
+        """Plays n_episodes test episodes and returns the average reward, distance and success rate,
+        together with the same stats per goal.
+
+        act(obs, goals) gets the stacked observations and desired goals of the running envs and returns their actions.
+        goals are spread evenly over the episodes in a random order, e.g. env.all_goals.
+        record=False keeps the run out of per_goal_path, e.g. for a second evaluation of the same epoch.
+        init_episodes(n), if given, returns one row per new episode, e.g. the policies of an episode, and act then
+        gets the rows of the running envs as a third argument.
+        """
+        goals = np.array(goals)
+        episode_goals = goals[np.concatenate([np.random.permutation(len(goals)) for _ in range(-(-n_episodes // len(goals)))])[:n_episodes]]
+        num_envs = min(self.vec_env.num_envs, n_episodes)
+
+        active = np.arange(num_envs)
+        observation = self.vec_env.reset(active, episode_goals[:num_envs])
+        obs, g = observation['observation'], observation['desired_goal']
+        episode_ids = np.arange(num_envs)
+        next_episode = num_envs
+        t = np.zeros(num_envs, dtype=np.int64)
+        total_reward = np.zeros(num_envs)
+        episode_state = None if init_episodes is None else init_episodes(num_envs)
+        rewards, dists, successes = np.zeros(n_episodes), np.zeros(n_episodes), np.zeros(n_episodes)
+
+        while len(active) > 0:
+            if episode_state is None:
+                actions = act(obs[active], g[active])
+            else:
+                actions = act(obs[active], g[active], episode_state[active])
+            observation, _, dones, infos = self.vec_env.step(actions, active)
+            ag = observation['achieved_goal']
+            success = np.array([info['is_success'] for info in infos], dtype=np.float64)
+            # caught by ghost -1, at goal +1, as in the sequential _eval_agent
+            total_reward[active] += self._rewards(ag, g[active]) - 1.0 * dones + 1.0 * (success > 0)
+            t[active] += 1
+            obs[active] = observation['observation']
+
+            finished = (success > 0) | dones | (t[active] >= self.max_timesteps)
+            done_envs = active[finished]
+            ids = episode_ids[done_envs]
+            rewards[ids] = total_reward[done_envs]
+            dists[ids] = goal_distance(ag[finished], g[done_envs])
+            successes[ids] = success[finished]
+
+            # refill the finished envs with the episodes that are left
+            refill = done_envs[:n_episodes - next_episode]
+            if len(refill) > 0:
+                observation = self.vec_env.reset(refill, episode_goals[next_episode:next_episode + len(refill)])
+                obs[refill] = observation['observation']
+                g[refill] = observation['desired_goal']
+                episode_ids[refill] = np.arange(next_episode, next_episode + len(refill))
+                next_episode += len(refill)
+                t[refill] = 0
+                total_reward[refill] = 0
+                if episode_state is not None:
+                    episode_state[refill] = init_episodes(len(refill))
+            active = np.concatenate([active[~finished], refill])
+
+        per_goal = {}
+        for goal in np.unique(episode_goals, axis=0):
+            mask = (episode_goals == goal).all(axis=1)
+            per_goal[tuple(goal)] = {'episodes': int(mask.sum()),
+                                     'reward': rewards[mask].mean(),
+                                     'dist': dists[mask].mean(),
+                                     'success_rate': successes[mask].mean()}
+        if self.per_goal_path is not None and record:
+            with open(self.per_goal_path, "a") as monitor_file:
+                monitor = csv.writer(monitor_file)
+                for goal, stats in per_goal.items():
+                    monitor.writerow([self.num_runs, goal[0], goal[1], stats['episodes'], stats['reward'], stats['dist'],
+                                      stats['success_rate']])
+            self.num_runs += 1
+        return {'reward': rewards.mean(), 'dist': dists.mean(), 'success_rate': successes.mean(), 'per_goal': per_goal}
+
+    def close(self):
+        self.vec_env.close()
+
+
+def make_evaluator(args, env_params):
+    # None keeps the sequential evaluation of the agents
+    if args.num_eval_envs <= 0:
+        return None
+    per_goal_path = None if args.save_dir is None else '{}/per_goal_monitor.csv'.format(args.save_dir)
+    return BatchedEvaluator(make_vec_goalPacman(args.num_eval_envs, args.seed + 1000, args.reset_pool), env_params['max_timesteps'],
+                            args.reward_type, per_goal_path, append=args.resume is not None)
@@ -5,13 +5,16 @@ import numpy as np
 import random
 import pickle
 import csv
-from atari_modules.replay_buffer import ReplayBuffer
+from atari_modules.replay_buffer import make_replay_buffer
+from atari_modules.vec_env import make_rollout_collector, close_pools, epsilon_greedy
 from atari_modules.models import ForwardMap, BackwardMap
 from atari_modules.wrappers import goal_distance
 from grid_modules.mdp_utils import extract_policy
 from torch.distributions.cauchy import Cauchy
 from torch.utils.tensorboard import SummaryWriter
 from atari_modules.reward_encoder_agent import get_reward_function
+from atari_modules.evaluation import make_evaluator
+from atari_modules.checkpoint import load_checkpoint, save_checkpoint
 
 
 def compute_entropy(policy):
@@ -54,7 +57,10 @@ class FBAgent:
         self.fb_optim = torch.optim.Adam(f_params + b_params, lr=self.args.lr)
         # self.backward_optim = torch.optim.Adam(self.backward_network.parameters(), lr=self.args.lr_backward)
         # create the replay buffer
-        self.buffer = ReplayBuffer(self.args.buffer_size)
+        self.buffer = make_replay_buffer(self.args)
+        # with several workers, samples are collected from a vector env instead
+        self.collector = make_rollout_collector(self.args, self.env_params['max_timesteps'], self._sample_vec_w,
+                                                self._act_vec)
         # create the dict for store the model
         if self.args.save_dir is not None:
             if not os.path.exists(self.args.save_dir):
@@ -67,9 +73,13 @@ class FBAgent:
             with open(self.args.save_dir + "/arguments.pkl", 'wb') as f:
                 pickle.dump(self.args, f)
 
-            with open('{}/score_monitor.csv'.format(self.args.save_dir), "wt") as monitor_file:
-                monitor = csv.writer(monitor_file)
-                monitor.writerow(['epoch', 'eval', 'avg dist', 'eval (GPI)', 'avg dist (GPI)'])
+            # a resumed run keeps the scores from before it stopped
+            if self.args.resume is None or not os.path.exists('{}/score_monitor.csv'.format(self.args.save_dir)):
+                with open('{}/score_monitor.csv'.format(self.args.save_dir), "wt") as monitor_file:
+                    monitor = csv.writer(monitor_file)
+                    monitor.writerow(['epoch', 'eval', 'avg dist', 'eval (GPI)', 'avg dist (GPI)'])
+        # pool of envs that plays the test episodes at once, None evaluates sequentially
+        self.evaluator = make_evaluator(self.args, self.env_params)
         # create logger for losses
         current_datetime = datetime.now()
         date_time_string = current_datetime.strftime("%Y-%m-%d %H:%M:%S")
@@ -84,42 +94,45 @@ class FBAgent:
         """
         # start to collect samples
         # print('MPI SIZE: ', MPI.COMM_WORLD.Get_size())
-        for epoch in range(self.args.n_epochs):
+        for epoch in range(self._resume(), self.args.n_epochs):
             for _ in range(self.args.n_cycles):
-                for _ in range(self.args.num_rollouts_per_cycle):
-                    # reset the rollouts
-                    # reset the environment
-                    observation = self.env.reset()
-                    obs = observation['observation']
-                    ag = observation['achieved_goal']
-                    g = observation['desired_goal']
-                    if self.args.w_sampling == 'goal_oriented':
-                        g_tensor = self._preproc_g(g)
-                        with torch.no_grad():
-                            w = self.backward_network(g_tensor)
-                    elif self.args.w_sampling == 'uniform_ball':
-                        w = self.sample_uniform_ball(1)
-                    elif self.args.w_sampling == 'cauchy_ball':
-                        w = self.sample_cauchy_ball(1)
-                    # start to collect samples
-                    for t in range(self.env_params['max_timesteps']):
-                        with torch.no_grad():
-                            obs_tensor = self._preproc_o(obs)
-                            action = self.act_e_greedy(obs_tensor, w, update_eps=0.2)
-                        # feed the actions into the environment
-                        observation_new, reward, done, info = self.env.step(action)
-                        obs_new = observation_new['observation']
-                        ag_new = observation_new['achieved_goal']
-                        # add transition
-                        self.buffer.add(obs, ag, g, action, reward, obs_new, done)
-                        if done:
-                            observation = self.env.reset()
-                            obs = observation['observation']
-                            ag = observation['achieved_goal']
-                            g = observation['desired_goal']
-                        else:
-                            obs = obs_new
-                            ag = ag_new
+                if self.collector is not None:
+                    self.collector.collect(self.buffer, self.args.num_rollouts_per_cycle)
+                else:
+                    for _ in range(self.args.num_rollouts_per_cycle):
+                        # reset the rollouts
+                        # reset the environment
+                        observation = self.env.reset()
+                        obs = observation['observation']
+                        ag = observation['achieved_goal']
+                        g = observation['desired_goal']
+                        if self.args.w_sampling == 'goal_oriented':
+                            g_tensor = self._preproc_g(g)
+                            with torch.no_grad():
+                                w = self.backward_network(g_tensor)
+                        elif self.args.w_sampling == 'uniform_ball':
+                            w = self.sample_uniform_ball(1)
+                        elif self.args.w_sampling == 'cauchy_ball':
+                            w = self.sample_cauchy_ball(1)
+                        # start to collect samples
+                        for t in range(self.env_params['max_timesteps']):
+                            with torch.no_grad():
+                                obs_tensor = self._preproc_o(obs)
+                                action = self.act_e_greedy(obs_tensor, w, update_eps=0.2)
+                            # feed the actions into the environment
+                            observation_new, reward, done, info = self.env.step(action)
+                            obs_new = observation_new['observation']
+                            ag_new = observation_new['achieved_goal']
+                            # add transition
+                            self.buffer.add(obs, ag, g, action, reward, obs_new, done)
+                            if done:
+                                observation = self.env.reset()
+                                obs = observation['observation']
+                                ag = observation['achieved_goal']
+                                g = observation['desired_goal']
+                            else:
+                                obs = obs_new
+                                ag = ag_new
                 for _ in range(self.args.n_batches):
                     # train the network
                     self._update_network()
@@ -139,6 +152,25 @@ class FBAgent:
                 monitor.writerow([epoch, success_rate, avg_dist, success_rate_gpi, avg_dist_gpi])
             torch.save([self.forward_network.state_dict(), self.backward_network.state_dict()],
                        os.path.join(self.dir, 'model.pt'))
+            if self.args.checkpoint_interval > 0 and (epoch + 1) % self.args.checkpoint_interval == 0:
+                save_checkpoint(os.path.join(self.dir, 'checkpoint'), *self._checkpoint_parts(), {'epoch': epoch, 'update_iteration': self.update_iteration})
+
+        # stop the env worker processes
+        close_pools(self.collector, self.evaluator)
+
+    def _checkpoint_parts(self):
+        networks = {'forward': self.forward_network, 'backward': self.backward_network,
+                    'forward_target': self.forward_target_network, 'backward_target': self.backward_target_network}
+        return networks, {'fb_optim': self.fb_optim}, {'buffer': self.buffer}
+
+    def _resume(self):
+        # returns the epoch to start from, everything else is restored in place
+        if self.args.resume is None:
+            return 0
+        counters = load_checkpoint(self.args.resume, *self._checkpoint_parts())
+        self.update_iteration = counters['update_iteration']
+        print('resumed from {} at epoch {}'.format(self.args.resume, counters['epoch'] + 1))
+        return counters['epoch'] + 1
 
     def sample_uniform_ball(self, n, eps=1e-10):
         gaussian_rdv = torch.FloatTensor(n, self.args.embed_dim).normal_(mean=0, std=1)
@@ -160,14 +192,19 @@ class FBAgent:
 
     # pre_process the inputs
     def _preproc_o(self, obs):
-        obs = np.transpose(np.array(obs)[None] / 255., [0, 3, 1, 2])
+        obs = np.array(obs)
+        if len(obs.shape) == 3:
+            obs = obs[None] # add batch dim of 1 if needed
+        obs = np.transpose(obs / 255., [0, 3, 1, 2])
         obs_tensor = torch.tensor(obs, dtype=torch.float32)
         if self.args.cuda:
             obs_tensor = obs_tensor.cuda()
         return obs_tensor
 
     def _preproc_g(self, g):
-        g_tensor = torch.tensor(g[None] / 170, dtype=torch.float32)
+        if len(g.shape) == 1:
+            g = g[None] # add batch dim of 1 if needed
+        g_tensor = torch.tensor(g / 170, dtype=torch.float32)
         if self.args.cuda:
             g_tensor = g_tensor.cuda()
         return g_tensor
@@ -176,12 +213,25 @@ class FBAgent:
         # import pdb
         # pdb.set_trace()
         num_gpi = w_train.shape[0]
-        obs_repeat = obs.repeat(num_gpi, 1, 1, 1)
-        w_eval_repeat = w_eval.repeat(num_gpi, 1)
-        f = self.forward_network(obs_repeat, w_train)
+        # one conv pass for obs, only the w conditioned head runs for each of the num_gpi policies
+        features = self.forward_network.features(obs)
+        f = self.forward_network.head(features, w_train)
+        w_eval_repeat = w_eval.expand(num_gpi, -1)
         z = torch.einsum('sda, sd -> sa', f, w_eval_repeat).max(0)[0]
         return z.max(0)[1]
 
+    # GPI in every env at once, env i evaluates the policies of w_train (or w_train[i]) with w_eval[i]
+    def act_gpi_batch(self, obs, w_train, w_eval):
+        if len(w_train.shape) == 2:
+            w_train = w_train.unsqueeze(0)
+        num_gpi = w_train.shape[1]
+        features = self.forward_network.features(obs)
+        # (envs x 1) features against (envs x num_gpi) w, the conv part still runs once per env
+        f = self.forward_network.head(features.unsqueeze(1), w_train)
+        f = f.reshape(obs.shape[0], num_gpi, *f.shape[1:])
+        z = torch.einsum('bkda, bd -> bka', f, w_eval).max(1)[0]
+        return z.max(1)[1]
+
     # Acts based on single state (no batch)
     def act(self, obs, w, target_network=False):
         if target_network:
@@ -195,9 +245,50 @@ class FBAgent:
     def act_e_greedy(self, obs, w, update_eps=0.2):
         return random.randrange(self.env_params['action']) if random.random() < update_eps else self.act(obs, w).item()
 
+    # Acts in every env of the vector env at once, env i follows w[i]
+    def act_e_greedy_batch(self, obs, w, update_eps=0.2):
+        return epsilon_greedy(self.act(obs, w), self.env_params['action'], update_eps).cpu().numpy()
+
+    def _act_eval_batch(self, obs, goals):
+        with torch.no_grad():
+            w = self.backward_network(self._preproc_g(goals))
+            return self.act_e_greedy_batch(self._preproc_o(obs), w, update_eps=0.02)
+
+    def _sample_vec_w(self, goals):
+        if self.args.w_sampling == 'goal_oriented':
+            return self.backward_network(self._preproc_g(goals))
+        elif self.args.w_sampling == 'uniform_ball':
+            return self.sample_uniform_ball(len(goals))
+        elif self.args.w_sampling == 'cauchy_ball':
+            return self.sample_cauchy_ball(len(goals))
+        else:
+            raise NotImplementedError()
+
+    def _act_vec(self, obs, w):
+        return self.act_e_greedy_batch(self._preproc_o(obs), w, update_eps=0.2)
+
     def act_gpi_e_greedy(self, obs, w_train, w, update_eps=0.2):
         return random.randrange(self.env_params['action']) if random.random() < update_eps else self.act_gpi(obs, w_train, w).item()
 
+    def _act_gpi_eval_batch(self, obs, goals, w_train):
+        with torch.no_grad():
+            w = self.backward_network(self._preproc_g(goals))
+            actions = self.act_gpi_batch(self._preproc_o(obs), w_train, w)
+            return epsilon_greedy(actions, self.env_params['action'], 0.02).cpu().numpy()
+
+    def _sample_gpi_w(self, num_gpi):
+        if self.args.w_sampling == 'goal_oriented':
+            transitions = self.buffer.sample(self.args.batch_size)
+            g_train = transitions['g']
+            g_train_tensor = torch.as_tensor(g_train, device="cuda" if self.args.cuda else "cpu").to(torch.float32) / 170
+            return self.backward_network(g_train_tensor)
+        elif self.args.w_sampling == 'uniform_ball':
+            return self.sample_uniform_ball(num_gpi)
+        elif self.args.w_sampling == 'cauchy_ball':
+            return self.sample_cauchy_ball(num_gpi)
+        else:
+            raise NotImplementedError()
+
     def get_policy(self, w, obs=None, policy_type='boltzmann', temp=1, eps=0.01, target_network=False):
         if target_network:
             f = self.forward_target_network(obs, w)
@@ -217,21 +308,14 @@ class FBAgent:
         transitions = self.buffer.sample(self.args.batch_size)
         transitions_other = self.buffer.sample(self.args.batch_size)
         # pre-process the observation and goal
-        obs_tensor = torch.tensor(np.transpose(transitions['obs'], [0, 3, 1, 2]) / 255, dtype=torch.float32)
-        obs_next_tensor = torch.tensor(np.transpose(transitions['obs_next'], [0, 3, 1, 2]) / 255, dtype=torch.float32)
-        g_tensor = torch.tensor(transitions['g'] / 170, dtype=torch.float32)
-        ag_tensor = torch.tensor(transitions['ag'] / 170, dtype=torch.float32)
-        ag_other_tensor = torch.tensor(transitions_other['ag'] / 170, dtype=torch.float32)
-        dones_tensor = torch.tensor(transitions['done'], dtype=torch.float32).reshape(-1, 1)
-        actions_tensor = torch.tensor(transitions['action'], dtype=torch.long)
-        if self.args.cuda:
-            obs_tensor = obs_tensor.cuda()
-            obs_next_tensor = obs_next_tensor.cuda()
-            g_tensor = g_tensor.cuda()
-            ag_tensor = ag_tensor.cuda()
-            ag_other_tensor = ag_other_tensor.cuda()
-            dones_tensor = dones_tensor.cuda()
-            actions_tensor = actions_tensor.cuda()
+        device = "cuda" if self.args.cuda else "cpu"
+        obs_tensor = torch.as_tensor(transitions['obs'], device=device).permute(0, 3, 1, 2).to(torch.float32) / 255
+        obs_next_tensor = torch.as_tensor(transitions['obs_next'], device=device).permute(0, 3, 1, 2).to(torch.float32) / 255
+        g_tensor = torch.as_tensor(transitions['g'], device=device).to(torch.float32) / 170
+        ag_tensor = torch.as_tensor(transitions['ag'], device=device).to(torch.float32) / 170
+        ag_other_tensor = torch.as_tensor(transitions_other['ag'], device=device).to(torch.float32) / 170
+        dones_tensor = torch.as_tensor(transitions['done'], device=device).to(torch.float32).reshape(-1, 1)
+        actions_tensor = torch.as_tensor(transitions['action'], device=device).to(torch.long)
 
         if self.args.w_sampling == 'goal_oriented':
             with torch.no_grad():
@@ -303,6 +387,9 @@ class FBAgent:
 
     # do the evaluation
     def _eval_agent(self):
+        if self.evaluator is not None:
+            results = self.evaluator.run(self._act_eval_batch, self.args.n_test_rollouts, self.env.all_goals)
+            return results['success_rate'], results['dist']
         total_success_rate = []
         total_dist = []
         for _ in range(self.args.n_test_rollouts):
@@ -343,23 +430,23 @@ class FBAgent:
         return success_rate, dist
 
     def _eval_gpi_agent(self, num_gpi=20):
+        if self.evaluator is not None:
+            # a new set of GPI policies for every episode, as in the sequential loop below
+            def init_episodes(n):
+                with torch.no_grad():
+                    return torch.stack([self._sample_gpi_w(num_gpi) for _ in range(n)])
+
+            results = self.evaluator.run(self._act_gpi_eval_batch, self.args.n_test_rollouts, self.env.all_goals,
+                                         record=False, init_episodes=init_episodes)
+            return results['success_rate'], results['dist']
         total_success_rate = []
         total_dist = []
         for _ in range(self.args.n_test_rollouts):
             observation = self.env.reset()
             obs = observation['observation']
             g = observation['desired_goal']
-            if self.args.w_sampling == 'goal_oriented':
-                transitions = self.buffer.sample(self.args.batch_size)
-                g_train = transitions['g']
-                g_train_tensor = torch.tensor(g_train / 170, dtype=torch.float32)
-                if self.args.cuda:
-                    g_train_tensor = g_train_tensor.cuda()
-                w_train = self.backward_network(g_train_tensor)
-            elif self.args.w_sampling == 'uniform_ball':
-                w_train = self.sample_uniform_ball(num_gpi)
-            elif self.args.w_sampling == 'cauchy_ball':
-                w_train = self.sample_cauchy_ball(num_gpi)
+            with torch.no_grad():
+                w_train = self._sample_gpi_w(num_gpi)
 
             for _ in range(self.env_params['max_timesteps']):
                 with torch.no_grad():
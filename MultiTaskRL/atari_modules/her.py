@@ -25,13 +25,11 @@ class her_sampler:
         her_indexes = np.where(np.random.uniform(size=batch_size) < self.future_p)
         # import pdb
         # pdb.set_trace()
-        # future_offset = np.random.uniform(size=batch_size) * (T - t_samples)
-        # future_offset = future_offset.astype(int)
-        future_offset = T - t_samples
-        for i in range(batch_size):
-            ends = np.where(episode_batch['done'][episode_idxs[i]][t_samples[i]:])[0]
-            if len(ends) > 0:
-                future_offset[i] = ends[0]
+        # future goals are only taken from before the episode ends, the buffer stores how far away that is
+        if 'steps_to_end' in transitions:
+            future_offset = transitions.pop('steps_to_end')
+        else:
+            future_offset = T - t_samples
         future_offset = (np.random.uniform(size=batch_size) * future_offset).astype(int)
         future_t = (t_samples + 1 + future_offset)[her_indexes]
         # replace go with achieved goal
@@ -13,6 +13,9 @@ import pickle
 import csv
 
 from atari_modules.wrappers import goal_distance
+from atari_modules.evaluation import make_evaluator
+from atari_modules.vec_env import close_pools, epsilon_greedy
+from atari_modules.checkpoint import load_checkpoint, save_checkpoint
 
 
 def get_reward_function(gs, num_actions):
@@ -88,9 +91,13 @@ class HerDQNAgent:
             with open(self.args.save_dir + "/arguments.pkl", 'wb') as f:
                 pickle.dump(self.args, f)
 
-            with open('{}/score_monitor.csv'.format(self.args.save_dir), "wt") as monitor_file:
-                monitor = csv.writer(monitor_file)
-                monitor.writerow(['epoch', 'eval', 'avg dist'])
+            # a resumed run keeps the scores from before it stopped
+            if self.args.resume is None or not os.path.exists('{}/score_monitor.csv'.format(self.args.save_dir)):
+                with open('{}/score_monitor.csv'.format(self.args.save_dir), "wt") as monitor_file:
+                    monitor = csv.writer(monitor_file)
+                    monitor.writerow(['epoch', 'eval', 'avg dist'])
+        # pool of envs that plays the test episodes at once, None evaluates sequentially
+        self.evaluator = make_evaluator(self.args, self.env_params)
 
         # create logger for losses
         current_datetime = datetime.now()
@@ -113,7 +120,7 @@ class HerDQNAgent:
 
         """
         # start to collect samples
-        for epoch in range(self.args.n_epochs):
+        for epoch in range(self._resume(), self.args.n_epochs):
             for _ in range(self.args.n_cycles):
                 mb_obs, mb_ag, mb_g, mb_actions, mb_dones = [], [], [], [], []
                 for _ in range(self.args.num_rollouts_per_cycle):
@@ -188,18 +195,41 @@ class HerDQNAgent:
                 # torch.save([self.o_norm.mean, self.o_norm.std, self.g_norm.mean, self.g_norm.std,
                 #             self.actor_network.state_dict()], \
                 #            self.model_path + '/model.pt')
+            if self.args.checkpoint_interval > 0 and (epoch + 1) % self.args.checkpoint_interval == 0:
+                save_checkpoint(os.path.join(self.dir, 'checkpoint'), *self._checkpoint_parts(), {'epoch': epoch, 'update_iteration': self.update_iteration})
+
+        # stop the env worker processes
+        close_pools(self.evaluator)
+
+
+    def _checkpoint_parts(self):
+        networks = {'critic': self.critic_network, 'critic_target': self.critic_target_network}
+        return networks, {'critic_optim': self.critic_optim}, {'buffer': self.buffer}
 
+    def _resume(self):
+        # returns the epoch to start from, everything else is restored in place
+        if self.args.resume is None:
+            return 0
+        counters = load_checkpoint(self.args.resume, *self._checkpoint_parts())
+        self.update_iteration = counters['update_iteration']
+        print('resumed from {} at epoch {}'.format(self.args.resume, counters['epoch'] + 1))
+        return counters['epoch'] + 1
 
     # pre_process the inputs
     def _preproc_o(self, obs):
-        obs = np.transpose(np.array(obs)[None] / 255., [0, 3, 1, 2])
-        obs_tensor = torch.tensor(obs, dtype=torch.float32)
-        if self.args.cuda:
-            obs_tensor = obs_tensor.cuda()
+        obs = np.array(obs)
+        if len(obs.shape) == 3:
+            obs = obs[None]  # add batch dim of 1 if needed
+        # scaled as float32 on the device, not as a float64 copy
+        obs_tensor = torch.tensor(obs, dtype=torch.float32, device="cuda" if self.args.cuda else "cpu")
+        obs_tensor = obs_tensor.permute(0, 3, 1, 2) / 255.
         return obs_tensor
 
     def _preproc_g(self, g):
-        g_tensor = torch.tensor(g[None] / 170, dtype=torch.float32)
+        g = np.array(g)
+        if len(g.shape) == 1:
+            g = g[None]
+        g_tensor = torch.tensor(g / 170, dtype=torch.float32)
         if self.args.cuda:
             g_tensor = g_tensor.cuda()
         return g_tensor
@@ -213,6 +243,12 @@ class HerDQNAgent:
     def act_e_greedy(self, obs, g, update_eps=0.2):
         return random.randrange(self.env_params['action']) if random.random() < update_eps else self.act(obs, g).item()
 
+    # Acts in every env of the evaluation pool at once, env i pursues g[i]
+    def _act_eval_batch(self, obs, g, update_eps=0.01):
+        with torch.no_grad():
+            actions = self.act(self._preproc_o(obs), self._preproc_g(g))
+            return epsilon_greedy(actions, self.env_params['action'], update_eps).cpu().numpy()
+
     # soft update
     def _soft_update_target_network(self, target, source):
         for target_param, param in zip(target.parameters(), source.parameters()):
@@ -276,6 +312,9 @@ class HerDQNAgent:
 
     # do the evaluation
     def _eval_agent(self):
+        if self.evaluator is not None:
+            results = self.evaluator.run(self._act_eval_batch, self.args.n_test_rollouts, self.env.all_goals)
+            return results['reward'], results['dist'], results['success_rate']
         total_success_rate = []
         total_dist = []
         total_rewards = []
@@ -54,13 +54,21 @@ class ForwardMap(nn.Module):
         self.forward_out = nn.Linear(512, embed_dim * env_params['action'])
 
     def forward(self, obs, w):
-        w = w / torch.sqrt(1 + torch.norm(w, dim=-1, keepdim=True) ** 2 / self.embed_dim)
+        return self.head(self.features(obs), w)
+
+    def features(self, obs):
+        # the conv part only depends on obs, compute it once and reuse it with head for many w
         x = F.relu(self.conv1(obs))
         x = F.relu(self.conv2(x))
         x = F.relu(self.conv3(x))
-        x = x.reshape(-1, 3136)
-        x = torch.cat([x, w], dim=1)
-        x = F.relu(self.fc1(x))
+        return x.reshape(-1, 3136)
+
+    def head(self, features, w):
+        # fc1(cat[features, w]) split into its image and w columns, so a single row of features broadcasts
+        # against a batch of w without repeating it
+        w = w / torch.sqrt(1 + torch.norm(w, dim=-1, keepdim=True) ** 2 / self.embed_dim)
+        x = F.linear(features, self.fc1.weight[:, :3136], self.fc1.bias) + F.linear(w, self.fc1.weight[:, 3136:])
+        x = F.relu(x)
         forward_value = self.forward_out(x)
         return forward_value.reshape(-1, self.embed_dim, self.num_actions)
 
@@ -120,7 +128,7 @@ class TaskAwareCritic(nn.Module):
     #     if (encoding != 0).any():
     #         encoding =  self.embed_dim **0.5  * encoding / (torch.norm(encoding))
     #     return encoding.flatten()
-    def forward(self, obs, encoding):
+    def _norm_encoding(self, encoding):
         norms = torch.linalg.vector_norm(encoding.reshape(encoding.shape[0], -1), dim=1)
         norms = torch.where(norms == 0, torch.ones_like(norms), norms)
         assert norms.shape[0] == encoding.shape[0]
@@ -128,12 +136,22 @@ class TaskAwareCritic(nn.Module):
         assert norm_encoding.shape[0] == encoding.shape[0]
         assert norm_encoding.shape[1] == encoding.shape[1]
         assert norm_encoding.shape[2] == encoding.shape[2]
-        norm_encoding = norm_encoding.reshape(-1, self.embed_dim * self.num_actions)
+        return norm_encoding.reshape(-1, self.embed_dim * self.num_actions)
+
+    def _first_layer(self, image_encoding, norm_encoding):
+        # the first linear layer applied to every (encoding, obs) pair of [image_encoding, norm_encoding]
+        # the weight is split into its image and encoding columns and the two products are broadcast-added,
+        # so the (goals x batch x (3136 + E*A)) concatenation is never built
+        linear = self.nn[0]
+        image_part = F.linear(image_encoding, linear.weight[:, :3136], linear.bias)
+        encoding_part = F.linear(norm_encoding, linear.weight[:, 3136:])
+        return encoding_part.unsqueeze(1) + image_part.unsqueeze(0)
+
+    def forward(self, obs, encoding):
+        norm_encoding = self._norm_encoding(encoding)
         image_encoding = self.image(obs)
         image_encoding = image_encoding.reshape(-1, 3136)
-        norm_encoding = norm_encoding.unsqueeze(1).repeat_interleave(image_encoding.shape[0], dim=1)
-        image_encoding = image_encoding.unsqueeze(0).repeat_interleave(norm_encoding.shape[0], dim=0)
-        values = self.nn(torch.cat([image_encoding, norm_encoding], dim=2))
+        values = self.nn[1:](self._first_layer(image_encoding, norm_encoding))
 
         # scalar value function
         # q_values = values
@@ -143,6 +161,32 @@ class TaskAwareCritic(nn.Module):
         q_values = torch.sum(q_values * encoding.unsqueeze(1).transpose(-1, -2), dim=3)
         return q_values
 
+    def forward_paired(self, obs, encoding):
+        # q values of obs[i] under encoding[i] only, instead of every (encoding, obs) pair
+        # used to act in many envs at once, each with its own reward function
+        assert obs.shape[0] == encoding.shape[0]
+        norm_encoding = self._norm_encoding(encoding)
+        image_encoding = self.image(obs).reshape(-1, 3136)
+        values = self.nn(torch.cat([image_encoding, norm_encoding], dim=1))
+        q_values = values.reshape(values.shape[0], self.num_actions, self.embed_dim)
+        q_values = torch.sum(q_values * encoding.transpose(-1, -2), dim=2)
+        return q_values
+
+
+def broadcast_transformer(transformer, example_encoding, observation_encoding):
+    """Output of transformer for every (observation, set of examples) pair, (num_obs x num_goals x 1 x d_model).
+    Same as repeating the examples for each observation and the observations for each set of examples,
+    but the examples only go through the encoder once per goal, and all observations attend to the same memory:
+    they are laid out as the target sequence of each goal, with a diagonal mask so the self attention of a token
+    only sees itself, which is exactly the self attention of a sequence of length 1."""
+    memory = transformer.encoder(example_encoding)  # num_goals x num_examples x d_model
+    num_obs, num_goals = observation_encoding.shape[0], memory.shape[0]
+    tgt = observation_encoding.reshape(1, num_obs, -1).expand(num_goals, -1, -1)
+    tgt_mask = torch.full((num_obs, num_obs), float('-inf'), device=tgt.device).fill_diagonal_(0.)
+    output_embedding = transformer.decoder(tgt, memory, tgt_mask=tgt_mask)  # num_goals x num_obs x d_model
+    return output_embedding.transpose(0, 1).unsqueeze(2)
+
+
 class TransformerCritic(nn.Module):
 
     def __init__(self, observation_space, state_space, action_space, d_model=64, device="cpu"):
@@ -206,24 +250,47 @@ class TransformerCritic(nn.Module):
         num_goals = example_encoding.shape[0]
 
         if example_encoding.shape[0] != observation_encoding.shape[0]:
-            example_encoding = example_encoding.unsqueeze(0)
-            observation_encoding = observation_encoding.unsqueeze(1)
-            example_encoding = example_encoding.repeat(num_obs, 1, 1, 1)
-            observation_encoding = observation_encoding.repeat(1, num_goals, 1, 1)
-            example_encoding = example_encoding.view(-1, example_encoding.shape[-2], example_encoding.shape[-1])
-            observation_encoding = observation_encoding.view(-1, observation_encoding.shape[-2], observation_encoding.shape[-1])
-
-        # pass through
-        # num_reward_functions = example_encoding.shape[0]
-        # example_encoding = example_encoding.repeat(num_obs, 1, 1) # repeat for each observation
-        # observation_encoding = observation_encoding.repeat(num_reward_functions, 1, 1) # repeat for each example
-        output_embedding = self.transformer(example_encoding, observation_encoding)
+            # every (obs, goal) pair, without repeating the examples for each observation
+            output_embedding = broadcast_transformer(self.transformer, example_encoding, observation_encoding)
+        else:
+            # pass through
+            # num_reward_functions = example_encoding.shape[0]
+            # example_encoding = example_encoding.repeat(num_obs, 1, 1) # repeat for each observation
+            # observation_encoding = observation_encoding.repeat(num_reward_functions, 1, 1) # repeat for each example
+            output_embedding = self.transformer(example_encoding, observation_encoding)
 
         # compute output
         output = self.decoder(output_embedding)
         output = output.reshape(num_obs, num_goals, -1)
         return output
 
+    def forward_paired(self, obs, example_state, example_reward):
+        # q values of obs[i] under the examples of reward function i only, instead of every (examples, obs) pair
+        assert obs.shape[0] == example_state.shape[0], "Need one set of examples per observation"
+        assert example_reward.shape[-1] == self.action_space[0], "Example reward must be a scalar for each action"
+        state_action_reward_example = torch.cat([example_state, example_reward], dim=-1)
+        example_encoding = self.encoder_goal(state_action_reward_example)
+        observation_encoding = self.encoder_observation(obs).unsqueeze(1)
+        output_embedding = self.transformer(example_encoding, observation_encoding)
+        output = self.decoder(output_embedding)
+        return output.reshape(obs.shape[0], -1)
+
+    def encode_examples(self, example_state, example_reward):
+        # output of the transformer encoder for each set of examples
+        # it does not depend on the observation, so it can be computed once and reused with forward_memory
+        state_action_reward_example = torch.cat([example_state, example_reward], dim=-1)
+        example_encoding = self.encoder_goal(state_action_reward_example)
+        return self.transformer.encoder(example_encoding)
+
+    def forward_memory(self, obs, memory):
+        # q values of obs[i] under the encoded examples memory[i], see encode_examples
+        # same as forward_paired, but only runs the observation encoder and the transformer decoder
+        assert obs.shape[0] == memory.shape[0], "Need one encoded set of examples per observation"
+        observation_encoding = self.encoder_observation(obs).unsqueeze(1)
+        output_embedding = self.transformer.decoder(observation_encoding, memory)
+        output = self.decoder(output_embedding)
+        return output.reshape(obs.shape[0], -1)
+
     def get_latent_embedding(self, obs, example_state, example_reward):
         assert len(
             example_state.shape) == 3, "Example state should have dimension 3: (num_reward_functions, num_datapoints, state_dim)"
@@ -308,14 +375,10 @@ class TransformerOracle(nn.Module):
         # example_encoding = example_encoding.repeat(num_obs, 1, 1) # repeat for each observation
         # observation_encoding = observation_encoding.repeat(num_reward_functions, 1, 1) # repeat for each example
         if example_encoding.shape[0] != observation_encoding.shape[0]:
-            example_encoding = example_encoding.unsqueeze(0)
-            observation_encoding = observation_encoding.unsqueeze(1)
-            example_encoding = example_encoding.repeat(num_obs, 1, 1, 1)
-            observation_encoding = observation_encoding.repeat(1, num_goals, 1, 1)
-            example_encoding = example_encoding.view(-1, example_encoding.shape[-2], example_encoding.shape[-1])
-            observation_encoding = observation_encoding.view(-1, observation_encoding.shape[-2], observation_encoding.shape[-1])
-        # ins = torch.cat((observation_encoding, example_encoding), dim=-2)
-        output_embedding = self.transformer(example_encoding, observation_encoding) # [:, -1, :]
+            output_embedding = broadcast_transformer(self.transformer, example_encoding, observation_encoding)
+        else:
+            # ins = torch.cat((observation_encoding, example_encoding), dim=-2)
+            output_embedding = self.transformer(example_encoding, observation_encoding) # [:, -1, :]
         # compute output
         output = self.decoder(output_embedding)
 
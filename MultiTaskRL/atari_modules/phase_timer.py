@@ -0,0 +1,108 @@
+import contextlib
+import csv
+import os
+import time
+from collections import defaultdict
+
+import torch
+
+"""
+Wall time and call counts of the phases of a training loop (env steps, preprocessing, replay sampling,
+encoder, forward/backward, logging), dumped once per epoch to TensorBoard and to a csv.
+When disabled, phase() hands back one shared null context, so the instrumented code only pays a method call.
+torch.profiler traces can be recorded for a chosen range of update steps as well.
+
+"""
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class PhaseTimer:
+    def __init__(self, enabled=False, csv_path=None, logger=None, sync_cuda=False, profile_start=-1, profile_steps=0,
+                 profile_dir=None):
+        """
+        Parameters
+        ----------
+        csv_path: str
+            per epoch breakdown, one row per phase
+        logger: SummaryWriter
+            the breakdown is also written as timing/<phase>_s, timing/<phase>_calls and timing/<phase>_fraction
+        sync_cuda: bool
+            synchronize before reading the clock, otherwise gpu work is counted in whatever phase waits on it
+        profile_start, profile_steps: int
+            record a torch.profiler trace of the update steps [profile_start, profile_start + profile_steps)
+            into profile_dir, works even if the timer itself is disabled
+        """
+        self.enabled = enabled
+        self.csv_path = csv_path
+        self.logger = logger
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.profile_start = profile_start
+        self.profile_end = profile_start + profile_steps
+        self.profile_dir = profile_dir
+        self.profiler = None
+        self.num_steps = 0
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        # the csv header is written by the first dump
+        self.csv_started = False
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync_cuda:
+                torch.cuda.synchronize()
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def step(self):
+        # call once per update step, starts and stops the profiler
+        if self.num_steps == self.profile_start and self.profile_end > self.profile_start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True,
+                                                   on_trace_ready=torch.profiler.tensorboard_trace_handler(self.profile_dir))
+            self.profiler.start()
+        self.num_steps += 1
+        if self.profiler is not None and self.num_steps == self.profile_end:
+            self.profiler.stop()
+            self.profiler = None
+
+    def dump(self, epoch, global_step):
+        """Writes the breakdown of everything timed since the last dump, and starts over."""
+        if not self.enabled:
+            return
+        total = sum(self.seconds.values())
+        rows = [[epoch, name, self.seconds[name], self.calls[name], self.seconds[name] / max(total, 1e-12)]
+                for name in sorted(self.seconds, key=self.seconds.get, reverse=True)]
+        if self.logger is not None:
+            for _, name, seconds, calls, fraction in rows:
+                self.logger.add_scalar('timing/{}_s'.format(name), seconds, global_step)
+                self.logger.add_scalar('timing/{}_calls'.format(name), calls, global_step)
+                self.logger.add_scalar('timing/{}_fraction'.format(name), fraction, global_step)
+        if self.csv_path is not None:
+            with open(self.csv_path, "a" if self.csv_started else "wt") as monitor_file:
+                monitor = csv.writer(monitor_file)
+                if not self.csv_started:
+                    monitor.writerow(['epoch', 'phase', 'seconds', 'calls', 'fraction'])
+                monitor.writerows(rows)
+            self.csv_started = True
+        self.seconds.clear()
+        self.calls.clear()
+
+
+def make_phase_timer(args, logger, log_dir):
+    csv_path = None if args.save_dir is None else os.path.join(args.save_dir, 'timing_monitor.csv')
+    return PhaseTimer(args.phase_timing, csv_path, logger, sync_cuda=args.cuda, profile_start=args.profile_start,
+                      profile_steps=args.profile_steps, profile_dir=os.path.join(log_dir, 'profile'))
@@ -1,6 +1,13 @@
+import collections
+import os
+import queue
+import shutil
+import tempfile
 import threading
+import weakref
+from multiprocessing import shared_memory
 import numpy as np
-import random
+import torch
 
 """
 Slightly different the replay buffer here is basically from the openai baselines code
@@ -10,7 +17,10 @@ in order to include done for atari games and discrete actions
 
 
 class ReplayBuffer(object):
-    """taken from https://github.com/openai/baselines/blob/master/baselines/deepq/replay_buffer.py"""
+    """taken from https://github.com/openai/baselines/blob/master/baselines/deepq/replay_buffer.py
+    rewritten as a preallocated ring of typed numpy arrays so that sampling is a single fancy-index
+    per field instead of a python loop over stored tuples
+    """
 
     def __init__(self, size):
         """Create Replay buffer.
@@ -20,41 +30,65 @@ class ReplayBuffer(object):
             Max number of transitions to store in the buffer. When the buffer
             overflows the old memories are dropped.
         """
-        self._storage = []
-        self._maxsize = size
+        self._maxsize = int(size)
         self._next_idx = 0
+        self._size = 0
+        # the arrays are allocated on the first add, once the observation and goal shapes are known
+        self._storage = None
 
     def __len__(self):
-        return len(self._storage)
+        return self._size
+
+    def _allocate(self, obs, ag, g):
+        self._storage = self._allocate_fields(ag, g)
+        self._storage['obs'] = np.empty([self._maxsize, *obs.shape], dtype=np.uint8)
+        self._storage['obs_next'] = np.empty([self._maxsize, *obs.shape], dtype=np.uint8)
+
+    def _allocate_fields(self, ag, g):
+        # frames are uint8 pixels, goals are pixel coordinates so int16 is plenty
+        return {'ag': np.empty([self._maxsize, *np.shape(ag)], dtype=np.int16),
+                'g': np.empty([self._maxsize, *np.shape(g)], dtype=np.int16),
+                'action': np.empty([self._maxsize], dtype=np.int64),
+                'reward': np.empty([self._maxsize], dtype=np.float32),
+                'done': np.empty([self._maxsize], dtype=np.float32)}
 
     def add(self, obs, ag, g, action, reward, obs_next, done):
-        data = (obs, ag, g, action, reward, obs_next, done)
+        # forces the LazyFrames into a single (84, 84, 4) array
+        obs = np.asarray(obs, dtype=np.uint8)
+        if self._storage is None:
+            self._allocate(obs, ag, g)
 
-        if self._next_idx >= len(self._storage):
-            self._storage.append(data)
-        else:
-            self._storage[self._next_idx] = data
+        idx = self._next_idx
+        self._storage['obs'][idx] = obs
+        self._storage['ag'][idx] = ag
+        self._storage['g'][idx] = g
+        self._storage['action'][idx] = action
+        self._storage['reward'][idx] = reward
+        self._storage['obs_next'][idx] = np.asarray(obs_next, dtype=np.uint8)
+        self._storage['done'][idx] = done
         self._next_idx = (self._next_idx + 1) % self._maxsize
+        self._size = min(self._size + 1, self._maxsize)
+
+    def add_batch(self, obs, ag, g, action, reward, obs_next, done):
+        """Adds one transition per env, e.g. a step of a vectorized env."""
+        obs = np.asarray(obs, dtype=np.uint8)
+        if self._storage is None:
+            self._allocate(obs[0], ag[0], g[0])
+
+        idxes = (self._next_idx + np.arange(obs.shape[0])) % self._maxsize
+        self._storage['obs'][idxes] = obs
+        self._storage['ag'][idxes] = ag
+        self._storage['g'][idxes] = g
+        self._storage['action'][idxes] = action
+        self._storage['reward'][idxes] = reward
+        self._storage['obs_next'][idxes] = np.asarray(obs_next, dtype=np.uint8)
+        self._storage['done'][idxes] = done
+        self._next_idx = (self._next_idx + obs.shape[0]) % self._maxsize
+        self._size = min(self._size + obs.shape[0], self._maxsize)
 
     def _encode_sample(self, idxes):
-        obses, ags, gs, actions, rewards, obses_next, dones = [], [], [], [], [], [], []
-        for i in idxes:
-            data = self._storage[i]
-            obs, ag, g, action, reward, obs_next, done = data
-            obses.append(np.array(obs, copy=False))
-            ags.append(ag.copy())
-            gs.append(g.copy())
-            actions.append(np.array(action, copy=False))
-            rewards.append(reward)
-            obses_next.append(np.array(obs_next, copy=False))
-            dones.append(done)
-        transitions = {'obs': np.array(obses),
-                       'ag': np.array(ags),
-                       'g': np.array(gs),
-                       'action': np.array(actions),
-                       'reward': np.array(rewards),
-                       'obs_next': np.array(obses_next),
-                       'done': np.array(dones)}
+        # fancy indexing returns copies, so the batch does not alias the storage
+        transitions = {key: value[idxes] for key, value in self._storage.items()}
         return transitions
 
     def sample(self, batch_size):
@@ -77,9 +111,784 @@ class ReplayBuffer(object):
             done_mask[i] = 1 if executing act_batch[i] resulted in
             the end of an episode and 0 otherwise.
         """
-        idxes = [random.randint(0, len(self._storage) - 1) for _ in range(batch_size)]
+        idxes = np.random.randint(0, self._size, batch_size)
+        return self._encode_sample(idxes)
+
+    def state_dict(self):
+        # the ring is filled from 0, so only the first _size slots hold transitions
+        state = {'_next_idx': self._next_idx, '_size': self._size}
+        if self._storage is not None:
+            state.update({key: value[:self._size] for key, value in self._storage.items()})
+        return state
+
+    def load_state_dict(self, state):
+        # the arrays may be memory mapped, they are copied into the (preallocated) storage
+        if 'obs' in state and self._storage is None:
+            self._storage = {key: np.empty([self._maxsize, *state[key].shape[1:]], dtype=state[key].dtype)
+                             for key in ['obs', 'ag', 'g', 'action', 'reward', 'obs_next', 'done']}
+        if self._storage is not None:
+            for key, value in self._storage.items():
+                value[:state['_size']] = state[key]
+        self._next_idx = state['_next_idx']
+        self._size = state['_size']
+
+
+class FrameStoreReplayBuffer(ReplayBuffer):
+    """Replay buffer that writes every raw frame only once.
+
+    A stacked observation shares its frames with the previous obs_next and with its own obs_next, so instead of
+    storing both stacks, each transition keeps the indices of its frames in a shared frame ring and the stacks are
+    rebuilt with a gather at sample time. Each transition owns its own index tuple, so a stack never mixes frames
+    of two episodes (the reset stack simply points k times at the reset frame).
+    Frame indices are absolute counters: a transition is dropped as soon as any of its frames may have been
+    overwritten, so sampling only ever sees complete stacks.
+    """
+
+    def __init__(self, size, frame_stack=4, frames_per_transition=3, max_reuse_lag=256):
+        """
+        Parameters
+        ----------
+        size: int
+            Max number of transitions to store in the buffer.
+        frame_stack: int
+            Number of frames in a stacked observation.
+        frames_per_transition: float
+            Expected number of new frames written per transition, used to size the frame ring. FrameStack.step
+            pushes 3 frames per agent step, plus one frame at every reset.
+        max_reuse_lag: int
+            A frame is only shared with a later transition if it was written at most this many frames ago,
+            which bounds how long a transition can pin old frames.
+        """
+        super(FrameStoreReplayBuffer, self).__init__(size)
+        self._frame_stack = frame_stack
+        self._max_reuse_lag = max_reuse_lag
+        self._frame_capacity = max(int(size * frames_per_transition), 2 * (max_reuse_lag + 2 * frame_stack))
+        self._frames = None
+        self._num_added = 0
+        self._num_frames = 0
+        self._first = 0
+        # (absolute frame indices, frames) of the previous obs_next, for every stream of transitions
+        self._last_frames = {}
+
+    def __len__(self):
+        return self._num_added - self._first
+
+    def _allocate(self, obs, ag, g):
+        self._storage = self._allocate_fields(ag, g)
+        frame_shape = obs.shape[:-1] + (obs.shape[-1] // self._frame_stack,)
+        self._frames = np.empty([self._frame_capacity, *frame_shape], dtype=np.uint8)
+        self._obs_idx = np.empty([self._maxsize, self._frame_stack], dtype=np.int64)
+        self._obs_next_idx = np.empty([self._maxsize, self._frame_stack], dtype=np.int64)
+        self._inserted_at = np.empty([self._maxsize], dtype=np.int64)
+
+    def _store_frames(self, stack, candidates=None):
+        # reuse a frame if it is identical to one of the candidates (indices, frames) or to an earlier frame of
+        # the stack, otherwise write it to the ring. All the frames are compared in one op per side
+        frames = np.stack(np.split(stack, self._frame_stack, axis=-1))
+        flat = frames.reshape(self._frame_stack, -1)
+        frame_idx = np.full([self._frame_stack], -1, dtype=np.int64)
+        if candidates is not None:
+            candidate_idx, candidate_frames = candidates
+            matches = (flat[:, None] == candidate_frames.reshape(1, len(candidate_idx), -1)).all(-1)
+            matches &= candidate_idx >= self._num_frames - self._max_reuse_lag
+            found = matches.any(1)
+            frame_idx[found] = candidate_idx[matches.argmax(1)[found]]
+        # e.g. the k copies of the reset frame are only written once
+        first_equal = (flat[:, None] == flat[None]).all(-1).argmax(1)
+        for i in np.nonzero(frame_idx < 0)[0]:
+            if first_equal[i] < i:
+                frame_idx[i] = frame_idx[first_equal[i]]
+            else:
+                frame_idx[i] = self._num_frames
+                self._frames[self._num_frames % self._frame_capacity] = frames[i]
+                self._num_frames += 1
+        return frame_idx, (frame_idx, frames)
+
+    def add(self, obs, ag, g, action, reward, obs_next, done, stream=0):
+        """stream identifies the env the transition comes from, frames are only shared within a stream."""
+        obs = np.asarray(obs, dtype=np.uint8)
+        obs_next = np.asarray(obs_next, dtype=np.uint8)
+        if self._storage is None:
+            self._allocate(obs, ag, g)
+
+        # obs is usually the previous obs_next, and obs_next shares its oldest frames with obs
+        obs_idx, obs_frames = self._store_frames(obs, self._last_frames.get(stream))
+        obs_next_idx, self._last_frames[stream] = self._store_frames(obs_next, obs_frames)
+
+        idx = self._num_added % self._maxsize
+        self._obs_idx[idx] = obs_idx
+        self._obs_next_idx[idx] = obs_next_idx
+        self._inserted_at[idx] = self._num_frames
+        self._storage['ag'][idx] = ag
+        self._storage['g'][idx] = g
+        self._storage['action'][idx] = action
+        self._storage['reward'][idx] = reward
+        self._storage['done'][idx] = done
+        self._num_added += 1
+
+        # drop transitions whose slot was reused or whose frames may have been overwritten. Every frame of a
+        # transition is at most max_reuse_lag + 2 * frame_stack older than its insertion counter
+        self._first = max(self._first, self._num_added - self._maxsize)
+        oldest_valid = self._num_frames - self._frame_capacity + self._max_reuse_lag + 2 * self._frame_stack
+        while self._inserted_at[self._first % self._maxsize] < oldest_valid:
+            self._first += 1
+
+    def add_batch(self, obs, ag, g, action, reward, obs_next, done):
+        for i in range(len(obs)):
+            self.add(obs[i], ag[i], g[i], action[i], reward[i], obs_next[i], done[i], stream=i)
+
+    def _gather_stack(self, frame_idx):
+        # (batch, k, h, w, c) -> (batch, h, w, k * c), the same layout as LazyFrames
+        frames = self._frames[frame_idx % self._frame_capacity]
+        frames = np.moveaxis(frames, 1, -2)
+        return frames.reshape(*frames.shape[:-2], -1)
+
+    def _encode_sample(self, idxes):
+        transitions = super(FrameStoreReplayBuffer, self)._encode_sample(idxes)
+        transitions['obs'] = self._gather_stack(self._obs_idx[idxes])
+        transitions['obs_next'] = self._gather_stack(self._obs_next_idx[idxes])
+        return transitions
+
+    def sample(self, batch_size):
+        idxes = np.random.randint(self._first, self._num_added, batch_size) % self._maxsize
+        return self._encode_sample(idxes)
+
+    def state_dict(self):
+        state = {'_num_added': self._num_added, '_num_frames': self._num_frames, '_first': self._first}
+        if self._storage is not None:
+            state.update(self._storage)
+            state.update({'_frames': self._frames, '_obs_idx': self._obs_idx, '_obs_next_idx': self._obs_next_idx,
+                          '_inserted_at': self._inserted_at})
+        return state
+
+    def load_state_dict(self, state):
+        if '_frames' in state:
+            self._storage = {key: np.array(state[key]) for key in ['ag', 'g', 'action', 'reward', 'done']}
+            self._frames = np.array(state['_frames'])
+            self._obs_idx = np.array(state['_obs_idx'])
+            self._obs_next_idx = np.array(state['_obs_next_idx'])
+            self._inserted_at = np.array(state['_inserted_at'])
+        self._num_added = state['_num_added']
+        self._num_frames = state['_num_frames']
+        self._first = state['_first']
+        # the next transitions start new streams, they simply do not share frames with the stored ones
+        self._last_frames = {}
+
+
+class SharedReplayBuffer(ReplayBuffer):
+    """Ring buffer in shared memory, written by collector processes and sampled by the learner.
+    The arrays live in named shared memory segments and are attached again when the buffer is sent to a
+    (spawned) process, so the shapes have to be known up front. All reads and writes hold a process lock,
+    so the learner never samples a half written transition.
+    """
+
+    def __init__(self, size, obs_shape, goal_shape, ctx):
+        # the counters have to exist before the base class assigns them
+        self._shared_next_idx = ctx.Value('l', 0, lock=False)
+        self._shared_size = ctx.Value('l', 0, lock=False)
+        self._lock = ctx.Lock()
+        super(SharedReplayBuffer, self).__init__(size)
+        self._specs = {'obs': ([self._maxsize, *obs_shape], np.uint8),
+                       'ag': ([self._maxsize, *goal_shape], np.int16),
+                       'g': ([self._maxsize, *goal_shape], np.int16),
+                       'action': ([self._maxsize], np.int64),
+                       'reward': ([self._maxsize], np.float32),
+                       'obs_next': ([self._maxsize, *obs_shape], np.uint8),
+                       'done': ([self._maxsize], np.float32)}
+        self._shm = {key: shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+                     for key, (shape, dtype) in self._specs.items()}
+        self._attach()
+
+    def _attach(self):
+        self._storage = {key: np.ndarray(shape, dtype=dtype, buffer=self._shm[key].buf)
+                         for key, (shape, dtype) in self._specs.items()}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_storage'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    @property
+    def _next_idx(self):
+        return self._shared_next_idx.value
+
+    @_next_idx.setter
+    def _next_idx(self, value):
+        self._shared_next_idx.value = value
+
+    @property
+    def _size(self):
+        return self._shared_size.value
+
+    @_size.setter
+    def _size(self, value):
+        self._shared_size.value = value
+
+    def add(self, obs, ag, g, action, reward, obs_next, done):
+        with self._lock:
+            super(SharedReplayBuffer, self).add(obs, ag, g, action, reward, obs_next, done)
+
+    def add_batch(self, obs, ag, g, action, reward, obs_next, done):
+        with self._lock:
+            super(SharedReplayBuffer, self).add_batch(obs, ag, g, action, reward, obs_next, done)
+
+    def sample(self, batch_size):
+        with self._lock:
+            return super(SharedReplayBuffer, self).sample(batch_size)
+
+    def state_dict(self):
+        # the counters are consistent, but the arrays are views that the collectors keep writing to while they are
+        # saved. Copying a full buffer would double its memory, and at worst the few slots written during the
+        # save hold a newer transition than the counters say
+        with self._lock:
+            return super(SharedReplayBuffer, self).state_dict()
+
+    def load_state_dict(self, state):
+        with self._lock:
+            super(SharedReplayBuffer, self).load_state_dict(state)
+
+    def close(self, unlink=False):
+        # only the process that created the buffer should unlink it
+        self._storage = None
+        for shm in self._shm.values():
+            shm.close()
+            if unlink:
+                shm.unlink()
+
+
+class TieredReplayBuffer(ReplayBuffer):
+    """Replay buffer with a hot in-memory ring for the recent transitions and an older cold segment on disk.
+    When the ring wraps around, every chunk of transitions that is about to be overwritten is first copied out
+    and written to a chunk file (raw .npy arrays, or a compressed .npz) by a background thread, and the oldest
+    chunks are deleted once the cold segment is full, so RAM only holds hot_size transitions and the cold rows
+    of the next minibatch.
+    Every index of a minibatch is hot or cold in proportion to the tier sizes. The cold rows of the next
+    minibatch are drawn while the current one is sampled, uniformly over every cold chunk, and a reader thread
+    gathers exactly those rows from the memory mapped chunk files in the meantime, so sampling is uniform over
+    both tiers and only waits on the disk when the updates outrun the reads.
+    A compressed chunk can only be read whole, so with compress the cold rows are drawn from resident_chunks
+    chunks held in memory instead, and the reader replaces one of them by a random chunk from disk every
+    swap_interval samples. That is an approximation: a newly spilled chunk starts out resident, so the recent
+    part of the cold segment is sampled more often than the rest.
+    state_dict holds the hot ring and the bookkeeping of the cold segment, the chunk files themselves are
+    hard linked (copied across file systems) into the checkpoint by save_files.
+    The background threads draw from the buffer's own generator, so they do not touch the global numpy RNG.
+    """
+
+    def __init__(self, size, hot_size, chunk_size=10000, cold_dir=None, compress=False, resident_chunks=4,
+                 swap_interval=50, seed=None):
+        """
+        Parameters
+        ----------
+        size: int
+            Max number of transitions over both tiers.
+        hot_size: int
+            Transitions kept in the in-memory ring, a multiple of chunk_size.
+        cold_dir: str
+            Where the chunk files of this buffer go (in a fresh subdirectory, removed with the buffer).
+        compress: bool
+            Write compressed .npz chunks, sampled through the resident chunks.
+        resident_chunks: int
+            Number of compressed cold chunks held in memory to sample from.
+        swap_interval: int
+            A resident compressed chunk is replaced by one from disk every swap_interval samples.
+        seed: int
+            Seed of the generator drawing the cold rows and the resident chunks.
+        """
+        super(TieredReplayBuffer, self).__init__(hot_size)
+        self._chunk_size = int(chunk_size)
+        assert self._maxsize % self._chunk_size == 0, "hot_size has to be a multiple of chunk_size"
+        self._max_cold_chunks = max(int(size) - self._maxsize, 0) // self._chunk_size
+        self._compress = compress
+        self._resident_chunks = resident_chunks
+        self._swap_interval = swap_interval
+        if cold_dir is not None:
+            os.makedirs(cold_dir, exist_ok=True)
+        self._cold_dir = tempfile.mkdtemp(prefix='replay_cold_', dir=cold_dir)
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self._cold_dir, True)
+
+        # absolute number of written transitions, and until when the last spilled slots still hold stale copies
+        self._num_written = 0
+        self._spilled_until = 0
+        self._next_chunk_id = 0
+        self._cold_chunks = collections.deque()  # chunk ids, oldest first
+        self._on_disk = set()
+        self._unwritten = {}  # chunk id -> arrays, spilled but not on disk yet
+        self._resident = {}  # chunk id -> arrays, only with compress
+        self._mmaps = {}  # chunk id -> memory mapped arrays, only touched by the reader
+        self._next_cold = None  # cold rows of the next minibatch, see _plan_cold
+        self._samples_since_swap = 0
+        self._rng = np.random.default_rng(seed)
+        self._cold_lock = threading.Lock()
+        self._jobs = queue.Queue()
+        self._reads = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+        self._reader = threading.Thread(target=self._read_worker, daemon=True)
+        self._reader.start()
+
+    def _pending(self):
+        # spilled slots that were not overwritten yet, they are already sampled as part of the cold segment
+        return max(self._spilled_until - self._num_written, 0)
+
+    def __len__(self):
+        return self._size - self._pending() + len(self._cold_chunks) * self._chunk_size
+
+    def _chunk_path(self, chunk_id):
+        return os.path.join(self._cold_dir, 'chunk_{}'.format(chunk_id))
+
+    def _spill(self, n):
+        # the next n slots are about to be written, move the chunks starting there to the cold segment
+        if self._storage is None or self._max_cold_chunks == 0:
+            return
+        offsets = np.arange(n)
+        starts = offsets[((self._next_idx + offsets) % self._chunk_size == 0) & (self._size + offsets >= self._maxsize)]
+        for offset in starts:
+            start = (self._next_idx + offset) % self._maxsize
+            chunk = {key: value[start:start + self._chunk_size].copy() for key, value in self._storage.items()}
+            self._spilled_until = self._num_written + offset + self._chunk_size
+            with self._cold_lock:
+                chunk_id = self._next_chunk_id
+                self._next_chunk_id += 1
+                self._cold_chunks.append(chunk_id)
+                self._unwritten[chunk_id] = chunk
+                if self._compress:
+                    # the chunk is in memory right now anyway, so it starts out resident
+                    self._make_resident(chunk_id, chunk)
+                if len(self._cold_chunks) > self._max_cold_chunks:
+                    oldest = self._cold_chunks.popleft()
+                    self._resident.pop(oldest, None)
+                    self._jobs.put(('delete', oldest, None))
+            self._jobs.put(('write', chunk_id, chunk))
+
+    def _make_resident(self, chunk_id, chunk):
+        # called with the cold lock held
+        if len(self._resident) >= self._resident_chunks:
+            del self._resident[list(self._resident)[self._rng.integers(len(self._resident))]]
+        self._resident[chunk_id] = chunk
+
+    def _write_chunk(self, chunk_id, chunk):
+        path = self._chunk_path(chunk_id)
+        if self._compress:
+            np.savez_compressed(path + '.npz', **chunk)
+        else:
+            os.makedirs(path)
+            for key, value in chunk.items():
+                np.save(os.path.join(path, key + '.npy'), value)
+
+    def _read_chunk(self, chunk_id):
+        # a whole compressed chunk
+        with np.load(self._chunk_path(chunk_id) + '.npz') as chunk:
+            return {key: chunk[key] for key in chunk.files}
+
+    def _worker(self):
+        # writes and deletes the chunk files
+        while True:
+            job, chunk_id, chunk = self._jobs.get()
+            if job == 'stop':
+                return
+            elif job == 'flush':
+                # everything queued before was processed
+                chunk.set()
+            elif job == 'write':
+                self._write_chunk(chunk_id, chunk)
+                with self._cold_lock:
+                    self._unwritten.pop(chunk_id, None)
+                    if chunk_id in self._cold_chunks:
+                        self._on_disk.add(chunk_id)
+                    else:  # deleted while it was being written
+                        self._jobs.put(('delete', chunk_id, None))
+            elif job == 'delete':
+                with self._cold_lock:
+                    written = chunk_id in self._on_disk
+                    self._on_disk.discard(chunk_id)
+                if written and self._compress:
+                    os.remove(self._chunk_path(chunk_id) + '.npz')
+                elif written:
+                    shutil.rmtree(self._chunk_path(chunk_id))
+
+    def _read_worker(self):
+        # gathers the planned cold rows, and with compress keeps swapping chunks into the resident set
+        while True:
+            try:
+                job, plan = self._reads.get(timeout=0.05)
+            except queue.Empty:
+                job = None
+            if job == 'stop':
+                return
+            elif job == 'gather':
+                plan['data'], plan['valid'] = self._gather_rows(plan['chunk_ids'], plan['rows'])
+                plan['ready'].set()
+            elif self._compress and self._samples_since_swap >= self._swap_interval:
+                # prefetch a chunk that is not resident yet
+                with self._cold_lock:
+                    candidates = [chunk_id for chunk_id in self._on_disk if chunk_id not in self._resident]
+                if len(candidates) == 0:
+                    continue
+                chunk_id = candidates[self._rng.integers(len(candidates))]
+                chunk = self._read_chunk(chunk_id)
+                with self._cold_lock:
+                    if chunk_id in self._on_disk:
+                        self._make_resident(chunk_id, chunk)
+                    self._samples_since_swap = 0
+
+    def _open_chunk(self, chunk_id):
+        # memory mapped, indexing a few rows only reads their pages
+        if chunk_id not in self._mmaps:
+            path = self._chunk_path(chunk_id)
+            self._mmaps[chunk_id] = {key[:-len('.npy')]: np.load(os.path.join(path, key), mmap_mode='r')
+                                     for key in os.listdir(path)}
+        return self._mmaps[chunk_id]
+
+    def _gather_rows(self, chunk_ids, rows):
+        # rows of chunks deleted since they were planned are marked invalid
+        with self._cold_lock:
+            for chunk_id in [chunk_id for chunk_id in self._mmaps if chunk_id not in self._on_disk]:
+                del self._mmaps[chunk_id]
+            chunks = {}
+            for chunk_id in np.unique(chunk_ids).tolist():
+                if chunk_id in self._unwritten or chunk_id in self._resident:
+                    chunks[chunk_id] = self._unwritten.get(chunk_id, self._resident.get(chunk_id))
+                elif chunk_id in self._on_disk and not self._compress:
+                    chunks[chunk_id] = None
+        data = None
+        valid = np.isin(chunk_ids, list(chunks))
+        for chunk_id, chunk in chunks.items():
+            if chunk is None:
+                chunk = self._open_chunk(chunk_id)
+            mask = chunk_ids == chunk_id
+            if data is None:
+                data = {key: np.empty([len(rows), *value.shape[1:]], dtype=value.dtype) for key, value in chunk.items()}
+            for key, value in chunk.items():
+                data[key][mask] = value[rows[mask]]
+        return data, valid
+
+    def _plan_cold(self, batch_size):
+        # called with the cold lock held: draws the cold rows of a minibatch, the reader gathers them meanwhile
+        candidates = list(self._resident) if self._compress else list(self._cold_chunks)
+        if len(candidates) == 0:
+            return None
+        plan = {'chunk_ids': np.asarray(candidates)[self._rng.integers(len(candidates), size=batch_size)],
+                'rows': self._rng.integers(self._chunk_size, size=batch_size), 'ready': threading.Event()}
+        self._reads.put(('gather', plan))
+        return plan
+
+    def add(self, obs, ag, g, action, reward, obs_next, done):
+        self._spill(1)
+        super(TieredReplayBuffer, self).add(obs, ag, g, action, reward, obs_next, done)
+        self._num_written += 1
+
+    def add_batch(self, obs, ag, g, action, reward, obs_next, done):
+        self._spill(len(obs))
+        super(TieredReplayBuffer, self).add_batch(obs, ag, g, action, reward, obs_next, done)
+        self._num_written += len(obs)
+
+    def sample(self, batch_size):
+        with self._cold_lock:
+            plan = self._next_cold
+            if plan is None or len(plan['rows']) < batch_size:
+                # first sample, or a larger batch than planned
+                plan = self._plan_cold(batch_size)
+            self._next_cold = self._plan_cold(batch_size)
+            num_cold = len(self._cold_chunks) * self._chunk_size if plan is not None else 0
+        pending = self._pending()
+        num_hot = self._size - pending
+        idxes = np.random.randint(0, num_cold + num_hot, batch_size)
+        is_cold = idxes < num_cold
+
+        rows = None
+        if is_cold.any():
+            plan['ready'].wait()
+            valid = np.nonzero(plan['valid'])[0]
+            if len(valid) > 0:
+                # draws of chunks that were deleted since the plan are replaced by other planned draws
+                rows = valid[:is_cold.sum()]
+                rows = np.concatenate([rows, np.random.choice(valid, is_cold.sum() - len(rows))])
+        if rows is None:
+            is_cold[:] = False
+            idxes = np.random.randint(0, num_hot, batch_size) + num_cold
+
+        # the valid hot slots start right after the stale spilled ones
+        hot_start = (self._next_idx + pending) % self._maxsize if self._size == self._maxsize else 0
+        parts = [self._encode_sample((hot_start + idxes[~is_cold] - num_cold) % self._maxsize)]
+        if rows is not None:
+            parts.append({key: value[rows] for key, value in plan['data'].items()})
+        self._samples_since_swap += 1
+        return {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+
+    def _flush(self):
+        # waits until the chunks spilled so far are on disk
+        done = threading.Event()
+        self._jobs.put(('flush', None, done))
+        done.wait()
+
+    def state_dict(self):
+        self._flush()
+        state = super(TieredReplayBuffer, self).state_dict()
+        with self._cold_lock:
+            state.update({'_num_written': self._num_written, '_spilled_until': self._spilled_until,
+                          '_next_chunk_id': self._next_chunk_id, '_cold_chunks': list(self._cold_chunks),
+                          '_compress': self._compress, '_rng': self._rng.bit_generator.state})
+        return state
+
+    def load_state_dict(self, state):
+        # the chunk files are only there once load_files linked them in
+        assert state['_compress'] == self._compress, "the checkpoint was written with another --cold-compress"
+        super(TieredReplayBuffer, self).load_state_dict(state)
+        self._flush()
+        with self._cold_lock:
+            self._num_written = state['_num_written']
+            self._spilled_until = state['_spilled_until']
+            self._next_chunk_id = state['_next_chunk_id']
+            self._cold_chunks = collections.deque(state['_cold_chunks'])
+            self._on_disk = set()
+            self._unwritten = {}
+            self._resident = {}
+            self._next_cold = None
+            self._rng.bit_generator.state = state['_rng']
+
+    def _chunk_name(self, chunk_id):
+        return os.path.basename(self._chunk_path(chunk_id)) + ('.npz' if self._compress else '')
+
+    def save_files(self, directory):
+        """Links the chunk files of the cold segment into directory/cold."""
+        self._flush()
+        os.makedirs(os.path.join(directory, 'cold'))
+        with self._cold_lock:
+            for chunk_id in self._cold_chunks:
+                _link_tree(os.path.join(self._cold_dir, self._chunk_name(chunk_id)),
+                           os.path.join(directory, 'cold', self._chunk_name(chunk_id)))
+
+    def load_files(self, directory):
+        """Links the chunk files saved by save_files into the cold directory, compressed chunks are also read
+        into the resident set."""
+        with self._cold_lock:
+            for chunk_id in self._cold_chunks:
+                _link_tree(os.path.join(directory, 'cold', self._chunk_name(chunk_id)),
+                           os.path.join(self._cold_dir, self._chunk_name(chunk_id)))
+                self._on_disk.add(chunk_id)
+            if self._compress:
+                num_resident = min(self._resident_chunks, len(self._cold_chunks))
+                for chunk_id in self._rng.choice(list(self._cold_chunks), num_resident, replace=False):
+                    self._resident[int(chunk_id)] = self._read_chunk(int(chunk_id))
+
+    def close(self):
+        self._jobs.put(('stop', None, None))
+        self._reads.put(('stop', None))
+        self._thread.join()
+        self._reader.join()
+        self._finalizer()
+
+
+def _link_tree(src, dst):
+    # hard links when src and dst are on the same file system, copies otherwise
+    if os.path.isdir(src):
+        os.makedirs(dst)
+        for name in os.listdir(src):
+            _link_tree(os.path.join(src, name), os.path.join(dst, name))
+        return
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class TorchReplayBuffer(ReplayBuffer):
+    """Ring buffer of preallocated torch tensors on the training device.
+    Transitions are copied to the device once when they are added, and sample draws the indices with
+    torch.randint and gathers with index_select, so a minibatch is assembled without any host side copy and
+    comes out as tensors (the agents use torch.as_tensor, which leaves them as they are).
+    """
+
+    def __init__(self, size, device="cpu"):
+        super(TorchReplayBuffer, self).__init__(size)
+        self.device = torch.device(device)
+
+    def _allocate(self, obs, ag, g):
+        shapes = {'obs': (obs.shape, torch.uint8), 'obs_next': (obs.shape, torch.uint8),
+                  'ag': (np.shape(ag), torch.int16), 'g': (np.shape(g), torch.int16),
+                  'action': ((), torch.int64), 'reward': ((), torch.float32), 'done': ((), torch.float32)}
+        self._storage = {key: torch.empty([self._maxsize, *shape], dtype=dtype, device=self.device)
+                         for key, (shape, dtype) in shapes.items()}
+
+    def _write(self, idxes, obs, ag, g, action, reward, obs_next, done):
+        transition = {'obs': obs, 'ag': ag, 'g': g, 'action': action, 'reward': reward,
+                      'obs_next': np.asarray(obs_next, dtype=np.uint8), 'done': done}
+        for key, value in transition.items():
+            storage = self._storage[key]
+            storage[idxes] = torch.as_tensor(np.asarray(value)).to(device=self.device, dtype=storage.dtype)
+
+    def add(self, obs, ag, g, action, reward, obs_next, done):
+        obs = np.asarray(obs, dtype=np.uint8)
+        if self._storage is None:
+            self._allocate(obs, ag, g)
+        self._write(self._next_idx, obs, ag, g, action, reward, obs_next, done)
+        self._next_idx = (self._next_idx + 1) % self._maxsize
+        self._size = min(self._size + 1, self._maxsize)
+
+    def add_batch(self, obs, ag, g, action, reward, obs_next, done):
+        obs = np.asarray(obs, dtype=np.uint8)
+        if self._storage is None:
+            self._allocate(obs[0], ag[0], g[0])
+        idxes = torch.as_tensor((self._next_idx + np.arange(obs.shape[0])) % self._maxsize, device=self.device)
+        self._write(idxes, obs, ag, g, action, reward, obs_next, done)
+        self._next_idx = (self._next_idx + obs.shape[0]) % self._maxsize
+        self._size = min(self._size + obs.shape[0], self._maxsize)
+
+    def _encode_sample(self, idxes):
+        return {key: value.index_select(0, idxes) for key, value in self._storage.items()}
+
+    def sample(self, batch_size):
+        idxes = torch.randint(0, self._size, (batch_size,), device=self.device)
         return self._encode_sample(idxes)
 
+    def state_dict(self):
+        state = {'_next_idx': self._next_idx, '_size': self._size}
+        if self._storage is not None:
+            state.update({key: value[:self._size].cpu().numpy() for key, value in self._storage.items()})
+        return state
+
+    def load_state_dict(self, state):
+        if 'obs' in state and self._storage is None:
+            self._allocate(np.empty(state['obs'].shape[1:]), state['ag'][0], state['g'][0])
+        if self._storage is not None:
+            for key, value in self._storage.items():
+                value[:state['_size']] = torch.from_numpy(np.array(state[key])).to(self.device)
+        self._next_idx = state['_next_idx']
+        self._size = state['_size']
+
+
+class SumTree:
+    """Array based sum tree over capacity leaves, node i has the children 2i and 2i + 1 and the root is node 1.
+    Sampling and updates work on whole batches of indices, one numpy op per level of the tree.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity *= 2
+        self.depth = self.capacity.bit_length() - 1
+        self.tree = np.zeros(2 * self.capacity, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, idxes):
+        return self.tree[self.capacity + np.asarray(idxes)]
+
+    def update(self, idxes, values):
+        nodes = self.capacity + np.asarray(idxes)
+        self.tree[nodes] = values
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def sample(self, batch_size):
+        # stratified: one uniform value in each of batch_size equal slices of the total mass
+        values = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * (self.total / batch_size)
+        nodes = np.ones(batch_size, dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values >= self.tree[left]
+            values = np.where(go_right, values - self.tree[left], values)
+            nodes = left + go_right
+        return nodes - self.capacity
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """Proportional prioritized replay (Schaul et al. 2016) on top of the ring buffer.
+    New transitions get the highest priority seen so far, sample also returns the sampled 'idxes' and their
+    importance sampling 'weights' (normalised by the largest weight of the batch), and update_priorities takes
+    the new absolute TD errors of those idxes.
+    """
+
+    def __init__(self, size, alpha=0.6, beta=0.4, eps=1e-6):
+        super(PrioritizedReplayBuffer, self).__init__(size)
+        self._alpha = alpha
+        self._beta = beta
+        self._eps = eps
+        self._tree = SumTree(self._maxsize)
+        self._max_priority = 1.0
+
+    def add(self, obs, ag, g, action, reward, obs_next, done):
+        idx = self._next_idx
+        super(PrioritizedReplayBuffer, self).add(obs, ag, g, action, reward, obs_next, done)
+        self._tree.update([idx], self._max_priority ** self._alpha)
+
+    def add_batch(self, obs, ag, g, action, reward, obs_next, done):
+        idxes = (self._next_idx + np.arange(len(obs))) % self._maxsize
+        super(PrioritizedReplayBuffer, self).add_batch(obs, ag, g, action, reward, obs_next, done)
+        self._tree.update(idxes, self._max_priority ** self._alpha)
+
+    def sample(self, batch_size):
+        # rounding can land right past the last filled leaf, which has priority 0
+        idxes = np.minimum(self._tree.sample(batch_size), self._size - 1)
+        probabilities = self._tree[idxes] / self._tree.total
+        weights = (self._size * probabilities) ** -self._beta
+        transitions = self._encode_sample(idxes)
+        transitions['weights'] = (weights / weights.max()).astype(np.float32)
+        transitions['idxes'] = idxes
+        return transitions
+
+    def update_priorities(self, idxes, priorities):
+        priorities = np.asarray(priorities, dtype=np.float64) + self._eps
+        self._tree.update(idxes, priorities ** self._alpha)
+        self._max_priority = max(self._max_priority, priorities.max())
+
+    def state_dict(self):
+        state = super(PrioritizedReplayBuffer, self).state_dict()
+        state['_priorities'] = self._tree[np.arange(self._size)]
+        state['_max_priority'] = self._max_priority
+        return state
+
+    def load_state_dict(self, state):
+        super(PrioritizedReplayBuffer, self).load_state_dict(state)
+        self._tree.update(np.arange(self._size), state['_priorities'])
+        self._max_priority = state['_max_priority']
+
+
+def td_loss(buffer, transitions, td_error, device):
+    """Mean squared TD error of a (goals x batch x ...) td_error. When transitions come from a
+    PrioritizedReplayBuffer the squares are weighted by their importance sampling weights, and the absolute TD
+    error averaged over the goals is the new priority of each transition."""
+    if 'weights' not in transitions:
+        return td_error.pow(2).mean()
+    weights = torch.tensor(transitions['weights'], device=device)
+    buffer.update_priorities(transitions['idxes'], td_error.detach().abs().mean(dim=0).reshape(-1).cpu().numpy())
+    return (weights.reshape(1, -1, *td_error.shape[2:]) * td_error.pow(2)).mean()
+
+
+def make_replay_buffer(args):
+    if args.replay_type == 'ring':
+        return ReplayBuffer(args.buffer_size)
+    elif args.replay_type == 'frame_store':
+        return FrameStoreReplayBuffer(args.buffer_size)
+    elif args.replay_type == 'torch':
+        return TorchReplayBuffer(args.buffer_size, "cuda" if args.cuda else "cpu")
+    elif args.replay_type == 'prioritized':
+        return PrioritizedReplayBuffer(args.buffer_size, args.per_alpha, args.per_beta)
+    elif args.replay_type == 'tiered':
+        return TieredReplayBuffer(args.buffer_size, args.hot_buffer_size, args.cold_chunk_size, args.cold_dir,
+                                  args.cold_compress, args.cold_resident_chunks, args.cold_swap_interval, seed=args.seed)
+    else:
+        raise NotImplementedError()
+
+
+def steps_to_end(dones):
+    """For every step of a (number episodes x T) batch of done flags, the number of steps until the first
+    done at or after it, T - t if the episode does not end."""
+    dones = np.asarray(dones).astype(bool)
+    T = dones.shape[1]
+    t = np.arange(T)
+    next_done = np.where(dones, t, T)
+    next_done = np.minimum.accumulate(next_done[:, ::-1], axis=1)[:, ::-1]
+    return next_done - t
+
 
 class her_replay_buffer:
     def __init__(self, env_params, buffer_size, sample_func):
@@ -91,11 +900,13 @@ class her_replay_buffer:
         self.n_transitions_stored = 0
         self.sample_func = sample_func
         # create the buffer to store info
-        self.buffers = {'obs': np.empty([self.size, self.T + 1, *self.env_params['obs']]),
-                        'ag': np.empty([self.size, self.T + 1, self.env_params['goal']]),
-                        'g': np.empty([self.size, self.T, self.env_params['goal']]),
-                        'actions': np.empty([self.size, self.T]),
-                        'done': np.empty([self.size, self.T])
+        # frames stay uint8 and goals are pixel positions, only the sampled minibatch is converted to float
+        self.buffers = {'obs': np.empty([self.size, self.T + 1, *self.env_params['obs']], dtype=np.uint8),
+                        'ag': np.empty([self.size, self.T + 1, self.env_params['goal']], dtype=np.int16),
+                        'g': np.empty([self.size, self.T, self.env_params['goal']], dtype=np.int16),
+                        'actions': np.empty([self.size, self.T], dtype=np.int8),
+                        'done': np.empty([self.size, self.T], dtype=np.bool_),
+                        'steps_to_end': np.empty([self.size, self.T], dtype=np.int16)
                         }
         # thread lock
         self.lock = threading.Lock()
@@ -112,8 +923,13 @@ class her_replay_buffer:
             self.buffers['g'][idxs] = mb_g
             self.buffers['actions'][idxs] = mb_actions
             self.buffers['done'][idxs] = dones
+            self.buffers['steps_to_end'][idxs] = steps_to_end(dones)
             self.n_transitions_stored += self.T * batch_size
 
+    @property
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self.buffers.values())
+
     # sample the data from the replay buffer
     def sample(self, batch_size):
         temp_buffers = {}
@@ -126,6 +942,19 @@ class her_replay_buffer:
         transitions = self.sample_func(temp_buffers, batch_size)
         return transitions
 
+    def state_dict(self):
+        with self.lock:
+            state = {'current_size': self.current_size, 'n_transitions_stored': self.n_transitions_stored}
+            state.update({key: value[:self.current_size] for key, value in self.buffers.items()})
+        return state
+
+    def load_state_dict(self, state):
+        with self.lock:
+            self.current_size = state['current_size']
+            self.n_transitions_stored = state['n_transitions_stored']
+            for key, value in self.buffers.items():
+                value[:self.current_size] = state[key]
+
     def _get_storage_idx(self, inc=None):
         inc = inc or 1
         if self.current_size + inc <= self.size:
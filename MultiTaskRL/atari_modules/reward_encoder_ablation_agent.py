@@ -12,8 +12,11 @@ from tqdm import trange
 from matplotlib import pyplot as plt
 
 from continuous_world_modules.geometry import Point
-from atari_modules.replay_buffer import ReplayBuffer
+from atari_modules.replay_buffer import make_replay_buffer, td_loss
+from atari_modules.reward_table import RewardTable
+from atari_modules.vec_env import make_rollout_collector, close_pools, select_actions
 from atari_modules.models import TaskAwareCritic, RewardEncoder # , RewardEncoderTranslator
+from atari_modules.checkpoint import load_checkpoint, save_checkpoint
 from datetime import datetime
 from torch.utils.tensorboard import SummaryWriter
 """
@@ -107,7 +110,13 @@ class RewardEncoderAblationAgent:
                                                # *self.reward_encoder_translator.parameters()
                                        ], lr=self.args.lr)
         # create the replay buffer
-        self.training_buffer = ReplayBuffer(self.args.buffer_size)
+        # rewards of every goal on the uniform input grid, looked up by goal instead of recomputed
+        self.reward_table = RewardTable(env.all_goals, env.get_uniform_inputs(), self.num_actions, self.args.reward_type,
+                                        device=self.device, cache_dir=self.args.reward_cache_dir)
+        self.training_buffer = make_replay_buffer(self.args)
+        # with several workers, samples are collected from a vector env instead
+        self.collector = make_rollout_collector(self.args, self.env_params['max_timesteps'], self._encode_vec_goals,
+                                                self._act_vec)
         # self.uniform_buffer = ReplayBuffer(self.args.buffer_size)
         # if not self.train_reward_encoder:
         #     with open(os.path.join(f'data/{save_dir_date_time}', 'uniform_buffer.pickle'), "rb") as file:
@@ -137,54 +146,58 @@ class RewardEncoderAblationAgent:
             with open(self.args.save_dir + "/arguments.pkl", 'wb') as f:
                 pickle.dump(self.args, f)
 
-            with open('{}/score_monitor.csv'.format(self.args.save_dir), "wt") as monitor_file:
-                monitor = csv.writer(monitor_file)
-                monitor.writerow(['epoch', 'avg. reward', 'avg. dist'])
+            # a resumed run keeps the scores from before it stopped
+            if self.args.resume is None or not os.path.exists('{}/score_monitor.csv'.format(self.args.save_dir)):
+                with open('{}/score_monitor.csv'.format(self.args.save_dir), "wt") as monitor_file:
+                    monitor = csv.writer(monitor_file)
+                    monitor.writerow(['epoch', 'avg. reward', 'avg. dist'])
     def learn(self):
         """
         train the network
 
         """
-        self.pretrain_reward_encoder()
-
+        if self.args.resume is None:
+            self.pretrain_reward_encoder()
+        start_epoch, best_average_reward = self._resume()
 
-        best_average_reward = -1e9
         # start to collect samples
-        for epoch in trange(self.args.n_epochs):
+        for epoch in trange(start_epoch, self.args.n_epochs):
             for cycle in range(self.args.n_cycles):
-                for _ in range(self.args.num_rollouts_per_cycle):
-                    # reset the environment
-                    observation = self.env.reset()
-                    obs = observation['observation']
-                    ag = observation['achieved_goal']
-                    g = observation['desired_goal']
-                    # create artificial reward function
-                    with torch.no_grad():
-                        reward_function = get_reward_function(g, self.num_actions)
-                        reward_encoding_flat, reward_encoding = self.compute_reward_encoding(reward_function)
-
-                    # start to collect samples
-                    for t in range(self.env_params['max_timesteps']):
+                if self.collector is not None:
+                    self.collector.collect(self.training_buffer, self.args.num_rollouts_per_cycle)
+                else:
+                    for _ in range(self.args.num_rollouts_per_cycle):
+                        # reset the environment
+                        observation = self.env.reset()
+                        obs = observation['observation']
+                        ag = observation['achieved_goal']
+                        g = observation['desired_goal']
+                        # create artificial reward function
                         with torch.no_grad():
-                            obs_tensor = self._preproc_o(obs)
-                            action = self.act(obs_tensor, reward_encoding)
-                        # feed the actions into the environment
-                        observation_new, reward, done, info = self.env.step(action)
-                        obs_new = observation_new['observation']
-                        ag_new = observation_new['achieved_goal']
-
-                        # add transition
-                        # if self.train_reward_encoder:
-                        #     self.uniform_buffer.add(obs, ag, g, action, reward, obs_new, done)
-                        self.training_buffer.add(obs, ag, g, action, reward, obs_new, done)
-                        if done:
-                            observation = self.env.reset()
-                            obs = observation['observation']
-                            ag = observation['achieved_goal']
-                            g = observation['desired_goal']
-                        else:
-                            obs = obs_new
-                            ag = ag_new
+                            reward_encoding_flat, reward_encoding = self.compute_reward_encoding(g)
+
+                        # start to collect samples
+                        for t in range(self.env_params['max_timesteps']):
+                            with torch.no_grad():
+                                obs_tensor = self._preproc_o(obs)
+                                action = self.act(obs_tensor, reward_encoding)
+                            # feed the actions into the environment
+                            observation_new, reward, done, info = self.env.step(action)
+                            obs_new = observation_new['observation']
+                            ag_new = observation_new['achieved_goal']
+
+                            # add transition
+                            # if self.train_reward_encoder:
+                            #     self.uniform_buffer.add(obs, ag, g, action, reward, obs_new, done)
+                            self.training_buffer.add(obs, ag, g, action, reward, obs_new, done)
+                            if done:
+                                observation = self.env.reset()
+                                obs = observation['observation']
+                                ag = observation['achieved_goal']
+                                g = observation['desired_goal']
+                            else:
+                                obs = obs_new
+                                ag = ag_new
 
 
                 # each update network backpropagates loss, but does not update parameters
@@ -223,10 +236,32 @@ class RewardEncoderAblationAgent:
                 torch.save(self.critic_network.state_dict(), os.path.join(self.dir, 'best_critic.pt'))
                 torch.save(self.reward_encoder.state_dict(), os.path.join(self.dir, 'best_reward_encoder.pt'))
 
+            if self.args.checkpoint_interval > 0 and (epoch + 1) % self.args.checkpoint_interval == 0:
+                save_checkpoint(os.path.join(self.dir, 'checkpoint'), *self._checkpoint_parts(),
+                                {'epoch': epoch, 'best_average_reward': best_average_reward, 'update_iteration': self.update_iteration})
+
             # maybe save uniform buffer
             # with open(os.path.join(self.dir, 'uniform_buffer.pickle'), "wb") as file:
             #     pickle.dump(self.uniform_buffer, file)
 
+        # stop the env worker processes
+        close_pools(self.collector)
+
+
+    def _checkpoint_parts(self):
+        networks = {'critic': self.critic_network, 'target_critic': self.target_critic_network, 'reward_encoder': self.reward_encoder}
+        return networks, {'optim': self.optim}, {'training_buffer': self.training_buffer}
+
+    def _resume(self):
+        # returns the epoch to start from and the best reward so far, everything else is restored in place
+        if self.args.resume is None:
+            return 0, -1e9
+        counters = load_checkpoint(self.args.resume, *self._checkpoint_parts())
+        self.update_iteration = counters['update_iteration']
+        # the checkpoint already has the pretrained encoder
+        self.uniform_inputs = self._preproc_g(self.env.get_uniform_inputs())
+        print('resumed from {} at epoch {}'.format(self.args.resume, counters['epoch'] + 1))
+        return counters['epoch'] + 1, counters['best_average_reward']
 
     # pre_process the inputs
     def _preproc_o(self, obs):
@@ -269,6 +304,19 @@ class RewardEncoderAblationAgent:
         else:
             raise NotImplementedError()
 
+    # Acts in every env of the vector env at once, env i uses reward_encoding[i]
+    def act_batch(self, obs, reward_encoding):
+        q = self.critic_network.forward_paired(obs, reward_encoding)
+        return select_actions(q, self.policy_type, self.update_eps, self.args.temp)
+
+    def _encode_vec_goals(self, goals):
+        # one batched encoder pass for every env that starts a new episode
+        reward_encoding_flat, reward_encoding = self.compute_reward_encoding(goals)
+        return reward_encoding
+
+    def _act_vec(self, obs, reward_encoding):
+        return self.act_batch(self._preproc_o(obs), reward_encoding)
+
     # Acts with an epsilon-greedy policy
     # def act_e_greedy(self, obs, reward_encoding, update_eps=0.2, print_q=False):
     #     return random.randrange(self.env_params['action']) if random.random() < update_eps else self.act(obs, reward_encoding, print_q=print_q).item()
@@ -334,11 +382,11 @@ class RewardEncoderAblationAgent:
         with torch.no_grad():
             online_transitions = self.training_buffer.sample(self.args.batch_size)
 
-            obs_tensor = torch.tensor(online_transitions['obs'], dtype=torch.float32, device=self.device)
-            obs_next_tensor = torch.tensor(online_transitions['obs_next'], dtype=torch.float32, device=self.device)
-            actions_tensor = torch.tensor(online_transitions['action'], dtype=torch.long, device=self.device)
-            achieved_goals = torch.tensor(online_transitions['ag'], dtype=torch.long, device=self.device)
-            dones_tensor = torch.tensor(online_transitions['done'], dtype=torch.float32, device=self.device)
+            obs_tensor = torch.as_tensor(online_transitions['obs'], device=self.device).to(torch.float32)
+            obs_next_tensor = torch.as_tensor(online_transitions['obs_next'], device=self.device).to(torch.float32)
+            actions_tensor = torch.as_tensor(online_transitions['action'], device=self.device).to(torch.long)
+            achieved_goals = torch.as_tensor(online_transitions['ag'], device=self.device).to(torch.long)
+            dones_tensor = torch.as_tensor(online_transitions['done'], device=self.device).to(torch.float32)
             achieved_goals = achieved_goals/170. # normalize it to be betwreen 0 and 1
             
             rewards = reward_function(achieved_goals)
@@ -373,8 +421,8 @@ class RewardEncoderAblationAgent:
             # the q loss
         real_q_value = self.critic_network(obs_tensor, reward_encoding.detach())
         real_q_value = real_q_value[:, torch.arange(rewards.shape[1]), actions_tensor].unsqueeze(-1)
-        critic_loss = (target_q_value - real_q_value).pow(2).mean()
-        return critic_loss
+        td_error = target_q_value - real_q_value
+        return td_loss(self.training_buffer, online_transitions, td_error, self.device)
 
 
     # update the network
@@ -382,8 +430,8 @@ class RewardEncoderAblationAgent:
         goals = self.env.all_goals
         num_goals_each_time = 40  # 148 max
         goals2 = goals[torch.randperm(goals.shape[0])[:num_goals_each_time]]
-        reward_function = get_reward_function(goals2, self.num_actions)
-        reward_encoding_flat, reward_encoding = self.compute_reward_encoding(reward_function)
+        reward_function = self.reward_table.reward_function(goals2)
+        reward_encoding_flat, reward_encoding = self.compute_reward_encoding(goals2)
         critic_loss = self._value_loss(goals2, reward_encoding, reward_function)
 
         # if not self.train_reward_encoder:
@@ -418,8 +466,8 @@ class RewardEncoderAblationAgent:
             obs = observation['observation']
             g = observation['desired_goal']
             ag = observation['achieved_goal']
-            reward_function = get_reward_function(g, self.num_actions)
-            reward_encoding_flat, reward_encoding = self.compute_reward_encoding(reward_function)
+            reward_function = self.reward_table.reward_function(g)
+            reward_encoding_flat, reward_encoding = self.compute_reward_encoding(g)
 
             total_reward = 0
             for _ in range(self.env_params['max_timesteps']):
@@ -455,8 +503,8 @@ class RewardEncoderAblationAgent:
 
         return total_rewards, total_dist, total_successes
 
-    def compute_reward_encoding(self, reward_function, batch_size=10_000, use_target=False):
-        rewards = reward_function(self.uniform_inputs)
+    def compute_reward_encoding(self, goals, batch_size=10_000, use_target=False):
+        rewards = self.reward_table.grid_rewards(goals)
         individual_encodings = self.reward_encoder(self.uniform_inputs)
         encoding = torch.mean(rewards.unsqueeze(2) * individual_encodings, dim=1)
         # if self.use_translator:
@@ -496,8 +544,7 @@ class RewardEncoderAblationAgent:
             observation = self.env.reset()
             obs = observation['observation']
             g = observation['desired_goal']
-            reward_function = get_reward_function(g, self.num_actions)
-            reward_encoding_flat, reward_encoding = self.compute_reward_encoding(reward_function)
+            reward_encoding_flat, reward_encoding = self.compute_reward_encoding(g)
 
             for _ in range(self.env_params['max_timesteps']):
                 with torch.no_grad():
@@ -559,8 +606,7 @@ class RewardEncoderAblationAgent:
         for descent_step in trange(15_000):
             # randomly select half of goals
             goals2 = goals[torch.randperm(goals.shape[0])[:num_goals_each_time]]
-            reward_functions = get_reward_function(goals2, self.num_actions)
-            rewards = reward_functions(self.uniform_inputs)
+            rewards = self.reward_table.grid_rewards(goals2)
             individual_encodings = self.reward_encoder(self.uniform_inputs)
             encoding = torch.mean(rewards.unsqueeze(2) * individual_encodings, dim=1)
             encoding = encoding.reshape(encoding.shape[0], -1)
@@ -12,8 +12,15 @@ from tqdm import trange
 from matplotlib import pyplot as plt
 
 from continuous_world_modules.geometry import Point
-from atari_modules.replay_buffer import ReplayBuffer
+from atari_modules.replay_buffer import make_replay_buffer, td_loss
+from atari_modules.reward_table import RewardTable
+from atari_modules.vec_env import make_rollout_collector, close_pools, select_actions
+from atari_modules.actor_learner import ActorLearner
+from atari_modules.encoding_cache import RewardEncodingCache
 from atari_modules.models import TaskAwareCritic, RewardEncoder # , RewardEncoderTranslator
+from atari_modules.evaluation import make_evaluator
+from atari_modules.checkpoint import load_checkpoint, save_checkpoint
+from atari_modules.phase_timer import make_phase_timer
 from datetime import datetime
 from torch.utils.tensorboard import SummaryWriter
 """
@@ -107,7 +114,17 @@ class RewardEncoderAgent:
                                                # *self.reward_encoder_translator.parameters()
                                        ], lr=self.args.lr)
         # create the replay buffer
-        self.training_buffer = ReplayBuffer(self.args.buffer_size)
+        # rewards of every goal on the uniform input grid, looked up by goal instead of recomputed
+        self.reward_table = RewardTable(env.all_goals, env.get_uniform_inputs(), self.num_actions, self.args.reward_type,
+                                        device=self.device, cache_dir=self.args.reward_cache_dir)
+        self.training_buffer = make_replay_buffer(self.args)
+        # reward encodings of the fixed goals, so acting and eval do not run the encoder over the whole grid
+        self.encoding_cache = RewardEncodingCache(self._encode_goals, env.all_goals)
+        # with several workers, samples are collected from a vector env instead, the async collectors bring their own
+        self.collector = None
+        if self.args.num_collectors == 0:
+            self.collector = make_rollout_collector(self.args, self.env_params['max_timesteps'], self.encoding_cache,
+                                                    self._act_vec)
         # self.uniform_buffer = ReplayBuffer(self.args.buffer_size)
         # if not self.train_reward_encoder:
         #     with open(os.path.join(f'data/{save_dir_date_time}', 'uniform_buffer.pickle'), "rb") as file:
@@ -137,54 +154,65 @@ class RewardEncoderAgent:
             with open(self.args.save_dir + "/arguments.pkl", 'wb') as f:
                 pickle.dump(self.args, f)
 
-            with open('{}/score_monitor.csv'.format(self.args.save_dir), "wt") as monitor_file:
-                monitor = csv.writer(monitor_file)
-                monitor.writerow(['epoch', 'avg. reward', 'avg. dist'])
+            # a resumed run keeps the scores from before it stopped
+            if self.args.resume is None or not os.path.exists('{}/score_monitor.csv'.format(self.args.save_dir)):
+                with open('{}/score_monitor.csv'.format(self.args.save_dir), "wt") as monitor_file:
+                    monitor = csv.writer(monitor_file)
+                    monitor.writerow(['epoch', 'avg. reward', 'avg. dist'])
+        # where the time of an epoch goes, does nothing unless --phase-timing
+        self.timer = make_phase_timer(self.args, self.logger, dir)
+        # pool of envs that plays the test episodes at once, None evaluates sequentially
+        self.evaluator = make_evaluator(self.args, self.env_params)
     def learn(self):
         """
         train the network
 
         """
-        self.pretrain_reward_encoder()
+        if self.args.resume is None:
+            self.pretrain_reward_encoder()
+        start_epoch, best_average_reward = self._resume()
 
-
-        best_average_reward = -1e9
         # start to collect samples
-        for epoch in trange(self.args.n_epochs):
+        for epoch in trange(start_epoch, self.args.n_epochs):
             for cycle in range(self.args.n_cycles):
-                for _ in range(self.args.num_rollouts_per_cycle):
-                    # reset the environment
-                    observation = self.env.reset()
-                    obs = observation['observation']
-                    ag = observation['achieved_goal']
-                    g = observation['desired_goal']
-                    # create artificial reward function
-                    with torch.no_grad():
-                        reward_function = get_reward_function(g, self.num_actions)
-                        reward_encoding_flat, reward_encoding = self.compute_reward_encoding(reward_function)
-
-                    # start to collect samples
-                    for t in range(self.env_params['max_timesteps']):
-                        with torch.no_grad():
-                            obs_tensor = self._preproc_o(obs)
-                            action = self.act(obs_tensor, reward_encoding)
-                        # feed the actions into the environment
-                        observation_new, reward, done, info = self.env.step(action)
-                        obs_new = observation_new['observation']
-                        ag_new = observation_new['achieved_goal']
-
-                        # add transition
-                        # if self.train_reward_encoder:
-                        #     self.uniform_buffer.add(obs, ag, g, action, reward, obs_new, done)
-                        self.training_buffer.add(obs, ag, g, action, reward, obs_new, done)
-                        if done:
-                            observation = self.env.reset()
-                            obs = observation['observation']
-                            ag = observation['achieved_goal']
-                            g = observation['desired_goal']
-                        else:
-                            obs = obs_new
-                            ag = ag_new
+                if self.collector is not None:
+                    with self.timer.phase('collect_vec'):
+                        self.collector.collect(self.training_buffer, self.args.num_rollouts_per_cycle)
+                else:
+                    for _ in range(self.args.num_rollouts_per_cycle):
+                        # reset the environment
+                        observation = self.env.reset()
+                        obs = observation['observation']
+                        ag = observation['achieved_goal']
+                        g = observation['desired_goal']
+                        reward_encoding = self.encoding_cache(g)
+
+                        # start to collect samples
+                        for t in range(self.env_params['max_timesteps']):
+                            with torch.no_grad():
+                                with self.timer.phase('preproc_obs'):
+                                    obs_tensor = self._preproc_o(obs)
+                                with self.timer.phase('act'):
+                                    action = self.act(obs_tensor, reward_encoding)
+                            # feed the actions into the environment
+                            with self.timer.phase('env_step'):
+                                observation_new, reward, done, info = self.env.step(action)
+                            obs_new = observation_new['observation']
+                            ag_new = observation_new['achieved_goal']
+
+                            # add transition
+                            # if self.train_reward_encoder:
+                            #     self.uniform_buffer.add(obs, ag, g, action, reward, obs_new, done)
+                            with self.timer.phase('replay_add'):
+                                self.training_buffer.add(obs, ag, g, action, reward, obs_new, done)
+                            if done:
+                                observation = self.env.reset()
+                                obs = observation['observation']
+                                ag = observation['achieved_goal']
+                                g = observation['desired_goal']
+                            else:
+                                obs = obs_new
+                                ag = ag_new
 
 
                 # each update network backpropagates loss, but does not update parameters
@@ -206,27 +234,96 @@ class RewardEncoderAgent:
                 # self._soft_update_target_network(self.target_reward_encoder, self.reward_encoder)
 
             # start to do the evaluation
-            average_reward, average_dist, success_rate = self._eval_agent()
-
-            # print('[{}] epoch is: {}, eval: {:.3f}, dist: {:.3f}'.format(datetime.now(), epoch, average_reward, average_dist))
-            self.logger.add_scalar('rl/total_reward', average_reward, self.update_iteration)
-            self.logger.add_scalar('rl/final_distance', average_dist, self.update_iteration)
-            self.logger.add_scalar('rl/success_rate', success_rate, self.update_iteration)
-            with open('{}/score_monitor.csv'.format(self.args.save_dir), "a") as monitor_file:
-                monitor = csv.writer(monitor_file)
-                monitor.writerow([epoch, average_reward, average_dist])
-            torch.save(self.critic_network.state_dict(), os.path.join(self.dir, 'critic.pt'))
-            torch.save(self.reward_encoder.state_dict(), os.path.join(self.dir, 'reward_encoder.pt'))
-
-            if average_reward > best_average_reward:
-                best_average_reward = average_reward
-                torch.save(self.critic_network.state_dict(), os.path.join(self.dir, 'best_critic.pt'))
-                torch.save(self.reward_encoder.state_dict(), os.path.join(self.dir, 'best_reward_encoder.pt'))
+            best_average_reward = self._evaluate_and_save(epoch, best_average_reward)
 
             # maybe save uniform buffer
             # with open(os.path.join(self.dir, 'uniform_buffer.pickle'), "wb") as file:
             #     pickle.dump(self.uniform_buffer, file)
 
+        # stop the env worker processes
+        close_pools(self.collector, self.evaluator)
+
+
+    def learn_async(self):
+        """
+        train the network while collector processes fill the buffer, see actor_learner.py
+
+        """
+        if self.args.resume is None:
+            self.pretrain_reward_encoder()
+
+        actor_learner = ActorLearner(self.args, self.env_params, self.critic_network, self.reward_encoder)
+        self.training_buffer = actor_learner.buffer
+        start_epoch, best_average_reward = self._resume()
+        actor_learner.sync_params()
+        actor_learner.start()
+        actor_learner.wait_for_samples(self.args.batch_size)
+
+        try:
+            for epoch in trange(start_epoch, self.args.n_epochs):
+                start_time, start_env_steps, start_updates = time.time(), actor_learner.env_steps, self.update_iteration
+                for cycle in range(self.args.n_cycles):
+                    for _ in range(self.args.n_batches):
+                        self._update_network()
+                        if self.update_iteration % self.args.sync_interval == 0:
+                            actor_learner.sync_params()
+                    # soft update
+                    self._soft_update_target_network(self.target_critic_network, self.critic_network)
+
+                # throughput of both sides, the learner should not be waiting on the collectors
+                elapsed = time.time() - start_time
+                env_steps_per_sec = (actor_learner.env_steps - start_env_steps) / elapsed
+                updates_per_sec = (self.update_iteration - start_updates) / elapsed
+                self.logger.add_scalar('throughput/env_steps_per_sec', env_steps_per_sec, self.update_iteration)
+                self.logger.add_scalar('throughput/updates_per_sec', updates_per_sec, self.update_iteration)
+                print('[{}] epoch {}: {:.1f} env steps/s, {:.1f} updates/s'.format(datetime.now(), epoch, env_steps_per_sec, updates_per_sec))
+
+                best_average_reward = self._evaluate_and_save(epoch, best_average_reward)
+        finally:
+            actor_learner.stop()
+            close_pools(self.collector, self.evaluator)
+
+    def _evaluate_and_save(self, epoch, best_average_reward):
+        with self.timer.phase('eval'):
+            average_reward, average_dist, success_rate = self._eval_agent()
+
+        # print('[{}] epoch is: {}, eval: {:.3f}, dist: {:.3f}'.format(datetime.now(), epoch, average_reward, average_dist))
+        self.logger.add_scalar('rl/total_reward', average_reward, self.update_iteration)
+        self.logger.add_scalar('rl/final_distance', average_dist, self.update_iteration)
+        self.logger.add_scalar('rl/success_rate', success_rate, self.update_iteration)
+        with open('{}/score_monitor.csv'.format(self.args.save_dir), "a") as monitor_file:
+            monitor = csv.writer(monitor_file)
+            monitor.writerow([epoch, average_reward, average_dist])
+        torch.save(self.critic_network.state_dict(), os.path.join(self.dir, 'critic.pt'))
+        torch.save(self.reward_encoder.state_dict(), os.path.join(self.dir, 'reward_encoder.pt'))
+
+        if average_reward > best_average_reward:
+            best_average_reward = average_reward
+            torch.save(self.critic_network.state_dict(), os.path.join(self.dir, 'best_critic.pt'))
+            torch.save(self.reward_encoder.state_dict(), os.path.join(self.dir, 'best_reward_encoder.pt'))
+
+        if self.args.checkpoint_interval > 0 and (epoch + 1) % self.args.checkpoint_interval == 0:
+            save_checkpoint(os.path.join(self.dir, 'checkpoint'), *self._checkpoint_parts(),
+                            {'epoch': epoch, 'best_average_reward': best_average_reward, 'update_iteration': self.update_iteration})
+        self.timer.dump(epoch, self.update_iteration)
+        return best_average_reward
+
+    def _checkpoint_parts(self):
+        networks = {'critic': self.critic_network, 'target_critic': self.target_critic_network, 'reward_encoder': self.reward_encoder}
+        return networks, {'optim': self.optim}, {'training_buffer': self.training_buffer}
+
+    def _resume(self):
+        # returns the epoch to start from and the best reward so far, everything else is restored in place
+        if self.args.resume is None:
+            return 0, -1e9
+        counters = load_checkpoint(self.args.resume, *self._checkpoint_parts())
+        self.update_iteration = counters['update_iteration']
+        # the checkpoint already has the pretrained encoder, set up what pretrain_reward_encoder would have
+        self.uniform_inputs = self._preproc_g(self.env.get_uniform_inputs())
+        self._freeze_reward_encoder()
+        print('resumed from {} at epoch {}'.format(self.args.resume, counters['epoch'] + 1))
+        return counters['epoch'] + 1, counters['best_average_reward']
+
 
     # pre_process the inputs
     def _preproc_o(self, obs):
@@ -269,6 +366,19 @@ class RewardEncoderAgent:
         else:
             raise NotImplementedError()
 
+    # Acts in every env of the vector env at once, env i uses reward_encoding[i]
+    def act_batch(self, obs, reward_encoding):
+        q = self.critic_network.forward_paired(obs, reward_encoding)
+        return select_actions(q, self.policy_type, self.update_eps, self.args.temp)
+
+    def _act_vec(self, obs, reward_encoding):
+        return self.act_batch(self._preproc_o(obs), reward_encoding)
+
+    # Acts in every env of the evaluation pool at once, env i pursues goals[i]
+    def _act_eval_batch(self, obs, goals):
+        with torch.no_grad():
+            return self.act_batch(self._preproc_o(obs), self.encoding_cache(goals))
+
     # Acts with an epsilon-greedy policy
     # def act_e_greedy(self, obs, reward_encoding, update_eps=0.2, print_q=False):
     #     return random.randrange(self.env_params['action']) if random.random() < update_eps else self.act(obs, reward_encoding, print_q=print_q).item()
@@ -332,13 +442,15 @@ class RewardEncoderAgent:
 
     def _value_loss(self, goals, reward_encoding, reward_function):
         with torch.no_grad():
-            online_transitions = self.training_buffer.sample(self.args.batch_size)
-
-            obs_tensor = torch.tensor(online_transitions['obs'], dtype=torch.float32, device=self.device)
-            obs_next_tensor = torch.tensor(online_transitions['obs_next'], dtype=torch.float32, device=self.device)
-            actions_tensor = torch.tensor(online_transitions['action'], dtype=torch.long, device=self.device)
-            achieved_goals = torch.tensor(online_transitions['ag'], dtype=torch.long, device=self.device)
-            dones_tensor = torch.tensor(online_transitions['done'], dtype=torch.float32, device=self.device)
+            with self.timer.phase('replay_sample'):
+                online_transitions = self.training_buffer.sample(self.args.batch_size)
+            # as_tensor so a device resident buffer (--replay-type torch) is not copied again, numpy batches are
+            # moved as uint8 and only converted on the device
+            obs_tensor = torch.as_tensor(online_transitions['obs'], device=self.device).to(torch.float32)
+            obs_next_tensor = torch.as_tensor(online_transitions['obs_next'], device=self.device).to(torch.float32)
+            actions_tensor = torch.as_tensor(online_transitions['action'], device=self.device).to(torch.long)
+            achieved_goals = torch.as_tensor(online_transitions['ag'], device=self.device).to(torch.long)
+            dones_tensor = torch.as_tensor(online_transitions['done'], device=self.device).to(torch.float32)
             achieved_goals = achieved_goals/170. # normalize it to be betwreen 0 and 1
             
             rewards = reward_function(achieved_goals)
@@ -354,12 +466,14 @@ class RewardEncoderAgent:
             dones_tensor = torch.logical_or(at_goal, dones_tensor).to(torch.float32)
 
             # preprocess
-            obs_tensor = self._preproc_o(obs_tensor)
-            obs_next_tensor = self._preproc_o(obs_next_tensor)
+            with self.timer.phase('preproc_obs'):
+                obs_tensor = self._preproc_o(obs_tensor)
+                obs_next_tensor = self._preproc_o(obs_next_tensor)
             dones_tensor = dones_tensor.unsqueeze(-1)
 
             # calculate the target Q value function
-            q_next_values = self.target_critic_network(obs_next_tensor, reward_encoding)
+            with self.timer.phase('forward'):
+                q_next_values = self.target_critic_network(obs_next_tensor, reward_encoding)
             action_probs = torch.nn.functional.softmax(q_next_values/self.args.temp, dim=-1)
             q_next_value = torch.sum(action_probs * q_next_values, dim=-1).unsqueeze(-1)
             # q_next_value = q_next_values.max(1)[0].reshape(-1, 1) # nromal best action
@@ -371,10 +485,11 @@ class RewardEncoderAgent:
             # clip_return = 1 / (1 - self.args.gamma) # TODO why do this?
             # target_q_value = torch.clamp(target_q_value, 0, clip_return)
             # the q loss
-        real_q_value = self.critic_network(obs_tensor, reward_encoding.detach())
+        with self.timer.phase('forward'):
+            real_q_value = self.critic_network(obs_tensor, reward_encoding.detach())
         real_q_value = real_q_value[:, torch.arange(rewards.shape[1]), actions_tensor].unsqueeze(-1)
-        critic_loss = (target_q_value - real_q_value).pow(2).mean()
-        return critic_loss
+        td_error = target_q_value - real_q_value
+        return td_loss(self.training_buffer, online_transitions, td_error, self.device)
 
 
     # update the network
@@ -382,8 +497,10 @@ class RewardEncoderAgent:
         goals = self.env.all_goals
         num_goals_each_time = 40  # 148 max
         goals2 = goals[torch.randperm(goals.shape[0])[:num_goals_each_time]]
-        reward_function = get_reward_function(goals2, self.num_actions)
-        reward_encoding_flat, reward_encoding = self.compute_reward_encoding(reward_function)
+        reward_function = self.reward_table.reward_function(goals2)
+        # the critic only sees a detached encoding, so the cached one is the same thing
+        with self.timer.phase('encoder'):
+            reward_encoding = self.encoding_cache(goals2)
         critic_loss = self._value_loss(goals2, reward_encoding, reward_function)
 
         # if not self.train_reward_encoder:
@@ -392,11 +509,13 @@ class RewardEncoderAgent:
         #     loss = critic_loss + reward_prediction_loss
         loss = critic_loss
 
-        loss.backward()
-        # norm = torch.nn.utils.clip_grad_norm_(self.reward_encoder.parameters(), 1.0)
-        self.optim.step()
-        self.optim.zero_grad()
-        with torch.no_grad():
+        with self.timer.phase('backward'):
+            loss.backward()
+            # norm = torch.nn.utils.clip_grad_norm_(self.reward_encoder.parameters(), 1.0)
+            self.optim.step()
+            self.optim.zero_grad()
+        self.encoding_cache.invalidate()
+        with torch.no_grad(), self.timer.phase('tensorboard'):
             # if self.train_reward_encoder:
             #     norm = torch.linalg.norm(torch.tensor([torch.linalg.norm(p.grad) for p in self.reward_encoder.parameters()]))
             # else:
@@ -406,10 +525,14 @@ class RewardEncoderAgent:
             # self.logger.add_scalar('Loss/reward', reward_prediction_loss.item(), self.update_iteration)
             # self.logger.add_scalar('reward_loss/gradient_magnitude', norm.item(), self.update_iteration)
             self.update_iteration += 1
+        self.timer.step()
 
 
     # do the evaluation
     def _eval_agent(self):
+        if self.evaluator is not None:
+            results = self.evaluator.run(self._act_eval_batch, self.args.n_test_rollouts, self.env.all_goals)
+            return results['reward'], results['dist'], results['success_rate']
         total_rewards = []
         total_dist = []
         total_successes = []
@@ -418,8 +541,8 @@ class RewardEncoderAgent:
             obs = observation['observation']
             g = observation['desired_goal']
             ag = observation['achieved_goal']
-            reward_function = get_reward_function(g, self.num_actions)
-            reward_encoding_flat, reward_encoding = self.compute_reward_encoding(reward_function)
+            reward_function = self.reward_table.reward_function(g)
+            reward_encoding = self.encoding_cache(g)
 
             total_reward = 0
             for _ in range(self.env_params['max_timesteps']):
@@ -455,8 +578,8 @@ class RewardEncoderAgent:
 
         return total_rewards, total_dist, total_successes
 
-    def compute_reward_encoding(self, reward_function, batch_size=10_000, use_target=False):
-        rewards = reward_function(self.uniform_inputs)
+    def compute_reward_encoding(self, goals, batch_size=10_000, use_target=False):
+        rewards = self.reward_table.grid_rewards(goals)
         individual_encodings = self.reward_encoder(self.uniform_inputs)
         encoding = torch.mean(rewards.unsqueeze(2) * individual_encodings, dim=1)
         # if self.use_translator:
@@ -483,6 +606,13 @@ class RewardEncoderAgent:
         # #     print("Here")
         # return encoding_flat, (individual_encodings, rewards, encoding)
 
+    def _encode_goals(self, goals):
+        # same as compute_reward_encoding, but the mean over the grid is a single einsum
+        # so all goals fit in one pass without the (goals x grid x E x A) product
+        rewards = self.reward_table.grid_rewards(goals)
+        individual_encodings = self.reward_encoder(self.uniform_inputs)
+        return torch.einsum('gna,nea->gea', rewards, individual_encodings) / self.uniform_inputs.shape[0]
+
     def render_episodes(self):
         self.uniform_inputs = self.env.get_uniform_inputs()
         self.uniform_inputs = self._preproc_g(self.uniform_inputs)
@@ -496,8 +626,7 @@ class RewardEncoderAgent:
             observation = self.env.reset()
             obs = observation['observation']
             g = observation['desired_goal']
-            reward_function = get_reward_function(g, self.num_actions)
-            reward_encoding_flat, reward_encoding = self.compute_reward_encoding(reward_function)
+            reward_encoding = self.encoding_cache(g)
 
             for _ in range(self.env_params['max_timesteps']):
                 with torch.no_grad():
@@ -540,6 +669,14 @@ class RewardEncoderAgent:
 
 
 
+    def _freeze_reward_encoder(self):
+        # the critic loss does not reach the encoder, so it is fixed from here on. Its grads are dropped so
+        # that Adam skips it: zero grads (the zero_grad default before torch 2.0) would still move it with the
+        # momentum of pretraining and the frozen encodings would no longer match reward_encoder.pt
+        self.reward_encoder.requires_grad_(False)
+        self.optim.zero_grad(set_to_none=True)
+        self.encoding_cache.freeze()
+
     def pretrain_reward_encoder(self):
         self.uniform_inputs = self.env.get_uniform_inputs()
         self.uniform_inputs = self._preproc_g(self.uniform_inputs)
@@ -549,8 +686,7 @@ class RewardEncoderAgent:
         for descent_step in trange(15_000):
             # randomly select half of goals
             goals2 = goals[torch.randperm(goals.shape[0])[:num_goals_each_time]]
-            reward_functions = get_reward_function(goals2, self.num_actions)
-            rewards = reward_functions(self.uniform_inputs)
+            rewards = self.reward_table.grid_rewards(goals2)
             individual_encodings = self.reward_encoder(self.uniform_inputs)
             encoding = torch.mean(rewards.unsqueeze(2) * individual_encodings, dim=1)
 
@@ -570,12 +706,14 @@ class RewardEncoderAgent:
             self.optim.step()
             grad_norm = torch.nn.utils.clip_grad_norm_(self.reward_encoder.parameters(), 0.1)
             self.optim.zero_grad()
+            self.encoding_cache.invalidate()
             with torch.no_grad():
                 self.logger.add_scalar('loss/reward', estimation_loss.item(), descent_step)
                 # self.logger.add_scalar('loss/regularization', cos_sim.item(), descent_step)
                 self.logger.add_scalar('loss/grad_norm', grad_norm.item(), descent_step)
 
         torch.save(self.reward_encoder.state_dict(), os.path.join(self.dir, 'reward_encoder.pt'))
+        self._freeze_reward_encoder()
         # torch.save(self.reward_encoder_translator.state_dict(), os.path.join(self.dir, 'reward_encoder_translator.pt'))
 
 
@@ -0,0 +1,103 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+"""
+Precomputed rewards of every goal on the uniform input grid.
+The reward functions of the atari agents only depend on the distance between a goal and an achieved goal,
+and both the goals (env.all_goals) and the grid the reward encoders are evaluated on (env.get_uniform_inputs)
+are fixed, so the (number goals x grid points) rewards are computed once, or loaded from disk, and sampled
+goals fetch their rows by index.
+With a cache_dir the table is memory mapped from disk, so later runs and seeds share it instead of rebuilding it.
+Rewards of arbitrary achieved goals (replay samples, eval) still go through goal_rewards,
+but reuse the goal tensor of the table instead of building a new one on every call.
+
+"""
+
+
+def goal_rewards(gs, achieved_goals, num_actions, reward_type='dense', distance_threshold=6 / 170.):
+    """Rewards of every (goal, achieved goal) pair, both normalised to [0, 1].
+    gs is (number goals x 2), achieved_goals is (number achieved goals x 2),
+    returns (number goals x number achieved goals x number actions)."""
+    gs = gs.unsqueeze(1)  # now gs = [batch, 1, 2]
+    achieved_goals = achieved_goals.unsqueeze(0)  # now achieved_goals = [1, batch2, 2]
+    if reward_type == 'dense':
+        rewards = -torch.sum(torch.abs(gs - achieved_goals), dim=-1)
+    elif reward_type == 'sparse':
+        distances = torch.max(torch.abs(gs - achieved_goals), dim=-1)[0]
+        rewards = (distances < distance_threshold).to(torch.float32)
+    else:
+        raise NotImplementedError()
+    return rewards.unsqueeze(2).expand(rewards.shape[0], rewards.shape[1], num_actions).to(torch.float32)
+
+
+class RewardTable:
+    def __init__(self, goals, grid, num_actions, reward_type='dense', distance_threshold=6, device="cpu", cache_dir=None):
+        """
+        Parameters
+        ----------
+        goals: array
+            the (number goals x 2) goals in pixel space, e.g. env.all_goals
+        grid: array
+            the (grid points x 2) inputs in pixel space, e.g. env.get_uniform_inputs()
+        distance_threshold: float
+            in pixels, only used by the sparse reward
+        cache_dir: str
+            if given, the table is saved there and loaded on the next run with the same goals and grid
+        """
+        self.num_actions = num_actions
+        self.reward_type = reward_type
+        self.distance_threshold = distance_threshold / 170.
+        self.device = device
+        goals = np.array(goals)
+        self._index = {tuple(goal): i for i, goal in enumerate(goals)}
+        self.goals = torch.tensor(goals, device=device) / 170.
+        self.grid = torch.tensor(grid, dtype=torch.float32, device=device) / 170.
+
+        path = None
+        if cache_dir is not None:
+            key = hashlib.sha1(goals.tobytes() + np.asarray(grid).tobytes() + str((reward_type, distance_threshold)).encode())
+            path = os.path.join(cache_dir, 'reward_table_{}_{}.npy'.format(reward_type, key.hexdigest()[:16]))
+        if path is not None and os.path.exists(path):
+            # memory mapped, pages are only read when touched and on cpu the tensor shares the mapping (no copy).
+            # copy on write so torch gets a writable array, nothing is ever written back to the file
+            self.table = torch.from_numpy(np.load(path, mmap_mode='c')).to(device)
+        else:
+            # the action dim is the same for every action, so only (goals x grid) is stored
+            with torch.no_grad():
+                self.table = goal_rewards(self.goals, self.grid, 1, reward_type, self.distance_threshold)[:, :, 0].contiguous()
+            if path is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                # several runs can share the cache, the file only appears under path once it is complete
+                with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.npy', delete=False) as tmp_file:
+                    np.save(tmp_file, self.table.cpu().numpy())
+                os.replace(tmp_file.name, path)
+
+    def goal_ids(self, gs):
+        gs = np.array(gs)
+        if len(gs.shape) == 1:  # make a single goal into multiple
+            gs = gs[None]
+        return torch.tensor([self._index[tuple(g)] for g in gs], device=self.device)
+
+    def grid_rewards(self, gs):
+        """Rewards of the goals gs on the whole grid, (number goals x grid points x number actions)."""
+        rewards = self.table[self.goal_ids(gs)]
+        return rewards.unsqueeze(2).expand(rewards.shape[0], rewards.shape[1], self.num_actions)
+
+    def all_rewards(self):
+        """Rewards of every goal, in the order given to the constructor, on the whole grid.
+        Same as grid_rewards(goals) but a view of the table, nothing is copied."""
+        return self.table.unsqueeze(2).expand(self.table.shape[0], self.table.shape[1], self.num_actions)
+
+    def reward_function(self, gs):
+        """Drop in replacement for get_reward_function(gs, num_actions)."""
+        goal_tensor = self.goals[self.goal_ids(gs)]
+
+        def reward_function(achieved_goals):
+            assert (achieved_goals <= 1).all()
+            return goal_rewards(goal_tensor, achieved_goals, self.num_actions, self.reward_type, self.distance_threshold)
+
+        return reward_function
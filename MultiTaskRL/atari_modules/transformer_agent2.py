@@ -12,7 +12,11 @@ from tqdm import trange
 from matplotlib import pyplot as plt
 
 from continuous_world_modules.geometry import Point
-from atari_modules.replay_buffer import ReplayBuffer
+from atari_modules.replay_buffer import make_replay_buffer, td_loss
+from atari_modules.reward_table import RewardTable
+from atari_modules.vec_env import make_rollout_collector, close_pools, select_actions
+from atari_modules.evaluation import make_evaluator
+from atari_modules.checkpoint import load_checkpoint, save_checkpoint
 from atari_modules.models import TaskAwareCritic, RewardEncoder, TransformerCritic, \
     TransformerOracle  # , RewardEncoderTranslator
 from datetime import datetime
@@ -73,6 +77,9 @@ class TransformerAgent2:
         self.num_actions = env_params['action']
         self.device = "cuda" if self.args.cuda else "cpu"
         self.max_examples = 100 # this is due to memory concerns
+        # encoded examples per goal index for acting, dropped whenever the critic is updated
+        self.memory_cache = {}
+        self.memory_version = -1
 
         # create the networks
         state_space = env.observation_space['achieved_goal'].shape
@@ -104,7 +111,13 @@ class TransformerAgent2:
         self.optim = torch.optim.Adam([*self.critic_network.parameters(),], lr=self.args.lr)
 
         # create the replay buffer
-        self.training_buffer = ReplayBuffer(self.args.buffer_size)
+        # rewards of every goal on the uniform input grid, looked up by goal instead of recomputed
+        self.reward_table = RewardTable(env.all_goals, env.get_uniform_inputs(), self.num_actions, self.args.reward_type,
+                                        device=self.device, cache_dir=self.args.reward_cache_dir)
+        self.training_buffer = make_replay_buffer(self.args)
+        # with several workers, samples are collected from a vector env instead
+        self.collector = make_rollout_collector(self.args, self.env_params['max_timesteps'], lambda goals: goals,
+                                                self._act_vec)
 
         # create logger for losses
         current_datetime = datetime.now()
@@ -130,50 +143,56 @@ class TransformerAgent2:
             with open(self.args.save_dir + "/arguments.pkl", 'wb') as f:
                 pickle.dump(self.args, f)
 
-            with open('{}/score_monitor.csv'.format(self.args.save_dir), "wt") as monitor_file:
-                monitor = csv.writer(monitor_file)
-                monitor.writerow(['epoch', 'avg. reward', 'avg. dist'])
+            # a resumed run keeps the scores from before it stopped
+            if self.args.resume is None or not os.path.exists('{}/score_monitor.csv'.format(self.args.save_dir)):
+                with open('{}/score_monitor.csv'.format(self.args.save_dir), "wt") as monitor_file:
+                    monitor = csv.writer(monitor_file)
+                    monitor.writerow(['epoch', 'avg. reward', 'avg. dist'])
+        # pool of envs that plays the test episodes at once, None evaluates sequentially
+        self.evaluator = make_evaluator(self.args, self.env_params)
     def learn(self):
         """
         train the network
 
         """
         self.get_data()
+        start_epoch, best_average_reward = self._resume()
 
-
-        best_average_reward = -1e9
         # start to collect samples
-        for epoch in trange(self.args.n_epochs):
+        for epoch in trange(start_epoch, self.args.n_epochs):
             for cycle in range(self.args.n_cycles):
-                for _ in range(self.args.num_rollouts_per_cycle):
-                    # reset the environment
-                    observation = self.env.reset()
-                    obs = observation['observation']
-                    ag = observation['achieved_goal']
-                    g = observation['desired_goal']
-
-                    # start to collect samples
-                    for t in range(self.env_params['max_timesteps']):
-                        with torch.no_grad():
-                            obs_tensor = self._preproc_o(obs)
-                            action = self.act(obs_tensor, g)
-                        # feed the actions into the environment
-                        observation_new, reward, done, info = self.env.step(action)
-                        obs_new = observation_new['observation']
-                        ag_new = observation_new['achieved_goal']
-
-                        # add transition
-                        # if self.train_reward_encoder:
-                        #     self.uniform_buffer.add(obs, ag, g, action, reward, obs_new, done)
-                        self.training_buffer.add(obs, ag, g, action, reward, obs_new, done)
-                        if done:
-                            observation = self.env.reset()
-                            obs = observation['observation']
-                            ag = observation['achieved_goal']
-                            g = observation['desired_goal']
-                        else:
-                            obs = obs_new
-                            ag = ag_new
+                if self.collector is not None:
+                    self.collector.collect(self.training_buffer, self.args.num_rollouts_per_cycle)
+                else:
+                    for _ in range(self.args.num_rollouts_per_cycle):
+                        # reset the environment
+                        observation = self.env.reset()
+                        obs = observation['observation']
+                        ag = observation['achieved_goal']
+                        g = observation['desired_goal']
+
+                        # start to collect samples
+                        for t in range(self.env_params['max_timesteps']):
+                            with torch.no_grad():
+                                obs_tensor = self._preproc_o(obs)
+                                action = self.act(obs_tensor, g)
+                            # feed the actions into the environment
+                            observation_new, reward, done, info = self.env.step(action)
+                            obs_new = observation_new['observation']
+                            ag_new = observation_new['achieved_goal']
+
+                            # add transition
+                            # if self.train_reward_encoder:
+                            #     self.uniform_buffer.add(obs, ag, g, action, reward, obs_new, done)
+                            self.training_buffer.add(obs, ag, g, action, reward, obs_new, done)
+                            if done:
+                                observation = self.env.reset()
+                                obs = observation['observation']
+                                ag = observation['achieved_goal']
+                                g = observation['desired_goal']
+                            else:
+                                obs = obs_new
+                                ag = ag_new
 
 
                 # each update network backpropagates loss, but does not update parameters
@@ -210,10 +229,30 @@ class TransformerAgent2:
                 best_average_reward = average_reward
                 torch.save(self.critic_network.state_dict(), os.path.join(self.dir, 'best_critic.pt'))
 
+            if self.args.checkpoint_interval > 0 and (epoch + 1) % self.args.checkpoint_interval == 0:
+                save_checkpoint(os.path.join(self.dir, 'checkpoint'), *self._checkpoint_parts(),
+                                {'epoch': epoch, 'best_average_reward': best_average_reward, 'update_iteration': self.update_iteration})
+
             # maybe save uniform buffer
             # with open(os.path.join(self.dir, 'uniform_buffer.pickle'), "wb") as file:
             #     pickle.dump(self.uniform_buffer, file)
 
+        # stop the env worker processes
+        close_pools(self.collector, self.evaluator)
+
+
+    def _checkpoint_parts(self):
+        networks = {'critic': self.critic_network, 'target_critic': self.target_critic_network}
+        return networks, {'optim': self.optim}, {'training_buffer': self.training_buffer}
+
+    def _resume(self):
+        # returns the epoch to start from and the best reward so far, everything else is restored in place
+        if self.args.resume is None:
+            return 0, -1e9
+        counters = load_checkpoint(self.args.resume, *self._checkpoint_parts())
+        self.update_iteration = counters['update_iteration']
+        print('resumed from {} at epoch {}'.format(self.args.resume, counters['epoch'] + 1))
+        return counters['epoch'] + 1, counters['best_average_reward']
 
     # pre_process the inputs
     def _preproc_o(self, obs):
@@ -252,24 +291,23 @@ class TransformerAgent2:
         goal = torch.tensor(goal, dtype=torch.float32, device=self.device)
         goal_indicies = torch.argmin(torch.sum(torch.abs(self.goals - goal), dim=-1), dim=-1)
 
-        # get permutation of data for each goal index # TODO  make permutation different for every goal
-        permutation = torch.randperm(self.states.shape[1])[:self.max_examples] 
-
-        example_states = self.states[:, permutation, :][goal_indicies]
-        example_rewards = self.rewards[:, permutation, :][goal_indicies]
-
-        if len(example_states.shape) == 2:
-            example_states = example_states.unsqueeze(0)
-            example_rewards = example_rewards.unsqueeze(0)
-
-
         # if epsilon greedy, then do random action with prob epsilon
         if self.policy_type == "epsilon" and random.random() < self.update_eps:
             return random.randrange(self.env_params['action'])
         if target_network:
+            # get permutation of data for each goal index # TODO  make permutation different for every goal
+            permutation = torch.randperm(self.states.shape[1])[:self.max_examples]
+
+            example_states = self.states[:, permutation, :][goal_indicies]
+            example_rewards = self.rewards[:, permutation, :][goal_indicies]
+
+            if len(example_states.shape) == 2:
+                example_states = example_states.unsqueeze(0)
+                example_rewards = example_rewards.unsqueeze(0)
             q = self.target_critic_network(obs, example_states, example_rewards)
         else:
-            q = self.critic_network(obs, example_states, example_rewards)
+            # the examples of a goal are only encoded once per parameter version, see _goal_memory
+            q = self.critic_network.forward_memory(obs, self._goal_memory(goal_indicies.reshape(-1)))
             if print_q:
                 print(f"Q: {q}")
         if self.policy_type == "epsilon":
@@ -280,6 +318,37 @@ class TransformerAgent2:
         else:
             raise NotImplementedError()
 
+    # Acts in every env of the vector env at once, env i pursues goals[i]
+    def act_batch(self, obs, goals):
+        goals = torch.tensor(goals, dtype=torch.float32, device=self.device)
+        goal_indicies = torch.argmin(torch.sum(torch.abs(self.goals.unsqueeze(0) - goals.unsqueeze(1)), dim=-1), dim=-1)
+        q = self.critic_network.forward_memory(obs, self._goal_memory(goal_indicies))
+        return select_actions(q, self.policy_type, self.update_eps, self.args.temp)
+
+    def _goal_memory(self, goal_indicies):
+        """Transformer encoder output of the examples of each goal index, the examples of a goal are fixed
+        until the critic is updated, so acting only has to run the observation side of the critic."""
+        if self.memory_version != self.update_iteration:
+            self.memory_cache = {}
+            self.memory_version = self.update_iteration
+        new_indicies = [i for i in torch.unique(goal_indicies).tolist() if i not in self.memory_cache]
+        if len(new_indicies) > 0:
+            new_indicies_tensor = torch.tensor(new_indicies, device=self.states.device)
+            # a different subset of examples for every goal
+            permutations = torch.rand(len(new_indicies), self.states.shape[1], device=self.states.device).argsort(dim=1)[:, :self.max_examples]
+            example_states = torch.gather(self.states[new_indicies_tensor], 1, permutations.unsqueeze(-1).expand(-1, -1, self.states.shape[-1]))
+            example_rewards = torch.gather(self.rewards[new_indicies_tensor], 1, permutations.unsqueeze(-1).expand(-1, -1, self.rewards.shape[-1]))
+            with torch.no_grad():
+                memory = self.critic_network.encode_examples(example_states, example_rewards)
+            for i, index in enumerate(new_indicies):
+                self.memory_cache[index] = memory[i]
+        return torch.stack([self.memory_cache[index] for index in goal_indicies.tolist()])
+
+    # Acts in every env of a vector env at once, both for the collector and the evaluator
+    def _act_vec(self, obs, goals):
+        with torch.no_grad():
+            return self.act_batch(self._preproc_o(obs), goals)
+
     # soft update
     def _soft_update_target_network(self, target, source):
         for target_param, param in zip(target.parameters(), source.parameters()):
@@ -294,11 +363,11 @@ class TransformerAgent2:
         with torch.no_grad():
             online_transitions = self.training_buffer.sample(self.args.batch_size)
 
-            obs_tensor = torch.tensor(online_transitions['obs'], dtype=torch.float32, device=self.device)
-            obs_next_tensor = torch.tensor(online_transitions['obs_next'], dtype=torch.float32, device=self.device)
-            actions_tensor = torch.tensor(online_transitions['action'], dtype=torch.long, device=self.device)
-            achieved_goals = torch.tensor(online_transitions['ag'], dtype=torch.long, device=self.device)
-            dones_tensor = torch.tensor(online_transitions['done'], dtype=torch.float32, device=self.device)
+            obs_tensor = torch.as_tensor(online_transitions['obs'], device=self.device).to(torch.float32)
+            obs_next_tensor = torch.as_tensor(online_transitions['obs_next'], device=self.device).to(torch.float32)
+            actions_tensor = torch.as_tensor(online_transitions['action'], device=self.device).to(torch.long)
+            achieved_goals = torch.as_tensor(online_transitions['ag'], device=self.device).to(torch.long)
+            dones_tensor = torch.as_tensor(online_transitions['done'], device=self.device).to(torch.float32)
             achieved_goals = achieved_goals/170. # normalize it to be betwreen 0 and 1
 
             # get example data
@@ -350,8 +419,8 @@ class TransformerAgent2:
             # the q loss
         real_q_value = self.critic_network(obs_tensor, example_states, example_rewards).squeeze(0)
         real_q_value = real_q_value[torch.arange(real_q_value.shape[0]), :, actions_tensor].transpose(1,0)
-        critic_loss = (target_q_value - real_q_value).pow(2).mean()
-        return critic_loss
+        td_error = target_q_value - real_q_value
+        return td_loss(self.training_buffer, online_transitions, td_error, self.device)
 
 
     # update the network
@@ -373,7 +442,7 @@ class TransformerAgent2:
         # start accumulating
         # for index in range(num_goals_each_time):
         #     goals3 = goals2[index:index+1]
-        reward_function = get_reward_function(goals2, self.num_actions)
+        reward_function = self.reward_table.reward_function(goals2)
         loss = self._value_loss(goals2, reward_function)
         loss.backward()
         with torch.no_grad():
@@ -390,6 +459,9 @@ class TransformerAgent2:
 
     # do the evaluation
     def _eval_agent(self):
+        if self.evaluator is not None:
+            results = self.evaluator.run(self._act_vec, self.args.n_test_rollouts, self.env.all_goals)
+            return results['reward'], results['dist'], results['success_rate']
         total_rewards = []
         total_dist = []
         total_successes = []
@@ -398,7 +470,7 @@ class TransformerAgent2:
             obs = observation['observation']
             g = observation['desired_goal']
             ag = observation['achieved_goal']
-            reward_function = get_reward_function(g, self.num_actions)
+            reward_function = self.reward_table.reward_function(g)
 
             total_reward = 0
             for _ in range(self.env_params['max_timesteps']):
@@ -494,11 +566,12 @@ class TransformerAgent2:
         goals = self.env.all_goals
 
         # compute reward for all states for all goals
-        reward_functions = get_reward_function(goals, self.num_actions)
-        rewards = reward_functions(states)
+        # the table is built from env.all_goals, so this is a view of it (memory mapped when loaded from reward_cache_dir)
+        rewards = self.reward_table.all_rewards()
 
         # process the data into tensors
-        self.states = states.unsqueeze(0).repeat(rewards.shape[0], 1, 1)
+        # every goal has the same states, expand instead of storing a copy per goal
+        self.states = states.unsqueeze(0).expand(rewards.shape[0], -1, -1)
         self.rewards = rewards
         self.goals = torch.tensor(goals).to(self.device)
 
@@ -0,0 +1,216 @@
+import multiprocessing as mp
+import random
+from functools import partial
+
+import numpy as np
+import torch
+
+from atari_modules.wrappers import make_goalPacman
+
+"""
+Runs several GoalMsPacman envs in subprocesses and steps them in lockstep,
+so that one network forward can choose the actions of every env.
+RolloutCollector holds the collection loop the agents share, they only provide how to encode the goals of new
+episodes and how to act on the stacked observations.
+Loosely follows SubprocVecEnv from the openai baselines code, but keeps the goal dict observations
+and does not auto-reset, so the terminal observation of an episode still reaches the replay buffer.
+
+"""
+
+
+def _to_numpy(observation):
+    # LazyFrames are forced here so that a single array goes through the pipe
+    return {'observation': np.asarray(observation['observation'], dtype=np.uint8),
+            'achieved_goal': observation['achieved_goal'],
+            'desired_goal': observation['desired_goal']}
+
+
+def _worker(remote, parent_remote, env_fn, seed):
+    parent_remote.close()
+    # goals are sampled with the global numpy rng, so every worker needs its own seed
+    random.seed(seed)
+    np.random.seed(seed)
+    env = env_fn()
+    env.seed(seed)
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                observation, reward, done, info = env.step(data)
+                remote.send((_to_numpy(observation), reward, done, info))
+            elif cmd == 'reset':
+                observation = env.reset()
+                if data is not None:
+                    env.set_goal(data)
+                    observation['desired_goal'] = data.copy()
+                remote.send(_to_numpy(observation))
+            elif cmd == 'close':
+                remote.close()
+                break
+            else:
+                raise NotImplementedError()
+    except KeyboardInterrupt:
+        print('SubprocVecGoalEnv worker: got KeyboardInterrupt')
+    finally:
+        env.close()
+
+
+def _stack(observations):
+    return {key: np.stack([observation[key] for observation in observations]) for key in observations[0].keys()}
+
+
+class SubprocVecGoalEnv:
+    def __init__(self, env_fns, seeds, context='spawn'):
+        """
+        Parameters
+        ----------
+        env_fns: list
+            picklable functions that each create one goal env
+        seeds: list
+            one seed per env
+        """
+        self.num_envs = len(env_fns)
+        ctx = mp.get_context(context)
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(self.num_envs)])
+        self.processes = [ctx.Process(target=_worker, args=(work_remote, remote, env_fn, seed), daemon=True)
+                          for work_remote, remote, env_fn, seed in zip(self.work_remotes, self.remotes, env_fns, seeds)]
+        for process in self.processes:
+            process.start()
+        for work_remote in self.work_remotes:
+            work_remote.close()
+        self.closed = False
+
+    def reset(self, env_ids=None, goals=None):
+        """Resets the given envs (all of them by default) and returns their stacked observations.
+        If goals are given, env_ids[i] is set to pursue goals[i] instead of a randomly sampled goal."""
+        if env_ids is None:
+            env_ids = np.arange(self.num_envs)
+        for i, env_id in enumerate(env_ids):
+            self.remotes[env_id].send(('reset', None if goals is None else goals[i]))
+        return _stack([self.remotes[env_id].recv() for env_id in env_ids])
+
+    def step(self, actions, env_ids=None):
+        """Steps the given envs (all of them by default), env_ids[i] takes actions[i]."""
+        if env_ids is None:
+            env_ids = np.arange(self.num_envs)
+        for env_id, action in zip(env_ids, actions):
+            self.remotes[env_id].send(('step', int(action)))
+        results = [self.remotes[env_id].recv() for env_id in env_ids]
+        observations, rewards, dones, infos = zip(*results)
+        return _stack(observations), np.array(rewards), np.array(dones), list(infos)
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
+
+
+def make_vec_goalPacman(num_envs, seed, reset_pool_path=None):
+    # every worker loads the same reset pool from disk
+    env_fn = partial(make_goalPacman, reset_pool_path)
+    return SubprocVecGoalEnv([env_fn for _ in range(num_envs)], [seed + 1 + i for i in range(num_envs)])
+
+
+def collect_rollouts(vec_env, buffer, num_steps, act, on_reset):
+    """Steps every env of vec_env num_steps times and streams the transitions into the buffer.
+
+    on_reset(env_ids, observation) is called with the envs that start a new episode (all of them at first),
+    so the agent can refresh its per env state, e.g. the goal encoding.
+    act(obs) gets the stacked observations and returns one action per env.
+    """
+    observation = vec_env.reset()
+    on_reset(np.arange(vec_env.num_envs), observation)
+    for t in range(num_steps):
+        actions = act(observation['observation'])
+        observation_new, rewards, dones, infos = vec_env.step(actions)
+        buffer.add_batch(observation['observation'], observation['achieved_goal'], observation['desired_goal'],
+                         actions, rewards, observation_new['observation'], dones)
+        done_ids = np.nonzero(dones)[0]
+        if len(done_ids) > 0:
+            # fresh arrays, the buffer may still hold views of the terminal observations
+            observation_new = {key: value.copy() for key, value in observation_new.items()}
+            reset_observation = vec_env.reset(done_ids)
+            for key in observation_new.keys():
+                observation_new[key][done_ids] = reset_observation[key]
+            on_reset(done_ids, observation_new)
+        observation = observation_new
+    return num_steps * vec_env.num_envs
+
+
+class RolloutCollector:
+    def __init__(self, vec_env, max_timesteps, encode_goals, act):
+        """
+        Parameters
+        ----------
+        vec_env: SubprocVecGoalEnv
+            the envs that collect the training rollouts
+        encode_goals: function
+            encode_goals(goals) returns what the agent conditions on for these desired goals (the goals themselves,
+            a reward encoding, a w, ...), one row per goal, as a numpy array or a torch tensor
+        act: function
+            act(obs, context) gets the stacked observations and the encode_goals rows of every env and returns
+            one action per env
+        """
+        self.vec_env = vec_env
+        self.max_timesteps = max_timesteps
+        self.encode_goals = encode_goals
+        self.act = act
+        self.context = None
+
+    def _on_reset(self, env_ids, observation):
+        context = self.encode_goals(observation['desired_goal'][env_ids])
+        if self.context is None:
+            self.context = context
+        elif isinstance(self.context, np.ndarray):
+            self.context[env_ids] = context
+        else:
+            self.context[torch.as_tensor(env_ids, device=self.context.device)] = context
+
+    def _act(self, obs):
+        return self.act(obs, self.context)
+
+    def collect(self, buffer, num_rollouts):
+        """Streams as many env steps as num_rollouts episodes into the buffer, rounded up to a multiple of
+        the number of envs."""
+        with torch.no_grad():
+            for _ in range(-(-num_rollouts // self.vec_env.num_envs)):
+                collect_rollouts(self.vec_env, buffer, self.max_timesteps, act=self._act, on_reset=self._on_reset)
+
+    def close(self):
+        self.vec_env.close()
+
+
+def make_rollout_collector(args, max_timesteps, encode_goals, act):
+    # None keeps the one env rollouts of the agents
+    if args.num_workers <= 1:
+        return None
+    return RolloutCollector(make_vec_goalPacman(args.num_workers, args.seed, args.reset_pool), max_timesteps,
+                            encode_goals, act)
+
+
+def close_pools(*pools):
+    # the collector and evaluator of an agent, either may be None
+    for pool in pools:
+        if pool is not None:
+            pool.close()
+
+
+def epsilon_greedy(actions, num_actions, update_eps):
+    """Replaces every greedy action of the batch by a random one with probability update_eps."""
+    explore = torch.rand(actions.shape, device=actions.device) < update_eps
+    return torch.where(explore, torch.randint_like(actions, num_actions), actions)
+
+
+def select_actions(q, policy_type, update_eps, temp):
+    """One action per row of the (batch x actions) q values as a numpy array, epsilon greedy or boltzmann."""
+    if policy_type == "epsilon":
+        actions = epsilon_greedy(q.max(1)[1], q.shape[1], update_eps)
+    elif policy_type == "boltzmann":
+        actions = torch.distributions.Categorical(logits=q / temp).sample()
+    else:
+        raise NotImplementedError()
+    return actions.cpu().numpy()
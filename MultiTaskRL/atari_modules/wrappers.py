@@ -1,5 +1,6 @@
 import numpy as np
 import os
+import pickle
 os.environ.setdefault('PATH', '')
 from collections import deque
 import gym
@@ -32,6 +33,68 @@ class NoopResetEnv(gym.Wrapper):
         return obs
 
 
+class ResetStatePool:
+    def __init__(self, states):
+        """Bank of emulator states right after the no-op reset, see SnapshotResetEnv.
+        The states come from AtariEnv.clone_state, so they can be pickled to disk
+        and loaded by every env that should start from them.
+        """
+        self.states = list(states)
+
+    def __len__(self):
+        return len(self.states)
+
+    @classmethod
+    def generate(cls, env, size):
+        # env is the base atari env wrapped in NoopResetEnv, so every state is a regular start state
+        states = []
+        for _ in range(size):
+            env.reset()
+            states.append(env.unwrapped.clone_state())
+        return cls(states)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls(pickle.load(f))
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self.states, f)
+
+    def sample(self):
+        return self.states[np.random.randint(len(self.states))]
+
+
+class SnapshotResetEnv(gym.Wrapper):
+    def __init__(self, env, pool):
+        """Takes the place of NoopResetEnv, but restores a start state from the pool
+        instead of playing the no-ops again on every reset.
+        """
+        gym.Wrapper.__init__(self, env)
+        self.pool = pool
+
+    def reset(self, **kwargs):
+        self.env.reset(**kwargs)
+        self.env.unwrapped.restore_state(self.pool.sample())
+        return self.env.unwrapped._get_obs()
+
+
+def make_reset_pool(path, size, env_id='MsPacmanNoFrameskip-v4'):
+    """Loads the pool at path, or generates it and saves it there first."""
+    if os.path.exists(path):
+        return ResetStatePool.load(path)
+    env = gym.make(env_id)
+    env = NoopResetEnv(env, noops=240)
+    pool = ResetStatePool.generate(env, size)
+    env.close()
+    directory = os.path.dirname(path)
+    if directory != '':
+        os.makedirs(directory, exist_ok=True)
+    pool.save(path)
+    return pool
+
+
 class FrameStack(gym.Wrapper):
     def __init__(self, env, k):
         """Stack k last frames.
@@ -67,10 +130,13 @@ class FrameStack(gym.Wrapper):
         return LazyFrames(list(self.frames))
 
 
-def make_atari(env_id):
+def make_atari(env_id, reset_pool=None):
     env = gym.make(env_id)
     assert 'NoFrameskip' in env.spec.id
-    env = NoopResetEnv(env, noops=240)
+    if reset_pool is None:
+        env = NoopResetEnv(env, noops=240)
+    else:
+        env = SnapshotResetEnv(env, reset_pool)
     env = MaxAndSkipEnv(env, skip=4)
     return env
 
@@ -253,8 +319,10 @@ class GoalMsPacman(gym.Wrapper):
 
 
 
-def make_goalPacman():
-    env = make_atari('MsPacmanNoFrameskip-v4')
+def make_goalPacman(reset_pool_path=None):
+    # with a reset pool, resets restore a saved start state instead of playing 240 no-ops
+    reset_pool = None if reset_pool_path is None else ResetStatePool.load(reset_pool_path)
+    env = make_atari('MsPacmanNoFrameskip-v4', reset_pool)
     env = LifeLossEnv(env)
     env = CroppedFrame(env)
     env = WarpFrame(env)
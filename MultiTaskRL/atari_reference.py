@@ -0,0 +1,39 @@
+import torch
+
+"""
+The atari model code as it was before it was factorised / broadcast, test_atari_models.py checks the models
+against these and the benchmark_*.py scripts time both sides.
+
+"""
+
+
+# the TaskAwareCritic forward pass as it was, with the (goals x batch x (3136 + E*A)) concatenation
+def concat_forward(critic, obs, encoding):
+    norm_encoding = critic._norm_encoding(encoding)
+    image_encoding = critic.image(obs).reshape(-1, 3136)
+    norm_encoding = norm_encoding.unsqueeze(1).repeat_interleave(image_encoding.shape[0], dim=1)
+    image_encoding = image_encoding.unsqueeze(0).repeat_interleave(norm_encoding.shape[0], dim=0)
+    values = critic.nn(torch.cat([image_encoding, norm_encoding], dim=2))
+    q_values = values.reshape(values.shape[0], values.shape[1], critic.num_actions, critic.embed_dim)
+    return torch.sum(q_values * encoding.unsqueeze(1).transpose(-1, -2), dim=3)
+
+
+# the transformer forward pass as it was, every (obs, goal) pair gets its own copy of the examples
+def repeat_forward(model, obs, example_encoding):
+    observation_encoding = model.encoder_observation(obs).unsqueeze(1)
+    num_obs = observation_encoding.shape[0]
+    num_goals = example_encoding.shape[0]
+    example_encoding = example_encoding.unsqueeze(0).repeat(num_obs, 1, 1, 1)
+    observation_encoding = observation_encoding.unsqueeze(1).repeat(1, num_goals, 1, 1)
+    example_encoding = example_encoding.view(-1, example_encoding.shape[-2], example_encoding.shape[-1])
+    observation_encoding = observation_encoding.view(-1, observation_encoding.shape[-2], observation_encoding.shape[-1])
+    output = model.decoder(model.transformer(example_encoding, observation_encoding))
+    return output.reshape(num_obs, num_goals, -1)
+
+
+def critic_repeat(critic, obs, example_state, example_reward):
+    return repeat_forward(critic, obs, critic.encoder_goal(torch.cat([example_state, example_reward], dim=-1)))
+
+
+def oracle_repeat(oracle, obs, goal):
+    return repeat_forward(oracle, obs, oracle.encoder_goal(goal.unsqueeze(1)))
@@ -0,0 +1,29 @@
+import time
+
+from grid_modules.gridworld.txt_utilities import build_gridworld_from_char_matrix, rooms, maze
+from grid_reference import reference_transitions
+
+"""
+Compares the construction time of the vectorized build_simple_grid + add_walls_at with the builder that filled
+the transition matrix state by state and action by action and then added the walls one at a time,
+on large wall heavy text maps. test_gridworld.py checks that both build the same matrix.
+Run from MultiTaskRL/: python benchmark_gridworld_builder.py
+
+"""
+
+
+print("{:>8} {:>6} {:>8} {:>8} {:>12} {:>12}".format("map", "size", "|S|", "walls", "loop s", "vectorized s"))
+for make_map in [rooms, maze]:
+    for size in [50, 100, 200, 400]:
+        char_matrix = make_map(size)
+        num_walls = sum(row.count('#') for row in char_matrix)
+        loop_time = float('nan')
+        if size <= 100:
+            start = time.time()
+            reference_transitions(char_matrix, 0.9)
+            loop_time = time.time() - start
+        start = time.time()
+        build_gridworld_from_char_matrix(char_matrix, p_success=0.9)
+        vectorized_time = time.time() - start
+        print("{:>8} {:>6} {:>8} {:>8} {:>12.3f} {:>12.3f}".format(make_map.__name__, size, size * size, num_walls,
+                                                                   loop_time, vectorized_time))
@@ -0,0 +1,66 @@
+import argparse
+import time
+
+import numpy as np
+
+from atari_modules.her import her_sampler
+from atari_modules.replay_buffer import her_replay_buffer
+
+"""
+Memory of the HerDQN episode buffer with the old float64 layout against the typed uint8 / int16 / int8 one,
+and how many transitions fit in a given amount of RAM with each.
+Run from MultiTaskRL/: python benchmark_her_replay_buffer.py --ram-gb 32
+
+"""
+
+
+# same as GoalMsPacman.compute_reward, without building the env
+def compute_reward(achieved_goal, goal, info):
+    return -(np.max(np.abs(achieved_goal - goal), axis=-1) > 6).astype(np.float32)
+
+
+def bytes_per_episode(env_params, dtypes):
+    T = env_params['max_timesteps']
+    shapes = {'obs': [T + 1, *env_params['obs']],
+              'ag': [T + 1, env_params['goal']],
+              'g': [T, env_params['goal']],
+              'actions': [T],
+              'done': [T],
+              'steps_to_end': [T]}
+    return sum(int(np.prod(shape)) * np.dtype(dtypes[key]).itemsize for key, shape in shapes.items())
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--ram-gb', type=float, default=32, help='the RAM budget of the buffer')
+parser.add_argument('--episodes', type=int, default=200, help='size of the buffer that is actually allocated')
+args = parser.parse_args()
+
+env_params = {'obs': (84, 84, 4), 'goal': 2, 'action': 5, 'max_timesteps': 50}
+T = env_params['max_timesteps']
+float64_dtypes = {'obs': np.float64, 'ag': np.float64, 'g': np.float64, 'actions': np.float64, 'done': np.float64,
+                  'steps_to_end': np.int64}
+
+# the typed buffer, filled so the pages are actually touched
+buffer = her_replay_buffer(env_params, args.episodes * T, her_sampler('future', 4, compute_reward).sample_her_transitions)
+for _ in range(args.episodes // 2):
+    mb_obs = np.random.randint(0, 256, size=(2, T + 1, *env_params['obs']), dtype=np.uint8)
+    mb_ag = np.random.randint(0, 170, size=(2, T + 1, 2))
+    mb_g = np.random.randint(0, 170, size=(2, T, 2))
+    mb_actions = np.random.randint(0, env_params['action'], size=(2, T))
+    mb_dones = (np.random.uniform(size=(2, T)) < 0.02).astype(np.float64)
+    buffer.store_episode([mb_obs, mb_ag, mb_g, mb_actions, mb_dones])
+typed_bytes = buffer.nbytes // buffer.size
+float64_bytes = bytes_per_episode(env_params, float64_dtypes)
+assert typed_bytes == bytes_per_episode(env_params, {key: value.dtype for key, value in buffer.buffers.items()})
+
+start = time.time()
+for _ in range(100):
+    transitions = buffer.sample(128)
+sample_ms = (time.time() - start) * 10
+assert transitions['obs'].dtype == np.uint8
+
+budget = args.ram_gb * 2**30
+print("{:>10} {:>16} {:>24}".format("layout", "MiB / episode", "transitions in {:.0f} GiB".format(args.ram_gb)))
+for name, episode_bytes in [("float64", float64_bytes), ("typed", typed_bytes)]:
+    print("{:>10} {:>16.2f} {:>24d}".format(name, episode_bytes / 2**20, int(budget // episode_bytes) * T))
+print("typed layout is {:.1f}x smaller, sampling 128 transitions takes {:.2f} ms".format(float64_bytes / typed_bytes, sample_ms))
@@ -0,0 +1,50 @@
+import time
+
+import numpy as np
+import torch
+
+from grid_modules.gridworld.txt_utilities import build_gridworld_from_char_matrix, open_room
+from grid_modules.mdp_utils import policy_evaluation, OptimalQTable
+from grid_reference import successor_reps_q
+
+"""
+Times the FB evaluation pattern (2 policies per test goal) as the grid grows, with the inverse of
+compute_successor_reps the grid agents used to go through and with policy_evaluation (iterative and solve).
+The inverse and the solve need the SA x SA matrix and only run while it fits.
+test_gridworld.py checks that they give the same q values.
+Run from MultiTaskRL/: python benchmark_policy_evaluation.py
+
+"""
+
+
+gamma = 0.9
+n_test_rollouts = 10
+device = "cuda" if torch.cuda.is_available() else "cpu"
+torch.manual_seed(0)
+
+print("{:>6} {:>8} {:>12} {:>12} {:>12} {:>12}".format("size", "|S|", "SA x SA MiB", "inverse ms", "solve ms",
+                                                        "iterative ms"))
+for size in [11, 21, 31, 51, 101, 201]:
+    env = build_gridworld_from_char_matrix(open_room(size), p_success=0.9)
+    P = env.P.to_torch(device=device)
+    goal_ids = list(np.random.choice(env.reachable_states, n_test_rollouts))
+    Rs = OptimalQTable(P, gamma).rewards(goal_ids)
+    pis = torch.softmax(torch.randn(2, n_test_rollouts, env.state_space, env.action_space, device=device), dim=-1)
+    dense_bytes = (env.state_space * env.action_space) ** 2 * 4
+
+    def timed(fn):
+        start = time.time()
+        fn()
+        if device == "cuda":
+            torch.cuda.synchronize()
+        return (time.time() - start) * 1000
+
+    inverse_time = solve_time = float('nan')
+    if dense_bytes < 2**30:
+        inverse_time = timed(lambda: [successor_reps_q(P, pis[i, j], Rs[j], gamma)
+                                      for i in range(2) for j in range(n_test_rollouts)])
+        solve_time = timed(lambda: [policy_evaluation(Rs[j], P, pis[i, j], gamma, solver='solve')
+                                    for i in range(2) for j in range(n_test_rollouts)])
+    iterative_time = timed(lambda: policy_evaluation(Rs, P, pis, gamma))
+    print("{:>6} {:>8} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.1f}".format(size, env.state_space, dense_bytes / 2**20,
+                                                                       inverse_time, solve_time, iterative_time))
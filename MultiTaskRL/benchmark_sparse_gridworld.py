@@ -0,0 +1,58 @@
+import time
+
+import numpy as np
+import torch
+
+from grid_modules.gridworld.txt_utilities import build_gridworld_from_char_matrix, open_room
+from grid_modules.mdp_utils import value_iteration, compute_successor_reps
+
+"""
+Scales the grid size from 11 to 200 with the sparse transition matrix of the grid worlds, against the dense one
+the builder used to make. Dense numbers are only measured while the dense matrix fits in memory, the successor
+representations while the SA x SA matrix does. test_gridworld.py checks that both give the same results.
+Run from MultiTaskRL/: python benchmark_sparse_gridworld.py
+
+"""
+
+
+def measure(fn, repeats=3):
+    start = time.time()
+    for _ in range(repeats):
+        out = fn()
+    return (time.time() - start) / repeats, out
+
+
+gamma = 0.9
+torch.manual_seed(0)
+
+print("{:>6} {:>8} {:>10} {:>12} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+    "size", "|S|", "build s", "P MiB", "dense MiB", "VI ms", "dense VI", "SR ms", "step us"))
+for size in [11, 25, 50, 100, 150, 200]:
+    char_matrix = open_room(size)
+    build_time, env = measure(lambda: build_gridworld_from_char_matrix(char_matrix, p_success=0.9), repeats=1)
+    state_space = env.state_space
+    dense_bytes = state_space * env.action_space * state_space * 4
+
+    env.reset()
+    R = torch.tensor(env.R, dtype=torch.float32)
+    P = env.P.to_torch()
+    vi_time, _ = measure(lambda: value_iteration(R, P, gamma, atol=1e-8, max_iteration=5000))
+    dense_vi_time = float('nan')
+    if dense_bytes < 2**30:
+        P_dense = P.to_dense()
+        dense_vi_time, _ = measure(lambda: value_iteration(R, P_dense, gamma, atol=1e-8, max_iteration=5000))
+        del P_dense
+    sr_time = float('nan')
+    if (state_space * env.action_space) ** 2 * 4 < 2**30:
+        pi = torch.softmax(torch.randn(state_space, env.action_space), dim=-1)
+        sr_time, _ = measure(lambda: compute_successor_reps(P, pi, gamma), repeats=1)
+
+    num_steps = 1000
+    start = time.time()
+    for _ in range(num_steps):
+        env.step(np.random.randint(env.action_space))
+    step_time = (time.time() - start) / num_steps
+
+    print("{:>6} {:>8} {:>10.2f} {:>12.2f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+        size, state_space, build_time, env.P.nbytes / 2**20, dense_bytes / 2**20, vi_time * 1000,
+        dense_vi_time * 1000, sr_time * 1000, step_time * 1e6))
@@ -0,0 +1,54 @@
+import time
+
+import torch
+
+from atari_modules.models import TaskAwareCritic
+from atari_reference import concat_forward
+
+"""
+Compares time and peak memory of the factorised first layer of TaskAwareCritic and of the old concatenation
+path across goal counts, test_atari_models.py checks that both match.
+Run from MultiTaskRL/: python benchmark_task_aware_critic.py
+
+"""
+
+
+def measure(fn, device, repeats=10):
+    if device == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for _ in range(repeats):
+        fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    elapsed = (time.time() - start) / repeats
+    peak = torch.cuda.max_memory_allocated() / 2**20 if device == "cuda" else float('nan')
+    return elapsed, peak
+
+
+env_params = {'obs': (84, 84, 4), 'goal': 2, 'action': 5, 'max_timesteps': 50}
+embed_dim = 32
+batch_size = 128
+device = "cuda" if torch.cuda.is_available() else "cpu"
+torch.manual_seed(0)
+
+critic = TaskAwareCritic(env_params, embed_dim).to(device)
+obs = torch.rand(batch_size, 4, 84, 84, device=device)
+
+print("{:>6} {:>14} {:>14} {:>14} {:>14}".format("goals", "concat ms", "factorised ms", "concat MiB", "factorised MiB"))
+for number_goals in [1, 10, 40, 80, 148]:
+    encoding = torch.randn(number_goals, embed_dim, env_params['action'], device=device)
+
+    def run_concat():
+        critic.zero_grad()
+        concat_forward(critic, obs, encoding).mean().backward()
+
+    def run_factorised():
+        critic.zero_grad()
+        critic(obs, encoding).mean().backward()
+
+    concat_time, concat_peak = measure(run_concat, device)
+    factorised_time, factorised_peak = measure(run_factorised, device)
+    print("{:>6} {:>14.2f} {:>14.2f} {:>14.1f} {:>14.1f}".format(number_goals, concat_time * 1000, factorised_time * 1000,
+                                                                 concat_peak, factorised_peak))
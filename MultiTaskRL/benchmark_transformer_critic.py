@@ -0,0 +1,56 @@
+import time
+
+import torch
+
+from atari_modules.models import TransformerCritic
+from atari_reference import critic_repeat
+
+"""
+Compares time and peak memory of the broadcast cross attention of TransformerCritic and of the old path that
+repeated the examples for every observation, test_atari_models.py checks that both match.
+Run from MultiTaskRL/: python benchmark_transformer_critic.py
+
+"""
+
+
+def measure(fn, device, repeats=5):
+    if device == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for _ in range(repeats):
+        fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    elapsed = (time.time() - start) / repeats
+    peak = torch.cuda.max_memory_allocated() / 2**20 if device == "cuda" else float('nan')
+    return elapsed, peak
+
+
+num_actions = 5
+device = "cuda" if torch.cuda.is_available() else "cpu"
+torch.manual_seed(0)
+
+critic = TransformerCritic((84, 84, 4), (2,), (num_actions,), device=device)
+
+num_obs, num_goals, num_examples = 128, 40, 200
+obs = torch.rand(num_obs, 4, 84, 84, device=device)
+example_state = torch.rand(num_goals, num_examples, 2, device=device)
+example_reward = torch.randn(num_goals, num_examples, num_actions, device=device)
+
+
+def run_repeat():
+    critic.zero_grad()
+    critic_repeat(critic, obs, example_state, example_reward).mean().backward()
+
+
+def run_broadcast():
+    critic.zero_grad()
+    critic(obs, example_state, example_reward).mean().backward()
+
+
+print("{} obs x {} goals x {} examples, forward + backward".format(num_obs, num_goals, num_examples))
+print("{:>10} {:>12} {:>12}".format("path", "ms", "peak MiB"))
+for name, fn in [("repeat", run_repeat), ("broadcast", run_broadcast)]:
+    elapsed, peak = measure(fn, device)
+    print("{:>10} {:>12.1f} {:>12.1f}".format(name, elapsed * 1000, peak))
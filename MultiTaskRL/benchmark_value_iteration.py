@@ -0,0 +1,45 @@
+import time
+
+import numpy as np
+import torch
+
+from grid_modules.gridworld import FOUR_ROOM_TXT, BIG_FOUR_ROOM_TXT
+from grid_modules.gridworld.txt_utilities import get_char_matrix, build_gridworld_from_char_matrix
+from grid_modules.mdp_utils import value_iteration, batched_value_iteration, OptimalQTable
+
+"""
+Times the evaluation pattern of the grid agents: n test goals solved one by one with value_iteration, solved
+in one batch with batched_value_iteration, and looked up again once memoized. test_gridworld.py checks that
+they give the same q values.
+Run from MultiTaskRL/: python benchmark_value_iteration.py
+
+"""
+
+
+gamma = 0.9
+n_test_rollouts = 10
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+for name, txt in [("four rooms", FOUR_ROOM_TXT), ("big four rooms", BIG_FOUR_ROOM_TXT)]:
+    env = build_gridworld_from_char_matrix(get_char_matrix(txt), p_success=0.9)
+    P = env.P.to_torch(device=device)
+    table = OptimalQTable(P, gamma, atol=1e-8, max_iteration=5000)
+    goal_ids = list(np.random.choice(env.reachable_states, n_test_rollouts))
+
+    def one_by_one():
+        return torch.stack([value_iteration(R, P, gamma, atol=1e-8, max_iteration=5000) for R in table.rewards(goal_ids)])
+
+    def batched():
+        return batched_value_iteration(table.rewards(goal_ids), P, gamma, atol=1e-8, max_iteration=5000)
+
+    # fills the memo
+    table(goal_ids)
+
+    print("{}, |S| = {}, {} goals".format(name, env.state_space, n_test_rollouts))
+    for path, fn in [("one by one", one_by_one), ("batched", batched), ("memoized", lambda: table(goal_ids))]:
+        start = time.time()
+        for _ in range(5):
+            fn()
+        if device == "cuda":
+            torch.cuda.synchronize()
+        print("{:>12} {:>10.2f} ms".format(path, (time.time() - start) / 5 * 1000))
@@ -0,0 +1,36 @@
+import time
+
+import numpy as np
+
+from grid_modules.gridworld.env import VectorGridWorldMDP
+from grid_modules.gridworld.txt_utilities import build_gridworld_from_char_matrix, open_room
+
+"""
+Compares collecting rollouts one step of one episode at a time with GridWorldMDP.step against stepping all of
+them in lockstep with VectorGridWorldMDP. Only the environment is timed, the agents also save one forward per
+step and env. test_gridworld.py checks that VectorGridWorldMDP draws its next states from P.
+Run from MultiTaskRL/: python benchmark_vector_gridworld.py
+
+"""
+
+
+max_timesteps = 50
+print("{:>6} {:>8} {:>6} {:>14} {:>14}".format("size", "|S|", "envs", "sequential s", "lockstep s"))
+for size in [21, 51, 101, 201]:
+    env = build_gridworld_from_char_matrix(open_room(size), p_success=0.9)
+    for num_envs in [8, 64]:
+        start = time.time()
+        for _ in range(num_envs):
+            env.reset()
+            for _ in range(max_timesteps):
+                env.step(np.random.randint(env.action_space))
+        sequential_time = time.time() - start
+
+        vec_env = VectorGridWorldMDP(env, num_envs)
+        start = time.time()
+        vec_env.reset()
+        for _ in range(max_timesteps):
+            vec_env.step(np.random.randint(env.action_space, size=num_envs))
+        lockstep_time = time.time() - start
+        print("{:>6} {:>8} {:>6} {:>14.4f} {:>14.4f}".format(size, env.state_space, num_envs, sequential_time,
+                                                             lockstep_time))
@@ -1,6 +1,7 @@
 import numpy as np
 from grid_modules import utils
 from grid_modules.exceptions import InvalidActionError, EpisodeDoneError
+from grid_modules.transitions import as_sparse
 
 
 class Env(object):
@@ -21,7 +22,8 @@ class MDP(Env):
     def __init__(self, P, R, gamma, p0, terminal_states, seed=1337, skip_check=False):
         """
         A simple MDP simulator.
-        :param P: The transition matrix of size |S|x|A|x|S|
+        :param P: The transition matrix of size |S|x|A|x|S|, dense or SparseTransitions.
+                  It is stored as SparseTransitions either way.
         :param R: The reward criterion |S|x|A|
         :param gamma: the discount factor.
         :param p0: the distribution over starting states |S| (must sum to 1.)
@@ -31,7 +33,8 @@ class MDP(Env):
         :param seed: the random seed for simulations.
         """
         super().__init__(seed)
-        if not skip_check: assert np.allclose(P.sum(axis=2), 1), 'Transition matrix does not seem to be a stochastic matrix ' \
+        P = as_sparse(P)
+        if not skip_check: assert P.is_stochastic(), 'Transition matrix does not seem to be a stochastic matrix ' \
                                            '(i.e. the sum over states for each action doesn not equal 1'
         self.P = P
         self.R = R
@@ -75,12 +78,12 @@ class MDP(Env):
         if self.current_state.argmax() in self.terminal_states:
             self.done = True
 
-        # get the vector representing the next state probabilities:
+        # get the reachable next states and their probabilities:
         current_state_idx = utils.convert_onehot_to_int(self.current_state)
-        next_state_probs = self.P[current_state_idx, action]
+        next_states, next_state_probs = self.P.row(current_state_idx, action)
 
         # sample the next state
-        sampled_next_state = self.rng.choice(np.arange(self.state_space), p=next_state_probs)
+        sampled_next_state = self.rng.choice(next_states, p=next_state_probs)
         # observe the reward
         reward = self.R[current_state_idx, action]
 
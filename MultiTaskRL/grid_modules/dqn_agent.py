@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 import os
 from datetime import datetime
 import numpy as np
@@ -7,7 +8,8 @@ import pickle
 import csv
 from grid_modules.replay_buffer import ReplayBuffer, her_replay_buffer
 from grid_modules.her import her_sampler
-from grid_modules.mdp_utils import extract_policy, value_iteration, compute_successor_reps
+from grid_modules.gridworld.env import VectorGridWorldMDP
+from grid_modules.mdp_utils import extract_policy, policy_evaluation, OptimalQTable
 from discrete_action_robots_modules.models import critic
 
 
@@ -28,11 +30,16 @@ class DQNAgent:
             self.critic_target_network.cuda()
         # create the optimizer
         self.critic_optim = torch.optim.Adam(self.critic_network.parameters(), lr=self.args.lr)
+        # optimal q values of the test goals, for the evaluation
+        self.optimal_q = OptimalQTable(self.env.P.to_torch(device='cuda' if self.args.cuda else None),
+                                       self.args.gamma, atol=1e-8, max_iteration=5000)
         # her sampler
         compute_reward = lambda g_1, g_2: (g_1.argmax(-1) == g_2.argmax(-1)).astype(np.float32)
         self.her_module = her_sampler(self.args.replay_strategy, self.args.replay_k, compute_reward)
         # create the replay buffer
         self.buffer = her_replay_buffer(self.env_params, self.args.buffer_size, self.her_module.sample_her_transitions)
+        # the rollouts of a cycle are collected together
+        self.vec_env = VectorGridWorldMDP(env, self.args.num_rollouts_per_cycle, seed=self.args.seed)
         # create the replay buffer
         # self.buffer = ReplayBuffer(self.args.buffer_size)
 
@@ -60,34 +67,27 @@ class DQNAgent:
         # start to collect samples
         for epoch in range(self.args.n_epochs):
             for _ in range(self.args.n_cycles):
-                mb_obs, mb_g, mb_actions = [], [], []
-                for _ in range(self.args.num_rollouts_per_cycle):
-                    # reset the rollouts
-                    ep_obs, ep_g, ep_actions = [], [], []
-                    # reset the environment
-                    obs = self.env.reset()
-                    g = self.env.goal
-                    # start to collect samples
-                    for t in range(self.env_params['max_timesteps']):
-                        with torch.no_grad():
-                            obs_tensor = self._preproc_o(obs)
-                            g_tensor = self._preproc_g(g)
-                            action = self.act_e_greedy(obs_tensor, g_tensor, update_eps=0.2)
-                        # feed the actions into the environment
-                        obs_new, reward, done, info = self.env.step(action)
-                        # append rollouts
-                        ep_obs.append(obs.copy())
-                        ep_g.append(g.copy())
-                        ep_actions.append(action)
-                        obs = obs_new
-                    ep_obs.append(obs.copy())
-                    mb_obs.append(ep_obs)
-                    mb_g.append(ep_g)
-                    mb_actions.append(ep_actions)
-                # convert them into arrays
-                mb_obs = np.array(mb_obs)
-                mb_g = np.array(mb_g)
-                mb_actions = np.array(mb_actions)
+                # the rollouts of the cycle are played in lockstep, one forward for all of them
+                mb_obs, mb_actions = [], []
+                # reset the rollouts
+                obs = self.vec_env.reset()
+                g = self.vec_env.goals.copy()
+                g_tensor = self._preproc_ids(g)
+                # start to collect samples
+                for t in range(self.env_params['max_timesteps']):
+                    with torch.no_grad():
+                        actions = self.act_e_greedy_batch(self._preproc_ids(obs), g_tensor, update_eps=0.2)
+                    # feed the actions into the environment
+                    obs_new, rewards, dones, info = self.vec_env.step(actions)
+                    # append rollouts
+                    mb_obs.append(obs)
+                    mb_actions.append(actions)
+                    obs = obs_new
+                mb_obs.append(obs)
+                # convert them into arrays, one hot only for the buffer
+                mb_obs = self.vec_env.onehot(np.stack(mb_obs, axis=1))
+                mb_g = self.vec_env.onehot(np.repeat(g[:, None], self.env_params['max_timesteps'], axis=1))
+                mb_actions = np.stack(mb_actions, axis=1)
                 # store the episodes
                 self.buffer.store_episode([mb_obs, mb_g, mb_actions])
 
@@ -122,6 +122,13 @@ class DQNAgent:
             g_tensor = g_tensor.cuda()
         return g_tensor
 
+    def _preproc_ids(self, ids):
+        # integer states of the vector env to the one hot inputs of the networks
+        ids_tensor = torch.as_tensor(ids, dtype=torch.long)
+        if self.args.cuda:
+            ids_tensor = ids_tensor.cuda()
+        return F.one_hot(ids_tensor, self.env.state_space).float()
+
     def get_policy(self, g, obs=None, policy_type='boltzmann', temp=1, eps=0.01, target_network=False):
         if obs is None:
             obs = torch.eye(self.env.state_space)  # S x S
@@ -146,6 +153,12 @@ class DQNAgent:
     def act_e_greedy(self, obs, g, update_eps=0.2):
         return random.randrange(self.env_params['action']) if random.random() < update_eps else self.act(obs, g).item()
 
+    # Acts with an epsilon-greedy policy for a batch of states
+    def act_e_greedy_batch(self, obs, g, update_eps=0.2):
+        actions = self.act(obs, g).cpu().numpy()
+        explore = np.random.rand(len(actions)) < update_eps
+        return np.where(explore, np.random.randint(self.env_params['action'], size=len(actions)), actions)
+
     # soft update
     def _soft_update_target_network(self, target, source):
         for target_param, param in zip(target.parameters(), source.parameters()):
@@ -192,28 +205,21 @@ class DQNAgent:
 
     # do the evaluation
     def _eval_agent(self):
-        total_perf = []
+        # sample the test goals first, their optimal q values are then solved together and memoized
+        goal_ids, goals = [], []
         for _ in range(self.args.n_test_rollouts):
-            init_obs = self.env.reset()
-            g = self.env.goal
-            R = torch.tensor(self.env.R, dtype=torch.float32)
-            P = torch.tensor(self.env.P, dtype=torch.float32)
-            if self.args.cuda:
-                R = R.cuda()
-                P = P.cuda()
-            opt_q = value_iteration(R, P, self.args.gamma, atol=1e-8, max_iteration=5000)
-            opt_perf = opt_q[self.env.reachable_states].max(1)[0].mean()
-
-            g_tensor = self._preproc_g(g)
-            pi = self.get_policy(g_tensor, policy_type='boltzmann', temp=0.1)
-            sr_pi = compute_successor_reps(P, pi, self.args.gamma)
-            q_pi = torch.matmul(sr_pi, R.t().reshape(self.env.state_space * self.env.action_space))
-            q_pi = q_pi.reshape(self.env.action_space, self.env.state_space).t()
-
-            # score = torch.dot(q_pi[init_obs.argmax()], pi[init_obs.argmax()])
-            score = torch.einsum('sa, sa -> s', q_pi, pi)[self.env.reachable_states].mean()
-            score /= opt_perf
-            total_perf.append(score.item())
-
-        total_perf = np.array(total_perf)
+            self.env.reset()
+            goal_ids.append(np.asarray(self.env.goal_id).item())
+            goals.append(self.env.goal)
+        opt_qs = self.optimal_q(goal_ids)
+        opt_perf = opt_qs[:, self.env.reachable_states].max(-1)[0].mean(-1)
+
+        with torch.no_grad():
+            pis = torch.stack([self.get_policy(self._preproc_g(g), policy_type='boltzmann', temp=0.1) for g in goals])
+            # q of every policy under the reward of its goal, all solved together
+            q_pis = policy_evaluation(self.optimal_q.rewards(goal_ids), self.optimal_q.P, pis, self.args.gamma)
+
+        scores = (q_pis * pis).sum(-1)[:, self.env.reachable_states].mean(-1)
+        scores /= opt_perf
+        total_perf = scores.cpu().numpy()
         return np.mean(total_perf)
\ No newline at end of file
@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 import os
 from datetime import datetime
 import numpy as np
@@ -6,7 +7,8 @@ import random
 import pickle
 import csv
 from grid_modules.replay_buffer import ReplayBuffer
-from grid_modules.mdp_utils import extract_policy, value_iteration, compute_successor_reps
+from grid_modules.gridworld.env import VectorGridWorldMDP
+from grid_modules.mdp_utils import extract_policy, policy_evaluation, OptimalQTable
 from discrete_action_robots_modules.models import ForwardMap, BackwardMap
 # from grid_modules.models import ForwardMap, BackwardMap
 
@@ -57,11 +59,16 @@ class FBAgent:
         self.f_optim = torch.optim.Adam(f_params, lr=self.args.lr)
         self.b_optim = torch.optim.Adam(b_params, lr=self.args.lr)
         self.fb_optim = torch.optim.Adam(f_params + b_params, lr=self.args.lr)
+        # optimal q values of the test goals, for the evaluation
+        self.optimal_q = OptimalQTable(self.env.P.to_torch(device='cuda' if self.args.cuda else None),
+                                       self.args.gamma, atol=1e-8, max_iteration=5000)
         # self.backward_optim = torch.optim.Adam(self.backward_network.parameters(), lr=self.args.lr_backward)
         # her sampler
 
         # create the replay buffer
         self.buffer = ReplayBuffer(self.args.buffer_size)
+        # the rollouts of a cycle are collected together
+        self.vec_env = VectorGridWorldMDP(env, self.args.num_rollouts_per_cycle, seed=self.args.seed)
 
         if args.save_dir is not None:
             if not os.path.exists(self.args.save_dir):
@@ -87,33 +94,30 @@ class FBAgent:
         # start to collect samples
         for epoch in range(self.args.n_epochs):
             for _ in range(self.args.n_cycles):
-                for _ in range(self.args.num_rollouts_per_cycle):
-                    # reset the rollouts
-                    # reset the environment
-                    obs = self.env.reset()
-                    g = self.env.goal
-                    if self.args.w_sampling == 'goal_oriented':
-                        g_tensor = self._preproc_g(g)
-                        with torch.no_grad():
-                            w = self.backward_network(g_tensor)
-                    elif self.args.w_sampling == 'uniform_ball':
-                        w = self.sample_uniform_ball(1)
-                    elif self.args.w_sampling == 'cauchy_ball':
-                        w = self.sample_cauchy_ball(1)
-                    # start to collect samples
-                    for t in range(self.env_params['max_timesteps']):
-                        with torch.no_grad():
-                            obs_tensor = self._preproc_o(obs)
-                            action = self.act_e_greedy(obs_tensor, w, update_eps=self.args.update_eps)
-                        # feed the actions into the environment
-                        obs_new, reward, done, info = self.env.step(action)
-                        # add transition
-                        self.buffer.add(obs, g, action, reward, obs_new, done)
-                        if done:
-                            obs = self.env.reset()
-                            g = self.env.goal
-                        else:
-                            obs = obs_new
+                # the rollouts of the cycle are played in lockstep, one forward for all of them
+                # reset the rollouts
+                obs = self.vec_env.reset()
+                g = self.vec_env.goals.copy()
+                if self.args.w_sampling == 'goal_oriented':
+                    with torch.no_grad():
+                        w = self.backward_network(self._preproc_ids(g))
+                elif self.args.w_sampling == 'uniform_ball':
+                    w = self.sample_uniform_ball(self.vec_env.num_envs)
+                elif self.args.w_sampling == 'cauchy_ball':
+                    w = self.sample_cauchy_ball(self.vec_env.num_envs)
+                # start to collect samples
+                for t in range(self.env_params['max_timesteps']):
+                    with torch.no_grad():
+                        actions = self.act_e_greedy_batch(self._preproc_ids(obs), w, update_eps=self.args.update_eps)
+                    # feed the actions into the environment
+                    obs_new, rewards, dones, info = self.vec_env.step(actions)
+                    # add transitions, the states are stored as integers
+                    for i in range(self.vec_env.num_envs):
+                        self.buffer.add(obs[i], g[i], actions[i], rewards[i], obs_new[i], dones[i])
+                    obs = obs_new
+                    if dones.any():
+                        obs = self.vec_env.reset(np.where(dones)[0])
+                        g = self.vec_env.goals.copy()
                 for _ in range(self.args.n_batches):
                     # train the network
                     fb_loss, entropy = self._update_network()
@@ -172,6 +176,13 @@ class FBAgent:
             g_tensor = g_tensor.cuda()
         return g_tensor
 
+    def _preproc_ids(self, ids):
+        # integer states, from the vector env or the replay buffer, to the one hot inputs of the networks
+        ids_tensor = torch.as_tensor(ids, dtype=torch.long)
+        if self.args.cuda:
+            ids_tensor = ids_tensor.cuda()
+        return F.one_hot(ids_tensor, self.env.state_space).float()
+
     def get_policy(self, w, obs=None, policy_type='boltzmann', temp=1, eps=0.01, target_network=False):
         if obs is None:
             obs = torch.eye(self.env.state_space)  # S x S
@@ -227,6 +238,12 @@ class FBAgent:
     def act_e_greedy(self, obs, g, update_eps=0.2):
         return random.randrange(self.env_params['action']) if random.random() < update_eps else self.act(obs, g).item()
 
+    # Acts with an epsilon-greedy policy for a batch of states
+    def act_e_greedy_batch(self, obs, w, update_eps=0.2):
+        actions = self.act(obs, w).cpu().numpy()
+        explore = np.random.rand(len(actions)) < update_eps
+        return np.where(explore, np.random.randint(self.env_params['action'], size=len(actions)), actions)
+
     # soft update
     def _soft_update_target_network(self, target, source):
         for target_param, param in zip(target.parameters(), source.parameters()):
@@ -243,18 +260,14 @@ class FBAgent:
         other_transitions = self.buffer.sample(self.args.batch_size)
 
         # transfer them into the tensor
-        obs_tensor = torch.tensor(transitions['obs'], dtype=torch.float32)
-        g_tensor = torch.tensor(transitions['g'], dtype=torch.float32)
-        obs_next_tensor = torch.tensor(transitions['obs_next'], dtype=torch.float32)
+        obs_tensor = self._preproc_ids(transitions['obs'])
+        g_tensor = self._preproc_ids(transitions['g'])
+        obs_next_tensor = self._preproc_ids(transitions['obs_next'])
         actions_tensor = torch.tensor(transitions['action'], dtype=torch.long)
-        obs_other_tensor = torch.tensor(other_transitions['obs'], dtype=torch.float32)
+        obs_other_tensor = self._preproc_ids(other_transitions['obs'])
         actions_other_tensor = torch.tensor(other_transitions['action'], dtype=torch.long)
         if self.args.cuda:
-            obs_tensor = obs_tensor.cuda()
-            g_tensor = g_tensor.cuda()
-            obs_next_tensor = obs_next_tensor.cuda()
             actions_tensor = actions_tensor.cuda()
-            obs_other_tensor = obs_other_tensor.cuda()
             actions_other_tensor = actions_other_tensor.cuda()
 
         if self.args.w_sampling == 'goal_oriented':
@@ -330,55 +343,39 @@ class FBAgent:
 
     # do the evaluation
     def _eval_agent(self, num_gpi=20):
-        total_perf = []
-        total_gpi_perf = []
+        # sample the test goals first, their optimal q values are then solved together and memoized
+        goal_ids, goals = [], []
         for _ in range(self.args.n_test_rollouts):
-            init_obs = self.env.reset()
-            g = self.env.goal
-            R = torch.tensor(self.env.R, dtype=torch.float32)
-            P = torch.tensor(self.env.P, dtype=torch.float32)
-            if self.args.cuda:
-                R = R.cuda()
-                P = P.cuda()
-            opt_q = value_iteration(R, P, self.args.gamma, atol=1e-8, max_iteration=5000)
-            opt_perf = opt_q[self.env.reachable_states].max(1)[0].mean()
-
-            g_tensor = self._preproc_g(g)
-            w = self.backward_network(g_tensor)
-            pi = self.get_policy(w, policy_type='boltzmann', temp=1)
-            sr_pi = compute_successor_reps(P, pi, self.args.gamma)
-            q_pi = torch.matmul(sr_pi, R.t().reshape(self.env.state_space * self.env.action_space))
-            q_pi = q_pi.reshape(self.env.action_space, self.env.state_space).t()
-
-            # score = torch.dot(q_pi[init_obs.argmax()], pi[init_obs.argmax()])
-            score = torch.einsum('sa, sa -> s', q_pi, pi)[self.env.reachable_states].mean()
-            score /= opt_perf
-            total_perf.append(score.item())
-
-            # with GPI
-
-            if self.args.w_sampling == 'goal_oriented':
-                transitions = self.buffer.sample(num_gpi)
-                g_train = transitions['g']
-                g_train_tensor = torch.tensor(g_train, dtype=torch.float32)
-                if self.args.cuda:
-                    g_train_tensor = g_train_tensor.cuda()
-                w_train = self.backward_network(g_train_tensor)
-            elif self.args.w_sampling == 'uniform_ball':
-                w_train = self.sample_uniform_ball(num_gpi)
-            elif self.args.w_sampling == 'cauchy_ball':
-                w_train = w + self.sample_cauchy_ball(num_gpi) / np.sqrt(self.args.embed_dim)
-
-            gpi_pi = self.get_gpi_policy(w_train, w, policy_type='boltzmann', temp=1)
-            sr_gpi_pi = compute_successor_reps(P, gpi_pi, self.args.gamma)
-            q_gpi_pi = torch.matmul(sr_gpi_pi, R.t().reshape(self.env.state_space * self.env.action_space))
-            q_gpi_pi = q_gpi_pi.reshape(self.env.action_space, self.env.state_space).t()
-
-            # gpi_score = torch.dot(q_gpi_pi[init_obs.argmax()], gpi_pi[init_obs.argmax()])
-            gpi_score = torch.einsum('sa, sa -> s', q_gpi_pi, gpi_pi)[self.env.reachable_states].mean()
-            gpi_score /= opt_perf
-            total_gpi_perf.append(gpi_score.item())
-
-        total_perf = np.array(total_perf)
-        total_gpi_perf = np.array(total_gpi_perf)
+            self.env.reset()
+            goal_ids.append(np.asarray(self.env.goal_id).item())
+            goals.append(self.env.goal)
+        opt_qs = self.optimal_q(goal_ids)
+        opt_perf = opt_qs[:, self.env.reachable_states].max(-1)[0].mean(-1)
+
+        pis, gpi_pis = [], []
+        with torch.no_grad():
+            for g in goals:
+                g_tensor = self._preproc_g(g)
+                w = self.backward_network(g_tensor)
+                pis.append(self.get_policy(w, policy_type='boltzmann', temp=1))
+
+                # with GPI
+
+                if self.args.w_sampling == 'goal_oriented':
+                    transitions = self.buffer.sample(num_gpi)
+                    g_train_tensor = self._preproc_ids(transitions['g'])
+                    w_train = self.backward_network(g_train_tensor)
+                elif self.args.w_sampling == 'uniform_ball':
+                    w_train = self.sample_uniform_ball(num_gpi)
+                elif self.args.w_sampling == 'cauchy_ball':
+                    w_train = w + self.sample_cauchy_ball(num_gpi) / np.sqrt(self.args.embed_dim)
+                gpi_pis.append(self.get_gpi_policy(w_train, w, policy_type='boltzmann', temp=1))
+
+            # q of every policy under the reward of its goal, all solved together
+            pis = torch.stack([torch.stack(pis), torch.stack(gpi_pis)])  # 2 x n_test_rollouts x S x A
+            q_pis = policy_evaluation(self.optimal_q.rewards(goal_ids), self.optimal_q.P, pis, self.args.gamma)
+
+        scores = (q_pis * pis).sum(-1)[:, :, self.env.reachable_states].mean(-1)
+        scores /= opt_perf
+        total_perf, total_gpi_perf = scores.cpu().numpy()
         return np.mean(total_perf), np.mean(total_gpi_perf)
\ No newline at end of file
@@ -3,12 +3,14 @@ Utilities to help build more complex grid worlds.
 """
 import numpy as np
 from grid_modules.gridworld.helper_utilities import (build_simple_grid,
+                                                     add_walls,
                                                      get_possible_actions,
                                                      check_can_take_action,
                                                      get_state_after_executing_action,
                                                      flatten_state,
                                                      unflatten_state)
 from grid_modules.gridworld.env import GridWorldMDP
+from grid_modules.transitions import SparseTransitions
 
 
 class TransitionMatrixBuilder(object):
@@ -20,7 +22,9 @@ class TransitionMatrixBuilder(object):
         self.grid_size = grid_size
         self.action_space = action_space
         self.state_space = grid_size * grid_size + int(has_terminal_state)
-        self._P = np.zeros((self.state_space, self.action_space, self.state_space))
+        # everything stays in place until a grid is added
+        self._P = SparseTransitions(np.tile(np.arange(self.state_space)[:, None, None], (1, self.action_space, 1)),
+                                    np.ones((self.state_space, self.action_space, 1)))
         self.grid_added = False
         self.P_modified = False
 
@@ -51,46 +55,23 @@ class TransitionMatrixBuilder(object):
         :param tuple_location: (x,y) location of the wall
         :return:
         """
-        target_state = flatten_state(tuple_location, self.grid_size, self.state_space)
-        target_state = target_state.argmax()
-        # find all the ways to go to "target_state"
-        # from_states contains states that can lead you to target_state by executing from_action
-        from_states, from_actions = np.where(self._P[:, :, target_state] != 0)
-
-        # get the transition probability distributions that go from s--> t via some action
-        transition_probs_from = self._P[from_states, from_actions, :]
-        # TODO: optimize this loop
-        for i, from_state in enumerate(from_states): # enumerate over states
-            tmp = transition_probs_from[i, target_state] # get the prob of transitioning
-            transition_probs_from[i, target_state] = 0 # set it to zero
-            transition_probs_from[i, from_state] += tmp # add the transition prob to staying in the same place
-
-        self._P[from_states, from_actions, :] = transition_probs_from
-
-        # Get the probability of going to any state for all actions from target_state.
-        transition_probs_from_wall = self._P[target_state, :, :]
-        for i, probs_from_action in enumerate(transition_probs_from_wall):
-            # Reset the probabilities.
-            transition_probs_from_wall[i, :] = 0.0
-            # Set the probability of going to the target state to be 1.0
-            transition_probs_from_wall[i, target_state] = 1.0
-        # Now set the probs of going to any state from target state as above (i.e only targets).
-        self._P[target_state, :, :] = transition_probs_from_wall
-
-        # renormalize and update transition matrix.
-        normalization = self._P.sum(2)
-        # normalization[normalization == 0] = 1
-        normalization = 1/normalization
-        self._P = (self._P * np.repeat(normalization, self._P.shape[0]).reshape(*self._P.shape))
-
-        assert np.allclose(self._P.sum(2), 1), 'Normalization did not occur correctly: {}'.format(self._P.sum(2))
-        assert np.allclose(self._P[target_state, :, target_state], 1.0), 'All actions from wall should lead to wall!'
+        self.add_walls_at([tuple_location])
+
+    def add_walls_at(self, tuple_locations):
+        """
+        Add blockades at all these positions in one pass
+        :param tuple_locations: list of (x,y) locations of the walls
+        :return:
+        """
+        target_states = [self.grid_size * x + y for (x, y) in tuple_locations]
+        add_walls(self._P, target_states)
+        assert self._P.is_stochastic(), 'Normalization did not occur correctly: {}'.format(self._P.probs.sum(2))
         self._P_modified = True
 
     @property
     def P(self, nocopy=False):
         """
-        Returns a new array with the transition matrix built so far.
+        Returns a new SparseTransitions with the transition matrix built so far.
         :param nocopy:
         :return:
         """
@@ -3,7 +3,8 @@ A simple grid world environment
 """
 
 import numpy as np
-from grid_modules.common import MDP
+from grid_modules.common import Env, MDP
+from grid_modules.exceptions import InvalidActionError, EpisodeDoneError
 from .helper_utilities import flatten_state, unflatten_state, get_reachable_id,\
     from_xy_to_id, from_id_to_xy
 
@@ -79,4 +80,74 @@ class GridWorldMDP(MDP):
         return state, reward, done, info
 
     def set_current_state_to(self, tuple_state):
-        return super().set_current_state_to(self.flatten_state(tuple_state).argmax())
\ No newline at end of file
+        return super().set_current_state_to(self.flatten_state(tuple_state).argmax())
+
+
+class VectorGridWorldMDP(Env):
+    def __init__(self, mdp, num_envs, seed=1337):
+        """
+        num_envs independent episodes of a GridWorldMDP stepped in lockstep.
+        States, goals and actions are integer ids, the next states are drawn from the cumulative distribution
+        of the (s, a) slots of the sparse P, so a step costs O(num_envs x K) whatever the size of the grid.
+        The reward is 1 in the goal state, as in GridWorldMDP.reset, use onehot() for the network inputs.
+        :param mdp: the GridWorldMDP giving P, gamma, the initial distribution and the reachable goals
+        :param num_envs: the number of episodes played at once
+        """
+        super().__init__(seed)
+        self.num_envs = num_envs
+        self.state_space = mdp.state_space
+        self.action_space = mdp.action_space
+        self.gamma = mdp.gamma
+        self.p0 = mdp.p0
+        self.reachable_states = np.array(mdp.reachable_states)
+        self.terminal_states = np.array(mdp.terminal_states, dtype=np.int64)
+        self.next_states = mdp.P.next_states
+        self.cum_probs = np.cumsum(mdp.P.probs, axis=-1)
+        self.states = np.zeros(num_envs, dtype=np.int64)
+        self.goals = np.zeros(num_envs, dtype=np.int64)
+        self.dones = np.zeros(num_envs, dtype=bool)
+
+    def reset(self, idx=None):
+        """
+        Draws a start state and a goal for the envs idx (all of them by default).
+        :return: the states of all the envs
+        """
+        idx = np.arange(self.num_envs) if idx is None else np.asarray(idx)
+        self.states[idx] = self.rng.choice(self.state_space, size=len(idx), p=self.p0)
+        self.goals[idx] = self.rng.choice(self.reachable_states, size=len(idx))
+        self.dones[idx] = False
+        return self.states.copy()
+
+    def step(self, actions):
+        """
+        :param actions: integer array with one action per env.
+        :return:
+        """
+        actions = np.asarray(actions)
+        if actions.shape != (self.num_envs,) or not np.issubdtype(actions.dtype, np.integer) \
+                or np.any((actions < 0) | (actions >= self.action_space)):
+            raise InvalidActionError('Invalid actions {}. There must be one integer between 0 and {} per env'.format(
+                actions, self.action_space - 1))
+        if np.any(self.dones):
+            raise EpisodeDoneError('Episodes {} have terminated. Use .reset(idx) to restart them.'.format(
+                np.where(self.dones)[0]))
+
+        # as in MDP.step, an episode ends when leaving a terminal state
+        # and the reward is the one of the state left
+        self.dones = np.isin(self.states, self.terminal_states)
+        rewards = (self.states == self.goals).astype(np.float32)
+
+        # sample the next states, the first slot whose cumulative probability is above a uniform draw
+        cum_probs = self.cum_probs[self.states, actions]  # N x K
+        slots = (self.rng.rand(self.num_envs, 1) >= cum_probs).sum(-1)
+        slots = np.minimum(slots, cum_probs.shape[-1] - 1)  # rounding of the last cumulative probability
+        self.states = self.next_states[self.states, actions, slots]
+
+        return self.states.copy(), rewards, self.dones.copy(), {'gamma': self.gamma}
+
+    def onehot(self, ids):
+        """One hot vectors of integer states, of shape ids.shape x |S|."""
+        ids = np.asarray(ids)
+        onehot = np.zeros(ids.shape + (self.state_space,), dtype=np.float32)
+        np.put_along_axis(onehot, ids[..., None], 1, axis=-1)
+        return onehot
@@ -1,6 +1,7 @@
 import numpy as np
 from grid_modules.gridworld.actions import LEFT, RIGHT, UP, DOWN, STAY
 from grid_modules.exceptions import InvalidActionError
+from grid_modules.transitions import SparseTransitions
 n_actions = 5
 
 
@@ -31,6 +32,7 @@ def from_xy_to_id(state_loc, size):
 
 
 def get_reachable_id(state_space, size, wall_locs):
+    wall_locs = set(wall_locs)
     return [s for s in range(state_space) if from_id_to_xy(s, size) not in wall_locs]
 
 
@@ -129,6 +131,8 @@ def build_simple_grid(size=5, terminal_states=[], p_success=1):
     A terminal state is added if len(terminal_states) > 0 and will return matrix of
     size (|S|+1)x|A|x(|S|+1)
     Moving into walls does nothing.
+    The matrix is returned as SparseTransitions with one slot per action:
+    slot k holds where executing action k leads and the probability of ending up executing it.
     :param size: size of the grid world
     :param terminal_state: the location of terminal states: a list of (x, y) tuples
     :param p_success: the probabilty that an action will be successful.
@@ -140,52 +144,59 @@ def build_simple_grid(size=5, terminal_states=[], p_success=1):
     grid_states = n_states # the number of entries of the state vector
                            # corresponding to the grid itself.
     if len(terminal_states) > 0: n_states += 1 # add an entry to state vector for terminal state
-    terminal_states = list(map(lambda tupl: int(size * tupl[0] + tupl[1]), terminal_states))
-
-    # this helper function creates the state transition list for
-    # taking an action in a state
-    def create_state_list_for_action(state_idx, action):
-        transition_probs = np.zeros(n_states)
-        if state_idx in terminal_states:
-            # no matter what action you take you should go to the absorbing state
-            transition_probs[-1] = 1
-        elif state_idx == n_states-1 and len(terminal_states) > 0:
-            # absorbing state, you should just transition back here whatever action you take.
-            transition_probs[-1] = 1
-
-        elif action in [LEFT, RIGHT, UP, DOWN, STAY]:
-            # valid action, now see if we can actually execute this action
-            # in this state:
-            # TODO: distinguish between capability of slipping and taking wrong action vs failing to execute action.
-            if check_can_take_action(action, state_idx, size):
-                # yes we can
-                possible_actions = get_possible_actions(state_idx, size)
-                if action in possible_actions:
-                    transition_probs[get_state_after_executing_action(action, state_idx, size)] = p_success
-                    possible_actions.remove(action)
-                for other_action in possible_actions:
-                    transition_probs[get_state_after_executing_action(other_action, state_idx, size)] = p_fail/len(possible_actions)
-
-            else:
-                possible_actions = get_possible_actions(state_idx, size)
-
-                for other_action in possible_actions:
-                    transition_probs[get_state_after_executing_action(other_action, state_idx, size)] = p_fail/len(possible_actions)
-                transition_probs[state_idx] += p_success  # cant take action, stay in same place
-        else:
-            raise InvalidActionError('Invalid action {} in the 2D gridworld'.format(action))
-        return transition_probs
-
-    P = np.zeros((n_states, n_actions, n_states))
-    for s in range(n_states):
-        for a in range(n_actions):
-            P[s, a, :] = create_state_list_for_action(s, a)
-    #
-    # T = {s: {a: create_state_list_for_action(s, a) for a in range(n_actions)} for s in range(n_states)}
-    # T[0][LEFT][0], T[0][RIGHT][0], T[0][DOWN][0], T[0][UP][0] = 1, 1, 1, 1
-    # T[15][LEFT][15], T[15][RIGHT][15], T[15][DOWN][15], T[15][UP][15] = 1, 1, 1, 1
+    terminal_states = np.array([int(size * tupl[0] + tupl[1]) for tupl in terminal_states], dtype=np.int64)
+
+    # which actions can be executed in every cell and where they lead, same as check_can_take_action
+    # and get_state_after_executing_action for all states at once
+    grid = np.arange(grid_states)
+    row, col = grid // size, grid % size
+    can_take = np.ones((grid_states, n_actions), dtype=bool)
+    can_take[:, LEFT] = col > 0
+    can_take[:, RIGHT] = col < size - 1
+    can_take[:, UP] = row > 0
+    can_take[:, DOWN] = row < size - 1
+    offsets = np.zeros(n_actions, dtype=np.int64)
+    offsets[LEFT], offsets[RIGHT], offsets[UP], offsets[DOWN] = -1, 1, -size, size
+    # cant take action: its slot stays on the state, i.e. stay in same place
+    outcomes = np.where(can_take, grid[:, None] + offsets, grid[:, None])  # S x K
+
+    next_states = np.empty((n_states, n_actions, n_actions), dtype=np.int64)
+    probs = np.zeros((n_states, n_actions, n_actions))
+    next_states[:grid_states] = outcomes[:, None, :]
+    # TODO: distinguish between capability of slipping and taking wrong action vs failing to execute action.
+    # p_fail is spread over the other executable actions
+    n_other = np.maximum(can_take.sum(1, keepdims=True) - can_take, 1)  # S x A
+    probs[:grid_states] = can_take[:, None, :] * (p_fail / n_other)[:, :, None]
+    probs[:grid_states, np.arange(n_actions), np.arange(n_actions)] = p_success
+
+    if len(terminal_states) > 0:
+        # no matter what action you take you should go to the absorbing state,
+        # and from the absorbing state you should just transition back there.
+        absorbing = np.append(terminal_states, n_states - 1)
+        next_states[absorbing] = absorbing[:, None, None]
+        next_states[absorbing, :, 0] = n_states - 1
+        probs[absorbing] = 0
+        probs[absorbing, :, 0] = 1
+    return SparseTransitions(next_states, probs)
+
+
+def add_walls(P, wall_states):
+    """
+    Turns wall_states into walls in place, all of them in one pass:
+    moving into a wall does nothing and all actions from a wall lead to the wall.
+    :param P: SparseTransitions
+    :param wall_states: list of integer states
+    :return:
+    """
+    wall_states = np.asarray(wall_states, dtype=np.int64)
+    is_wall = np.zeros(P.state_space, dtype=bool)
+    is_wall[wall_states] = True
+    # the prob of going into a wall is added to staying in the same place
+    from_states = np.broadcast_to(np.arange(P.next_states.shape[0])[:, None, None], P.next_states.shape)
+    into_wall = is_wall[P.next_states]
+    P.next_states[into_wall] = from_states[into_wall]
+
+    P.next_states[wall_states] = wall_states[:, None, None]
+    P.probs[wall_states] = 0.0
+    P.probs[wall_states, :, 0] = 1.0
     return P
-
-
-def add_walls():
-    pass
\ No newline at end of file
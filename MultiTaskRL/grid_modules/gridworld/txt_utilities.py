@@ -1,5 +1,6 @@
 """Utilities to help load gridworlds from a text file with random goal.
 """
+import numpy as np
 from grid_modules.gridworld.helper_utilities import flatten_state
 from grid_modules.gridworld.builder_tools import TransitionMatrixBuilder, create_reward_matrix
 from grid_modules.gridworld.env import GridWorldMDP
@@ -58,8 +59,7 @@ def build_gridworld_from_char_matrix(char_matrix, p_success=1, seed=2017,
 
     tmb = transition_matrix_builder_cls(grid_size,  has_terminal_state=False)
     tmb.add_grid(terminal_states=[], p_success=p_success)
-    for (r, c) in wall_locs:
-        tmb.add_wall_at((r, c))
+    tmb.add_walls_at(wall_locs)
     P = tmb.P
     R = create_reward_matrix(P.shape[0], grid_size, reward_spec, action_space=5)
     p0 = flatten_state(start_loc, grid_size, R.shape[0])
@@ -68,3 +68,41 @@ def build_gridworld_from_char_matrix(char_matrix, p_success=1, seed=2017,
                       size=grid_size, wall_locs=wall_locs,
                       goal_loc=goal_loc, seed=seed)
     return gw
+
+
+def open_room(size):
+    """
+    Char matrix of a size x size room without inner walls, starting in the bottom left corner.
+    """
+    rows = ['#' * size] + ['#' + ' ' * (size - 2) + '#' for _ in range(size - 2)] + ['#' * size]
+    rows[-2] = '#s' + ' ' * (size - 3) + '#'
+    return get_char_matrix(rows)
+
+
+def rooms(size, room_size=10):
+    """
+    Char matrix of a grid of room_size rooms with a door in the middle of every wall.
+    """
+    char_matrix = [[' '] * size for _ in range(size)]
+    for i in range(size):
+        for j in range(size):
+            if i % room_size == 0 or j % room_size == 0 or i == size - 1 or j == size - 1:
+                char_matrix[i][j] = '#'
+    for i in range(room_size // 2, size - 1, room_size):
+        for j in range(room_size, size - 1, room_size):
+            char_matrix[i][j] = ' '
+            char_matrix[j][i] = ' '
+    char_matrix[1][1] = 's'
+    return char_matrix
+
+
+def maze(size, wall_fraction=0.3, seed=0):
+    """
+    Char matrix with a wall on each inner cell with probability wall_fraction.
+    """
+    rng = np.random.RandomState(seed)
+    walls = rng.rand(size, size) < wall_fraction
+    walls[0, :] = walls[-1, :] = walls[:, 0] = walls[:, -1] = True
+    char_matrix = [['#' if wall else ' ' for wall in row] for row in walls]
+    char_matrix[1][1] = 's'
+    return char_matrix
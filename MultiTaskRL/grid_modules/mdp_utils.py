@@ -1,5 +1,13 @@
 import torch
 import torch.nn.functional as F
+from grid_modules.transitions import SparseTransitions
+
+
+def expected_value(P, v):
+    # E[v(s') | s, a], P is either a dense S x A x S tensor or SparseTransitions holding tensors
+    if isinstance(P, SparseTransitions):
+        return P.expected(v)
+    return torch.einsum('ijk, ...k->...ij', P, v)
 
 
 def value_iteration(R, P, gamma, atol=0.0001, max_iteration=1000):
@@ -7,12 +15,64 @@ def value_iteration(R, P, gamma, atol=0.0001, max_iteration=1000):
     for i in range(max_iteration):
         q_old = q
         v = torch.max(q, dim=1)[0]
-        q = R + gamma * torch.einsum('ijk, k->ij', P, v)
+        q = R + gamma * expected_value(P, v)
         if torch.allclose(q, q_old, atol=atol):
             break
     return q
 
 
+def batched_value_iteration(R, P, gamma, atol=0.0001, max_iteration=1000):
+    """
+    value_iteration for a stack of rewards R (G x S x A) sharing the same P.
+    Each reward stops being iterated once its own q stopped moving (same test as torch.allclose),
+    so the slow goals do not keep the solved ones running.
+    """
+    q = torch.zeros_like(R)
+    active = torch.arange(R.shape[0], device=R.device)
+    for i in range(max_iteration):
+        q_old = q[active]
+        v = torch.max(q_old, dim=-1)[0]
+        q_new = R[active] + gamma * expected_value(P, v)
+        q[active] = q_new
+        converged = ((q_new - q_old).abs() <= atol + 1e-5 * q_old.abs()).flatten(1).all(1)
+        active = active[~converged]
+        if len(active) == 0:
+            break
+    return q
+
+
+class OptimalQTable(object):
+    def __init__(self, P, gamma, atol=1e-8, max_iteration=5000):
+        """
+        Memoized optimal q values of the goal reaching rewards of a grid world (reward 1 at the goal state
+        whatever the action, as in GridWorldMDP.set_goal). The goals are the finitely many reachable states,
+        so each one is solved once, the ones missing from a query all in the same batched_value_iteration.
+        :param P: the transition matrix as tensors, dense or SparseTransitions
+        """
+        self.P = P
+        self.gamma = gamma
+        self.atol = atol
+        self.max_iteration = max_iteration
+        self.state_space, self.action_space = P.shape[:2]
+        self.device = P.probs.device if isinstance(P, SparseTransitions) else P.device
+        self.q = {}
+
+    def rewards(self, goal_ids):
+        R = torch.zeros(len(goal_ids), self.state_space, self.action_space, device=self.device)  # G x S x A
+        goal_ids = torch.as_tensor(goal_ids, dtype=torch.long, device=self.device)
+        R[torch.arange(len(goal_ids), device=self.device), goal_ids] = 1
+        return R
+
+    def __call__(self, goal_ids):
+        """The optimal q values of the goals, G x S x A."""
+        missing = sorted(set(goal_ids) - set(self.q))
+        if len(missing) > 0:
+            q = batched_value_iteration(self.rewards(missing), self.P, self.gamma, atol=self.atol,
+                                        max_iteration=self.max_iteration)
+            self.q.update(zip(missing, q))
+        return torch.stack([self.q[goal_id] for goal_id in goal_ids])
+
+
 def extract_policy(q, policy_type='boltzmann', temp=1, eps=0):
     action_space = q.shape[-1]
     if policy_type == 'boltzmann':
@@ -27,10 +87,62 @@ def extract_policy(q, policy_type='boltzmann', temp=1, eps=0):
 
 
 def compute_successor_reps(P, pi, gamma):
-    state_space, action_space = P.shape[:2]
-    P_pi = torch.einsum('sax, xu -> saxu', P, pi)  # S x A x S x A
-    P_pi = P_pi.transpose(0, 1).transpose(2, 3).reshape(state_space * action_space,
-                                                        state_space * action_space)
+    P_pi = policy_transitions(P, pi)
     Id = torch.eye(*P_pi.size(), out=torch.empty_like(P_pi))
     sr_pi = torch.inverse(Id - gamma * P_pi)
-    return sr_pi
\ No newline at end of file
+    return sr_pi
+
+
+def policy_evaluation(R, P, pi, gamma, solver='iterative', atol=1e-8, max_iteration=5000):
+    """
+    q_pi of the rewards R, i.e. the solution of (I - gamma P_pi) q = R, without the inverse of compute_successor_reps.
+    iterative: q <- R + gamma E[sum_u pi(u|s') q(s', u)], only ever touches P, so memory stays linear in |S||A|
+               with SparseTransitions. R (... x S x A) and pi (... x S x A) are broadcast, so many rewards and
+               policies are evaluated at once.
+    solve: torch.linalg.solve on the SA x SA matrix of a single policy pi, all the rewards R (... x S x A)
+           are solved together as the columns of the right hand side.
+    """
+    if solver == 'iterative':
+        q = torch.zeros(torch.broadcast_shapes(R.shape, pi.shape), dtype=R.dtype, device=R.device)
+        for i in range(max_iteration):
+            q_old = q
+            v = (pi * q).sum(-1)
+            q = R + gamma * expected_value(P, v)
+            if torch.allclose(q, q_old, atol=atol):
+                break
+        return q
+    elif solver == 'solve':
+        state_space, action_space = P.shape[:2]
+        P_pi = policy_transitions(P, pi)
+        Id = torch.eye(*P_pi.size(), out=torch.empty_like(P_pi))
+        # columns indexed as a * S + s, like P_pi
+        r = R.reshape(-1, state_space, action_space).transpose(1, 2).reshape(-1, state_space * action_space)
+        q = torch.linalg.solve(Id - gamma * P_pi, r.t()).t()
+        return q.reshape(-1, action_space, state_space).transpose(1, 2).reshape(R.shape)
+    else:
+        raise NotImplementedError()
+
+
+def policy_transitions(P, pi):
+    # the SA x SA transition matrix between state-action pairs under pi, (a, s) -> (u, x) indexed as a * S + s -> u * S + x
+    state_space, action_space = P.shape[:2]
+    if isinstance(P, SparseTransitions):
+        return sparse_policy_transitions(P, pi)
+    P_pi = torch.einsum('sax, xu -> saxu', P, pi)  # S x A x S x A
+    return P_pi.transpose(0, 1).transpose(2, 3).reshape(state_space * action_space, state_space * action_space)
+
+
+def sparse_policy_transitions(P, pi):
+    # the same SA x SA matrix as the einsum above, scattered straight from the fan out arrays
+    # without the S x A x S x A intermediate
+    state_space, action_space, fan_out = P.next_states.shape
+    s = torch.arange(state_space, device=pi.device).reshape(-1, 1, 1, 1)
+    a = torch.arange(action_space, device=pi.device).reshape(1, -1, 1, 1)
+    u = torch.arange(action_space, device=pi.device).reshape(1, 1, 1, -1)
+    next_states = P.next_states.unsqueeze(-1)  # S x A x K x 1
+    rows = (a * state_space + s).expand(-1, -1, fan_out, action_space)
+    cols = u * state_space + next_states
+    values = P.probs.unsqueeze(-1) * pi[P.next_states]  # S x A x K x A
+    P_pi = torch.zeros(state_space * action_space, state_space * action_space, dtype=pi.dtype, device=pi.device)
+    P_pi.index_put_((rows.reshape(-1), cols.reshape(-1)), values.reshape(-1), accumulate=True)
+    return P_pi
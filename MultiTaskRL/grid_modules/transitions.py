@@ -0,0 +1,91 @@
+import numpy as np
+import torch
+
+"""
+Sparse transition matrix for the grid MDPs.
+From every (s, a) only a handful of states can be reached (at most 5 in a grid world), so instead of the dense
+|S| x |A| x |S| array P is kept as two |S| x |A| x K arrays: next_states[s, a, k] is reached with probability
+probs[s, a, k]. Unused slots have probability 0 and the same next state can appear in several slots,
+the probabilities then add up. Memory is linear in |S| and every product with P is a gather.
+
+"""
+
+
+class SparseTransitions(object):
+    def __init__(self, next_states, probs, state_space=None):
+        """
+        :param next_states: integer array |S| x |A| x K
+        :param probs: array |S| x |A| x K, numpy or torch, same type as next_states
+        :param state_space: number of states, |S| unless next states are outside of the states P is defined on
+        """
+        assert next_states.shape == probs.shape, 'next_states and probs must have the same shape'
+        self.next_states = next_states
+        self.probs = probs
+        self.state_space = next_states.shape[0] if state_space is None else state_space
+
+    @classmethod
+    def from_dense(cls, P):
+        """Compresses a dense |S| x |A| x |S| numpy array, K is the largest number of non zeros of a row."""
+        P = np.asarray(P)
+        fan_out = max(int((P != 0).sum(axis=2).max()), 1)
+        # stable sort puts the non zeros first, in the order of the states
+        next_states = np.argsort(P == 0, axis=2, kind='stable')[:, :, :fan_out]
+        probs = np.take_along_axis(P, next_states, axis=2)
+        return cls(next_states, probs, P.shape[2])
+
+    @property
+    def shape(self):
+        return (self.next_states.shape[0], self.next_states.shape[1], self.state_space)
+
+    @property
+    def fan_out(self):
+        return self.next_states.shape[2]
+
+    @property
+    def nbytes(self):
+        if isinstance(self.probs, torch.Tensor):
+            return self.next_states.element_size() * self.next_states.numel() + self.probs.element_size() * self.probs.numel()
+        return self.next_states.nbytes + self.probs.nbytes
+
+    def copy(self):
+        if isinstance(self.probs, torch.Tensor):
+            return SparseTransitions(self.next_states.clone(), self.probs.clone(), self.state_space)
+        return SparseTransitions(self.next_states.copy(), self.probs.copy(), self.state_space)
+
+    def to_dense(self):
+        state_space, action_space, fan_out = self.next_states.shape
+        if isinstance(self.probs, torch.Tensor):
+            P = torch.zeros(state_space * action_space, self.state_space, dtype=self.probs.dtype, device=self.probs.device)
+            P.scatter_add_(1, self.next_states.reshape(-1, fan_out), self.probs.reshape(-1, fan_out))
+            return P.reshape(state_space, action_space, self.state_space)
+        P = np.zeros((state_space, action_space, self.state_space), dtype=self.probs.dtype)
+        s, a = np.meshgrid(np.arange(state_space), np.arange(action_space), indexing='ij')
+        np.add.at(P, (s[:, :, None], a[:, :, None], self.next_states), self.probs)
+        return P
+
+    def to_torch(self, dtype=torch.float32, device=None):
+        return SparseTransitions(torch.as_tensor(self.next_states, dtype=torch.long, device=device),
+                                 torch.as_tensor(self.probs, dtype=dtype, device=device), self.state_space)
+
+    def is_stochastic(self, atol=1e-8):
+        if isinstance(self.probs, torch.Tensor):
+            return bool(torch.allclose(self.probs.sum(-1), torch.ones_like(self.probs[..., 0]), atol=atol))
+        return np.allclose(self.probs.sum(-1), 1, atol=atol)
+
+    def row(self, state, action):
+        """The reachable next states of (state, action) and their probabilities."""
+        return self.next_states[state, action], self.probs[state, action]
+
+    def expected(self, v):
+        """
+        E[v(s') | s, a] for a value function v of shape (..., |S|), numpy or torch like P.
+        Returns an array of shape (..., |S|, |A|).
+        """
+        return (v[..., self.next_states] * self.probs).sum(-1)
+
+
+def as_sparse(P):
+    # lets the MDPs and the builders take either a dense array or SparseTransitions
+    if isinstance(P, SparseTransitions):
+        return P
+    return SparseTransitions.from_dense(P)
@@ -0,0 +1,52 @@
+import numpy as np
+import torch
+
+from grid_modules.gridworld.helper_utilities import (get_possible_actions, check_can_take_action,
+                                                     get_state_after_executing_action, n_actions)
+from grid_modules.mdp_utils import compute_successor_reps
+from grid_modules.transitions import SparseTransitions
+
+"""
+The grid world code as it was before it was vectorized, test_gridworld.py checks the new code against these
+and the benchmark_*.py scripts time both sides.
+
+"""
+
+
+def reference_transitions(char_matrix, p_success):
+    # the builder as it was, one (s, a) at a time, then wall by wall
+    size = len(char_matrix)
+    p_fail = 1 - p_success
+    next_states = np.zeros((size * size, n_actions, n_actions), dtype=np.int64)
+    probs = np.zeros((size * size, n_actions, n_actions))
+    for s in range(size * size):
+        for a in range(n_actions):
+            next_states[s, a] = s
+            possible_actions = get_possible_actions(s, size)
+            for other_action in possible_actions:
+                next_states[s, a, other_action] = get_state_after_executing_action(other_action, s, size)
+            if check_can_take_action(a, s, size):
+                possible_actions.remove(a)
+            for other_action in possible_actions:
+                probs[s, a, other_action] = p_fail / len(possible_actions)
+            probs[s, a, a] = p_success
+    from_states = np.broadcast_to(np.arange(size * size)[:, None, None], next_states.shape)
+    for r in range(size):
+        for c in range(size):
+            if char_matrix[r][c] != '#':
+                continue
+            target = r * size + c
+            into_wall = next_states == target
+            next_states[into_wall] = from_states[into_wall]
+            next_states[target] = target
+            probs[target] = 0
+            probs[target, :, 0] = 1
+    return SparseTransitions(next_states, probs)
+
+
+def successor_reps_q(P, pi, R, gamma):
+    # the policy evaluation as it was, inverse then product with the reward
+    state_space, action_space = R.shape
+    sr_pi = compute_successor_reps(P, pi, gamma)
+    q_pi = torch.matmul(sr_pi, R.t().reshape(state_space * action_space))
+    return q_pi.reshape(action_space, state_space).t()
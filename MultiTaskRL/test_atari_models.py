@@ -0,0 +1,70 @@
+import pytest
+import torch
+
+from atari_modules.models import TaskAwareCritic, TransformerCritic, TransformerOracle
+from atari_reference import concat_forward, critic_repeat, oracle_repeat
+
+"""
+Checks the factorised TaskAwareCritic and the broadcast cross attention of the transformer models against the
+paths they replaced, the forward passes as well as the gradients since the models are trained through them.
+Run from MultiTaskRL/: python -m pytest test_atari_models.py
+
+"""
+
+NUM_ACTIONS = 5
+
+
+def outputs_and_grads(model, fn, *inputs):
+    model.zero_grad()
+    output = fn(*inputs)
+    output.pow(2).mean().backward()
+    return output.detach(), [p.grad.clone() for p in model.parameters() if p.grad is not None]
+
+
+def assert_same(expected, actual):
+    (expected_output, expected_grads), (output, grads) = expected, actual
+    assert output.shape == expected_output.shape
+    assert torch.allclose(output, expected_output, atol=1e-5, rtol=1e-4), (output - expected_output).abs().max()
+    assert len(grads) == len(expected_grads)
+    for expected_grad, grad in zip(expected_grads, grads):
+        assert torch.allclose(grad, expected_grad, atol=1e-5, rtol=1e-4), (grad - expected_grad).abs().max()
+
+
+@pytest.mark.parametrize('number_goals', [1, 7, 40])
+def test_task_aware_critic_matches_concat(number_goals):
+    torch.manual_seed(0)
+    embed_dim, batch_size = 32, 16
+    critic = TaskAwareCritic({'obs': (84, 84, 4), 'goal': 2, 'action': NUM_ACTIONS}, embed_dim)
+    obs = torch.rand(batch_size, 4, 84, 84)
+    encoding = torch.randn(number_goals, embed_dim, NUM_ACTIONS)
+    # an all zero encoding skips the normalisation
+    encoding[0] = 0
+    expected = outputs_and_grads(critic, concat_forward, critic, obs, encoding)
+    actual = outputs_and_grads(critic, critic, obs, encoding)
+    assert actual[0].shape == (number_goals, batch_size, NUM_ACTIONS)
+    assert_same(expected, actual)
+
+
+@pytest.mark.parametrize('num_obs, num_goals, num_examples', [(1, 3, 10), (16, 5, 50)])
+def test_transformer_critic_matches_repeat(num_obs, num_goals, num_examples):
+    torch.manual_seed(0)
+    critic = TransformerCritic((84, 84, 4), (2,), (NUM_ACTIONS,), device="cpu")
+    obs = torch.rand(num_obs, 4, 84, 84)
+    example_state = torch.rand(num_goals, num_examples, 2)
+    example_reward = torch.randn(num_goals, num_examples, NUM_ACTIONS)
+    expected = outputs_and_grads(critic, critic_repeat, critic, obs, example_state, example_reward)
+    actual = outputs_and_grads(critic, critic, obs, example_state, example_reward)
+    assert actual[0].shape == (num_obs, num_goals, NUM_ACTIONS)
+    assert_same(expected, actual)
+
+
+@pytest.mark.parametrize('num_obs, num_goals', [(1, 3), (16, 7)])
+def test_transformer_oracle_matches_repeat(num_obs, num_goals):
+    torch.manual_seed(0)
+    oracle = TransformerOracle((84, 84, 4), (2,), (NUM_ACTIONS,), device="cpu")
+    obs = torch.rand(num_obs, 4, 84, 84)
+    goal = torch.rand(num_goals, 2)
+    expected = outputs_and_grads(oracle, oracle_repeat, oracle, obs, goal)
+    actual = outputs_and_grads(oracle, oracle, obs, goal)
+    assert actual[0].shape == (num_obs, num_goals, NUM_ACTIONS)
+    assert_same(expected, actual)
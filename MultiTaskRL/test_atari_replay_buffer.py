@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+from atari_modules.replay_buffer import ReplayBuffer, FrameStoreReplayBuffer, SumTree, steps_to_end
+
+"""
+Checks the atari replay code: the frame store against the plain ring buffer, the sum tree of the prioritized
+replay and steps_to_end.
+Run from MultiTaskRL/: python -m pytest test_atari_replay_buffer.py
+
+"""
+
+
+def stacked_episodes(rng, num_transitions, frame_stack=4, frame_shape=(4, 4, 1), episode_length=7):
+    # (obs, obs_next, done) like FrameStack: a reset stacks the reset frame k times, a step pushes 3 frames.
+    # The frames come from a small pool, so equal frames show up across steps and episodes as well
+    pool = rng.integers(0, 256, size=(6, *frame_shape), dtype=np.uint8)
+    frames = [pool[rng.integers(len(pool))]] * frame_stack
+    t = 0
+    for _ in range(num_transitions):
+        obs = np.concatenate(frames[-frame_stack:], axis=-1)
+        frames = frames + [pool[i] for i in rng.integers(len(pool), size=3)]
+        obs_next = np.concatenate(frames[-frame_stack:], axis=-1)
+        t += 1
+        done = t == episode_length
+        yield obs, obs_next, done
+        if done:
+            frames = [pool[rng.integers(len(pool))]] * frame_stack
+            t = 0
+
+
+def check_same_transitions(ring, frame_store):
+    assert 0 < len(frame_store) <= len(ring)
+    idxes = np.arange(frame_store._first, frame_store._num_added) % frame_store._maxsize
+    expected = ring._encode_sample(idxes)
+    transitions = frame_store._encode_sample(idxes)
+    for key in ['obs', 'obs_next', 'ag', 'g', 'action', 'reward', 'done']:
+        assert np.array_equal(transitions[key], expected[key]), key
+
+
+@pytest.mark.parametrize('num_transitions', [30, 500])
+def test_frame_store_matches_ring(num_transitions):
+    # 500 transitions wrap both rings several times
+    size = 64
+    rng = np.random.default_rng(0)
+    ring, frame_store = ReplayBuffer(size), FrameStoreReplayBuffer(size, max_reuse_lag=16)
+    for i, (obs, obs_next, done) in enumerate(stacked_episodes(rng, num_transitions)):
+        for buffer in (ring, frame_store):
+            buffer.add(obs, np.array([i, 0]), np.array([0, i]), i % 5, float(i), obs_next, done)
+    check_same_transitions(ring, frame_store)
+    transitions = frame_store.sample(32)
+    assert transitions['obs'].shape == (32, 4, 4, 4)
+
+
+def test_frame_store_add_batch_matches_ring():
+    # frames are only shared within the stream of an env, the episodes of the envs end at different steps
+    size, num_envs = 60, 3
+    rng = np.random.default_rng(1)
+    streams = [stacked_episodes(rng, 200, episode_length=5 + i) for i in range(num_envs)]
+    ring, frame_store = ReplayBuffer(size), FrameStoreReplayBuffer(size, max_reuse_lag=16)
+    for step in range(200):
+        obs, obs_next, done = map(np.stack, zip(*[next(stream) for stream in streams]))
+        ag = np.full((num_envs, 2), step)
+        for buffer in (ring, frame_store):
+            buffer.add_batch(obs, ag, ag, np.arange(num_envs), np.zeros(num_envs), obs_next, done)
+    check_same_transitions(ring, frame_store)
+
+
+def test_sum_tree_sampling_proportions():
+    # 5 leaves are padded to a tree of 8, the last leaf and the padding have no mass
+    tree = SumTree(5)
+    priorities = np.array([1., 2., 3., 4., 0.])
+    tree.update(np.arange(5), priorities)
+    assert tree.total == priorities.sum()
+    np.random.seed(0)
+    idxes = np.concatenate([tree.sample(100) for _ in range(2000)])
+    assert idxes.max() < 4
+    frequencies = np.bincount(idxes, minlength=5) / len(idxes)
+    assert np.allclose(frequencies, priorities / priorities.sum(), atol=0.01)
+
+
+def test_sum_tree_update_duplicate_idxes():
+    tree = SumTree(6)
+    tree.update(np.arange(6), np.ones(6))
+    # a batch can sample the same transition twice, the parents are still only summed once
+    tree.update([2, 2, 5, 0, 5], [4., 4., 3., 0.5, 3.])
+    leaves = np.array([0.5, 1., 4., 1., 1., 3.])
+    assert np.allclose(tree[np.arange(6)], leaves)
+    assert np.isclose(tree.total, leaves.sum())
+    internal = np.arange(1, tree.capacity)
+    assert np.allclose(tree.tree[internal], tree.tree[2 * internal] + tree.tree[2 * internal + 1])
+
+
+def test_steps_to_end():
+    dones = np.array([[0, 0, 1, 0, 0],
+                      [0, 0, 0, 0, 0],
+                      [1, 1, 0, 0, 1]])
+    expected = np.array([[2, 1, 0, 2, 1],
+                         [5, 4, 3, 2, 1],
+                         [0, 0, 2, 1, 0]])
+    assert np.array_equal(steps_to_end(dones), expected)
+
+    # against a loop over the steps
+    dones = np.random.default_rng(0).random((20, 50)) < 0.1
+    expected = np.array([[next((k - t for k in range(t, 50) if row[k]), 50 - t) for t in range(50)] for row in dones])
+    assert np.array_equal(steps_to_end(dones), expected)
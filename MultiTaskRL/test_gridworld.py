@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+import torch
+
+from grid_modules.gridworld import FOUR_ROOM_TXT, BIG_FOUR_ROOM_TXT
+from grid_modules.gridworld.env import VectorGridWorldMDP
+from grid_modules.gridworld.txt_utilities import get_char_matrix, build_gridworld_from_char_matrix, rooms, maze
+from grid_modules.mdp_utils import (value_iteration, batched_value_iteration, compute_successor_reps,
+                                    policy_evaluation, OptimalQTable)
+from grid_reference import reference_transitions, successor_reps_q
+
+"""
+Checks the sparse, vectorized and batched grid world code against the implementations it replaced.
+The reference implementations live in grid_reference.py, the benchmark_*.py scripts time both sides.
+Run from MultiTaskRL/: python -m pytest test_gridworld.py
+
+"""
+
+
+MAPS = [get_char_matrix(FOUR_ROOM_TXT), get_char_matrix(BIG_FOUR_ROOM_TXT), rooms(31), maze(31)]
+
+
+@pytest.mark.parametrize('p_success', [1, 0.8])
+@pytest.mark.parametrize('char_matrix', MAPS)
+def test_builder_matches_reference(char_matrix, p_success):
+    P = build_gridworld_from_char_matrix(char_matrix, p_success=p_success).P
+    expected = reference_transitions(char_matrix, p_success)
+    assert np.allclose(P.to_dense(), expected.to_dense())
+    assert P.is_stochastic()
+
+
+@pytest.mark.parametrize('p_success', [1, 0.8])
+def test_sparse_matches_dense(p_success):
+    gamma = 0.9
+    torch.manual_seed(0)
+    env = build_gridworld_from_char_matrix(get_char_matrix(BIG_FOUR_ROOM_TXT), p_success=p_success)
+    env.reset()
+    R = torch.tensor(env.R, dtype=torch.float32)
+    P_dense = torch.tensor(env.P.to_dense(), dtype=torch.float32)
+    P_sparse = env.P.to_torch()
+    q_dense = value_iteration(R, P_dense, gamma, atol=1e-8, max_iteration=5000)
+    q_sparse = value_iteration(R, P_sparse, gamma, atol=1e-8, max_iteration=5000)
+    assert torch.allclose(q_dense, q_sparse, atol=1e-5)
+
+    pi = torch.softmax(torch.randn(env.state_space, env.action_space), dim=-1)
+    assert torch.allclose(compute_successor_reps(P_dense, pi, gamma), compute_successor_reps(P_sparse, pi, gamma),
+                          atol=1e-4)
+
+    P = env.P.to_dense()
+    for _ in range(100):
+        s = env.current_state.argmax()
+        a = np.random.randint(env.action_space)
+        next_state = env.step(a)[0].argmax()
+        assert P[s, a, next_state] > 0
+
+
+def test_batched_value_iteration():
+    gamma = 0.9
+    env = build_gridworld_from_char_matrix(get_char_matrix(FOUR_ROOM_TXT), p_success=0.9)
+    P = env.P.to_torch()
+    table = OptimalQTable(P, gamma, atol=1e-8, max_iteration=5000)
+    goal_ids = list(np.random.RandomState(0).choice(env.reachable_states, 10))
+    expected = torch.stack([value_iteration(R, P, gamma, atol=1e-8, max_iteration=5000)
+                            for R in table.rewards(goal_ids)])
+    assert torch.allclose(expected, batched_value_iteration(table.rewards(goal_ids), P, gamma, atol=1e-8,
+                                                            max_iteration=5000), atol=1e-6)
+    assert torch.allclose(expected, table(goal_ids), atol=1e-6)
+    # memoized
+    assert torch.allclose(expected, table(goal_ids), atol=1e-6)
+
+
+def test_policy_evaluation():
+    gamma = 0.9
+    n_goals = 5
+    torch.manual_seed(0)
+    env = build_gridworld_from_char_matrix(get_char_matrix(FOUR_ROOM_TXT), p_success=0.9)
+    P = env.P.to_torch()
+    goal_ids = list(np.random.RandomState(0).choice(env.reachable_states, n_goals))
+    Rs = OptimalQTable(P, gamma).rewards(goal_ids)
+    pis = torch.softmax(torch.randn(2, n_goals, env.state_space, env.action_space), dim=-1)
+
+    q_iterative = policy_evaluation(Rs, P, pis, gamma)
+    for i in range(2):
+        for j in range(n_goals):
+            assert torch.allclose(successor_reps_q(P, pis[i, j], Rs[j], gamma), q_iterative[i, j], atol=1e-4)
+        # one policy, all the rewards at once
+        q_solve = policy_evaluation(Rs, P, pis[i, 0], gamma, solver='solve')
+        assert torch.allclose(q_solve[0], successor_reps_q(P, pis[i, 0], Rs[0], gamma), atol=1e-4)
+
+
+def test_vector_gridworld_samples_from_P():
+    env = build_gridworld_from_char_matrix(get_char_matrix(BIG_FOUR_ROOM_TXT), p_success=0.7)
+    P = env.P.to_dense()
+    num_envs = 100000
+    vec_env = VectorGridWorldMDP(env, num_envs, seed=0)
+    rng = np.random.RandomState(0)
+    for _ in range(5):
+        state = rng.choice(env.reachable_states)
+        action = rng.randint(env.action_space)
+        vec_env.reset()
+        vec_env.states[:] = state
+        next_states, rewards, dones, _ = vec_env.step(np.full(num_envs, action))
+        frequencies = np.bincount(next_states, minlength=env.state_space) / num_envs
+        assert np.allclose(frequencies, P[state, action], atol=0.01)
+        assert np.array_equal(rewards, (state == vec_env.goals).astype(np.float32))
+    onehot = vec_env.onehot(next_states[:10])
+    assert np.array_equal(onehot.argmax(-1), next_states[:10])
+    assert np.all(onehot.sum(-1) == 1)